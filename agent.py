@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor remote reader agent
+# With "--agent <url>" reader scripts (see readers.run) send measurements to
+# a central bluesensor-server.py (POST /api/ingest, see IngestHandler there)
+# instead of printing them. Every measurement gets a sequence number and is
+# appended to a local spool (spool.py) first; a background thread sends
+# spooled measurements in compressed batches and removes them from spool
+# only when server has acknowledged them, so nothing is lost while the link
+# is down and after a restart the agent continues with the first measurement
+# which was not acknowledged. Server skips sequence numbers it has already
+# accepted, so a batch sent again after its response was lost is not saved
+# twice.
+# Sequence numbers are reserved in blocks of SEQ_BLOCK in file "sequence" of
+# spool directory (with random ID of spool, which tells server that numbering
+# started again when spool was removed), so they increase across restarts
+# without writing the file for every measurement.
+# Batch is sent as lines "<seq>\t<port>\t<JSON measurement>", compressed
+# with gzip or, if module zstandard is installed ("pip install zstandard"),
+# with zstd.
+
+import os
+import json
+import uuid
+import zlib
+import gzip
+import urllib.parse
+import urllib.request
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from spool import Spool, SpoolDrainer
+
+SPOOL_PATH  = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agent-spool') # spools of agents, one per port
+BATCH       = 5000 # max measurements sent at once
+INTERVAL    = 5.0  # seconds to wait for more measurements after a batch which was not full
+SEQ_BLOCK   = 10000 # sequence numbers reserved at once
+TIMEOUT     = 30   # seconds to wait for response of server
+MAX_BATCH_BYTES = 64*1024*1024 # max bytes of decompressed batch accepted by server
+ENCODINGS   = ('gzip', 'zstd', 'identity')
+
+# (compressed data, value of Content-Encoding)
+def compress(data, encoding='gzip'):
+    if encoding == 'gzip':
+        return gzip.compress(data, 6), encoding
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd needs module zstandard')
+        return zstandard.ZstdCompressor().compress(data), encoding
+    return data, 'identity'
+
+# data of request body with Content-Encoding encoding, raises ValueError
+# when encoding is not supported or data is bigger than limit
+def decompress(data, encoding=None, limit=MAX_BATCH_BYTES):
+    if encoding in (None, '', 'identity'):
+        result = data
+    elif encoding == 'gzip':
+        d = zlib.decompressobj(wbits=31)
+        result = d.decompress(data, limit + 1)
+        if not d.eof:
+            raise ValueError('incomplete gzip data' if len(result) <= limit else 'batch is too big')
+    elif encoding == 'zstd' and zstandard is not None:
+        result = zstandard.ZstdDecompressor().stream_reader(data).read(limit + 1)
+    else:
+        raise ValueError('unsupported Content-Encoding {}'.format(encoding))
+    if len(result) > limit:
+        raise ValueError('batch is too big')
+    return result
+
+def available(encoding):
+    return encoding in ENCODINGS and (encoding != 'zstd' or zstandard is not None)
+
+class Agent:
+    # url of central server, port is name of reader's port (for example "0"),
+    # measurements are sent as measurements of sensor "<agent_id>-<port>"
+    def __init__(self, url, agent_id, reader_name, port, spool_path,
+                 encoding='gzip', token=None, batch_size=BATCH, interval=INTERVAL):
+        if not available(encoding):
+            raise ValueError('unsupported compression {}'.format(encoding))
+        self.spool = Spool(spool_path)
+        self.seq_file = os.path.join(spool_path, 'sequence')
+        self.run, self.reserved = self.load_sequence()
+        self.seq = self.reserved
+        self.port = port
+        self.encoding = encoding
+        self.headers = {'Content-Type': 'text/tab-separated-values; charset=utf-8',
+                        'Content-Encoding': encoding}
+        if token is not None:
+            self.headers['Authorization'] = 'Bearer ' + token
+        self.url = '{}/api/ingest?{}'.format(url.rstrip('/'), urllib.parse.urlencode(
+            {'agent': agent_id, 'reader': reader_name, 'run': self.run}))
+        self.sent = 0 # measurements acknowledged by server
+        self.sent_bytes = 0 # compressed bytes of acknowledged batches
+        self.drainer = SpoolDrainer(self.spool, self.send_batch, batch_size, interval)
+        self.drainer.start()
+
+    def load_sequence(self):
+        try:
+            with open(self.seq_file) as f:
+                state = json.load(f)
+            return str(state['run']), int(state['reserved'])
+        except FileNotFoundError:
+            return uuid.uuid4().hex, 0
+
+    def reserve(self):
+        self.reserved += SEQ_BLOCK
+        with open(self.seq_file + '.tmp', 'w') as f:
+            json.dump({'run': self.run, 'reserved': self.reserved}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.seq_file + '.tmp', self.seq_file)
+
+    def append(self, measurements):
+        for measurement in measurements:
+            if self.seq >= self.reserved:
+                self.reserve()
+            self.seq += 1
+            self.spool.append(self.seq, self.port, json.dumps(measurement))
+
+    # write_batch of SpoolDrainer: raises exception when batch is not acknowledged
+    def send_batch(self, records):
+        data, encoding = compress(''.join('\t'.join(record) + '\n' for record in records).encode('utf-8'),
+                                  self.encoding)
+        request = urllib.request.Request(self.url, data, self.headers)
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            result = json.loads(response.read().decode('utf-8'))
+        if result.get('ack', {}).get(self.port, 0) < int(records[-1][0]):
+            raise ValueError('batch was not acknowledged')
+        self.sent += len(records)
+        self.sent_bytes += len(data)
+
+    def stop(self):
+        self.drainer.stop()
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor alerting
+# Rules (JSON file given with --alerts) are evaluated on every measurement,
+# per data key. Every rule keeps its own state per sensor and the state is
+# updated incrementally in O(1) per sample, so nothing is recomputed over
+# history. Rules are bound to sensors and data keys once (when the engine is
+# created), so a sample only touches rules of its own sensor.
+# Rule types:
+# - threshold: value is above "above" or below "below";
+# - rate: value changes faster than "per_second" (in either direction);
+# - zscore: value is more than "z" standard deviations away from mean of
+#   the last "window" values;
+# - stale: no value of key (or no measurement, without "key") for "seconds";
+#   counted from arrival of the last value, not from its time, so a backlog
+#   of old measurements (agent after an outage, replay) keeps rule quiet.
+# Example of rules file:
+# [{"name": "pm25-high", "key": "pm25", "type": "threshold", "above": 50},
+#  {"name": "gas1-spike", "key": "gas1", "type": "zscore", "window": 60, "z": 4},
+#  {"name": "silent", "type": "stale", "seconds": 30, "sensor": "0"}]
+# Alert events are dicts:
+# {"type": "alert", "state": "firing" or "resolved", "rule": ..., "sensor": ...,
+#  "key": ..., "time": <msec>, "value": ..., "message": ...}
+
+import json
+import math
+from collections import deque
+
+RULE_TYPES = ('threshold', 'rate', 'zscore', 'stale')
+WINDOW = 60    # values in rolling window of zscore rules
+Z      = 3.0   # standard deviations of zscore rules
+STALE  = 60    # seconds of stale rules
+
+def number(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value == value:
+        return value
+    return None
+
+# Mean and standard deviation of the last n values, updated in O(1): running
+# sums are corrected by the value which leaves the window. Sums are computed
+# again every n values, so rounding errors don't accumulate.
+class Window:
+    __slots__ = ('size', 'values', 'sum', 'sumsq', 'updates')
+
+    def __init__(self, size):
+        self.size = size
+        self.values = deque()
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.updates = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        self.values.append(value)
+        self.sum += value
+        self.sumsq += value*value
+        if len(self.values) > self.size:
+            old = self.values.popleft()
+            self.sum -= old
+            self.sumsq -= old*old
+        self.updates += 1
+        if self.updates >= self.size:
+            self.updates = 0
+            self.sum = math.fsum(self.values)
+            self.sumsq = math.fsum(v*v for v in self.values)
+
+    def mean(self):
+        return self.sum/len(self.values)
+
+    def stddev(self):
+        n = len(self.values)
+        return math.sqrt(max(0.0, self.sumsq/n - (self.sum/n)**2))
+
+class Rule:
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise ValueError('rule must be an object')
+        self.type = spec.get('type', 'threshold')
+        if self.type not in RULE_TYPES:
+            raise ValueError('unknown rule type {!r}'.format(self.type))
+        self.key = spec.get('key')
+        if self.key is None and self.type != 'stale':
+            raise ValueError('rule of type {} needs "key"'.format(self.type))
+        self.name = str(spec.get('name') or '{}-{}'.format(self.key or 'measurement', self.type))
+        self.sensor = spec.get('sensor') # None for all sensors
+        if self.sensor is not None:
+            self.sensor = str(self.sensor)
+        try:
+            self.above = self.limit(spec, 'above')
+            self.below = self.limit(spec, 'below')
+            self.per_second = self.limit(spec, 'per_second')
+            self.window = int(spec.get('window', WINDOW))
+            self.z = float(spec.get('z', Z))
+            self.seconds = float(spec.get('seconds', STALE))
+        except (TypeError, ValueError):
+            raise ValueError('invalid limit in rule {}'.format(self.name))
+        if self.type == 'threshold' and self.above is None and self.below is None:
+            raise ValueError('threshold rule {} needs "above" or "below"'.format(self.name))
+        if self.type == 'rate' and self.per_second is None:
+            raise ValueError('rate rule {} needs "per_second"'.format(self.name))
+        if self.window < 2:
+            raise ValueError('window of rule {} is too small'.format(self.name))
+
+    @staticmethod
+    def limit(spec, name):
+        return None if spec.get(name) is None else float(spec[name])
+
+    def matches(self, sensor_name):
+        return self.sensor is None or self.sensor == sensor_name
+
+# state of one rule for one sensor
+class State:
+    __slots__ = ('rule', 'sensor', 'active', 'event', 'last_time', 'last_value', 'received', 'window')
+
+    def __init__(self, rule, sensor, now):
+        self.rule = rule
+        self.sensor = sensor
+        self.active = False
+        self.event = None # last alert event
+        self.last_time = now # msec of last value (for rate rules)
+        self.last_value = None
+        self.received = now # wall clock msec when last value arrived (for stale rules)
+        self.window = Window(rule.window) if rule.type == 'zscore' else None
+
+    # new value at time t (msec) which arrived at received (msec), returns
+    # (firing, message) or None when state can't be decided yet
+    def update(self, t, value, received):
+        rule = self.rule
+        if rule.type == 'threshold':
+            if rule.above is not None and value > rule.above:
+                return True, '{} is above {}'.format(value, rule.above)
+            if rule.below is not None and value < rule.below:
+                return True, '{} is below {}'.format(value, rule.below)
+            return False, None
+        if rule.type == 'rate':
+            last_time, last_value = self.last_time, self.last_value
+            self.last_time, self.last_value = t, value
+            if last_value is None or t <= last_time:
+                return None
+            rate = (value - last_value)*1000/(t - last_time)
+            if abs(rate) > rule.per_second:
+                return True, 'changes by {:.4g}/s'.format(rate)
+            return False, None
+        if rule.type == 'zscore':
+            window = self.window
+            result = None
+            if len(window) >= rule.window:
+                mean = window.mean(); stddev = window.stddev()
+                if stddev > 0:
+                    z = (value - mean)/stddev
+                    result = (True, '{} is {:.2f} standard deviations from mean {:.4g}'.format(value, z, mean))\
+                        if abs(z) > rule.z else (False, None)
+            window.add(value)
+            return result
+        # stale: a value has arrived
+        self.received = received
+        return False, None
+
+class Engine:
+    # on_event is called with every alert event
+    def __init__(self, rules, sensor_names, on_event, now):
+        self.rules = rules
+        self.on_event = on_event
+        self.by_sensor = {} # sensor -> {key -> [State]}, key None for any measurement
+        self.stale = [] # States of stale rules, checked by check()
+        self.fired = {} # rule name -> alerts fired
+        for name in sensor_names:
+            self.add_sensor(name, now)
+
+    # bind rules to sensor which appeared after engine was created (remote sensors)
+    def add_sensor(self, name, now):
+        if name in self.by_sensor: return
+        self.by_sensor[name] = table = {}
+        for rule in self.rules:
+            if rule.matches(name):
+                state = State(rule, name, now)
+                table.setdefault(rule.key, []).append(state)
+                if rule.type == 'stale':
+                    self.stale.append(state)
+
+    # measurement of sensor at time t (msec) with data {key: value}, which
+    # arrived at received (wall clock msec, same clock as now of check())
+    def sample(self, sensor_name, t, data, received):
+        table = self.by_sensor.get(sensor_name)
+        if not table: return
+        for key, states in table.items():
+            if key is None:
+                value = t
+            else:
+                value = number(data.get(key))
+                if value is None: continue
+            for state in states:
+                result = state.update(t, value, received)
+                if result is not None and result[0] != state.active:
+                    self.change(state, result[0], t, None if key is None else value, result[1])
+
+    # fire stale rules, now is msec
+    def check(self, now):
+        for state in self.stale:
+            if not state.active and now - state.received > state.rule.seconds*1000:
+                self.change(state, True, now, None, 'no {} for {:g} s'.format(
+                    'value of ' + state.rule.key if state.rule.key else 'measurement', state.rule.seconds))
+
+    def change(self, state, firing, t, value, message):
+        state.active = firing
+        rule = state.rule
+        if firing:
+            self.fired[rule.name] = self.fired.get(rule.name, 0) + 1
+        state.event = {'type': 'alert', 'state': 'firing' if firing else 'resolved',
+                       'rule': rule.name, 'sensor': state.sensor, 'key': rule.key,
+                       'time': t, 'value': value, 'message': message}
+        self.on_event(state.event)
+
+    # events of alerts which are firing
+    def active(self):
+        return [state.event for table in self.by_sensor.values() for states in table.values()
+                for state in states if state.active]
+
+def load_rules(path):
+    with open(path) as f:
+        specs = json.load(f)
+    if isinstance(specs, dict):
+        specs = specs.get('rules', [])
+    if not isinstance(specs, list):
+        raise ValueError('list of rules expected')
+    return [Rule(spec) for spec in specs]
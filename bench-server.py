@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# End-to-end benchmark of bluesensor-server.py: runs server with <sensors>
+# simulated readers at <rate> measurements per second each, attaches
+# <clients> WebSocket clients to /data and reports ingest throughput,
+# broadcast latency (time of measurement to receipt by client), CPU and
+# memory of server and (with --db) database write lag. Results are printed
+# as JSON to stdout, summary to stderr.
+# Usage: "python bench-server.py [options] [-- <server options>]"
+# Example: "python bench-server.py --sensors 4 --rate 500 --clients 20 --duration 30"
+
+import sys, os
+import traceback
+import time
+import json
+import socket
+import subprocess
+import tempfile
+import shutil
+from array import array
+from tornado import ioloop, gen, websocket, httpclient
+
+import timing
+import readers
+
+SENSORS  = 2     # simulated readers
+RATE     = 100   # measurements per second of each reader
+CLIENTS  = 10    # WebSocket clients
+DURATION = 10    # seconds of measurement
+WARMUP   = 2     # seconds before measurement starts
+PORT     = 8099
+PROTO    = 2
+READER   = 'read-serial'
+KEYS     = {'read-serial': 'temp1', 'read-raw-serial': 'temp1', 'read-dust': 'pm25'} # data key used
+                                        # for counting measurements in server's store
+SERVER   = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bluesensor-server.py')
+
+OPTIONS = ('sensors', 'rate', 'clients', 'duration', 'warmup', 'port', 'proto',
+           'reader', 'db', 'output')
+
+def print_exc(f_name, msg=''):
+    exc_type, exc_obj, exc_tb = sys.exc_info()
+    exc = traceback.format_exception_only(exc_type, exc_obj)
+    err = '{}({}): {}'.format(f_name, exc_tb.tb_lineno, msg) + exc[-1].strip()
+    sys.stderr.write(err + '\n')
+    sys.stderr.flush()
+
+def usage():
+    sys.stderr.write('Usage: python bench-server.py [options] [-- <server options>]\n')
+    sys.stderr.write('Options:\n')
+    sys.stderr.write('  --sensors <n>   simulated readers (default {})\n'.format(SENSORS))
+    sys.stderr.write('  --rate <n>      measurements per second of each reader (default {})\n'.format(RATE))
+    sys.stderr.write('  --clients <n>   WebSocket clients (default {})\n'.format(CLIENTS))
+    sys.stderr.write('  --duration <s>  seconds of measurement (default {})\n'.format(DURATION))
+    sys.stderr.write('  --warmup <s>    seconds before measurement starts (default {})\n'.format(WARMUP))
+    sys.stderr.write('  --port <n>      TCP port of server (default {})\n'.format(PORT))
+    sys.stderr.write('  --proto <n>     WebSocket protocol of clients, 1 or 2 (default {})\n'.format(PROTO))
+    sys.stderr.write('  --reader <r>    reader of simulated sensors (default {})\n'.format(READER))
+    sys.stderr.write('  --db <n>        save every <n>-th measurement into database (see database.py)\n')
+    sys.stderr.write('  --output <f>    write results to file <f> instead of stdout\n')
+    sys.stderr.flush()
+
+# CPU seconds (user + system) and resident memory (bytes) of process (Linux)
+def proc_usage(pid):
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12]))/os.sysconf('SC_CLK_TCK')
+        rss = int(fields[21])*os.sysconf('SC_PAGE_SIZE')
+        return cpu, rss
+    except:
+        return None, None
+
+def percentile(values, p):
+    if not values: return None
+    return values[min(len(values) - 1, int(len(values)*p/100))]
+
+def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), 0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+class Client:
+    def __init__(self, stats):
+        self.stats = stats
+        self.received = 0
+        self.conn = None
+
+    @gen.coroutine
+    def run(self, url, proto):
+        self.conn = yield websocket.websocket_connect(url,
+            subprotocols=['bluesensor.v2'] if proto == 2 else None)
+        while True:
+            message = yield self.conn.read_message()
+            if message is None: return
+            now = timing.now_ms()
+            if not self.stats.measuring: continue
+            try:
+                if message.startswith('['):
+                    t = json.loads(message)[1] # v2 sample
+                elif message.startswith('{"metadata"'):
+                    t = json.loads(message).get('time') # v1 measurement
+                else:
+                    continue # metadata or backfill
+            except ValueError:
+                continue
+            self.received += 1
+            if isinstance(t, int):
+                self.stats.latencies.append(now - t)
+
+class Stats:
+    def __init__(self):
+        self.measuring = False
+        self.latencies = array('d')
+
+@gen.coroutine
+def store_count(port, sensor, key, t_from, t_to):
+    # measurements of sensor in server's store between t_from and t_to
+    url = 'http://localhost:{}/api/series?sensor={}&key={}&from={}&to={}&points=1'.format(
+        port, sensor, key, t_from, t_to)
+    response = yield httpclient.AsyncHTTPClient().fetch(url)
+    return sum(json.loads(response.body).get('count') or [0])
+
+def db_usage(t_from, t_to, sources, schema):
+    # rows saved into database between t_from and t_to, and lag (msec) of
+    # the newest row saved behind the time of the query
+    import database as db
+    import psycopg2
+    conn = psycopg2.connect(host=db.DBHOST, dbname=db.DBNAME, user=db.DBUSER, password=db.DBPWD)
+    try:
+        cs = conn.cursor()
+        if schema == 2:
+            table = "{sn} s JOIN {dn} d ON s.device = d.id WHERE d.source = ANY(%s) AND s.date >= %s"\
+                .format(sn=db.SAMPLES, dn=db.DEVICES)
+        else:
+            table = "{tn} s WHERE s.source = ANY(%s) AND s.date >= %s".format(tn=db.TABLE)
+        now = timing.now_ms()
+        cs.execute("SELECT count(*) FILTER (WHERE s.date <= %s), max(s.date) FROM " + table,
+                   (db.msDate(t_to), sources, db.msDate(t_from)))
+        rows, last = cs.fetchone()
+    finally:
+        conn.close()
+    lag = None
+    if last is not None:
+        lag = max(0, now - int((last - db.msDate(0)).total_seconds()*1000))
+    return rows, lag
+
+def main():
+    opts = {}; server_args = []
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == '--':
+            server_args = args; break
+        name = arg.lstrip('-')
+        if arg.startswith('-') and name in OPTIONS and args:
+            opts[name] = args.pop(0)
+        else:
+            usage()
+            sys.exit(1)
+    try:
+        sensors = int(opts.get('sensors', SENSORS))
+        rate = float(opts.get('rate', RATE))
+        clients = int(opts.get('clients', CLIENTS))
+        duration = float(opts.get('duration', DURATION))
+        warmup = float(opts.get('warmup', WARMUP))
+        port = int(opts.get('port', PORT))
+        proto = int(opts.get('proto', PROTO))
+        db_save = int(opts['db']) if 'db' in opts else None
+    except ValueError:
+        usage()
+        sys.exit(1)
+    reader = opts.get('reader', READER)
+
+    cmd = [sys.executable, SERVER, '--port', str(port), '--rate', str(rate)] + server_args
+    spool_dir = None
+    if db_save is not None:
+        spool_dir = tempfile.mkdtemp(prefix='bench-spool-')
+        cmd += ['--data-log', str(db_save), '--spool', spool_dir]
+    for i in range(sensors):
+        cmd += [reader, str(i), 'simulate']
+    sys.stderr.write('Running: {}\n'.format(' '.join(cmd)))
+    sys.stderr.flush()
+    log = tempfile.TemporaryFile()
+    server = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not wait_for_port(port):
+            raise RuntimeError('server is not listening on port {}'.format(port))
+        results = ioloop.IOLoop.current().run_sync(lambda: run(server, port, sensors, KEYS.get(reader, 'temp1'),
+                                                               rate, clients, duration, warmup, proto))
+        results.update({'sensors': sensors, 'rate': rate, 'clients': clients, 'proto': proto,
+                        'duration': duration, 'reader': reader, 'server_args': server_args})
+        if db_save is not None:
+            results['db_save'] = db_save
+            try:
+                schema = 2 if '--db-schema' in server_args and \
+                    server_args[server_args.index('--db-schema') + 1] == '2' else 1
+                sources = [readers.DEVNAME + str(i) for i in range(sensors)]
+                rows, lag = db_usage(results['t_from'], results['t_to'], sources, schema)
+                results['db_rows'] = rows
+                results['db_rows_per_s'] = round(rows/duration, 1)
+                results['db_lag_ms'] = lag
+            except:
+                print_exc(sys._getframe().f_code.co_name, 'database: ')
+                results['db_error'] = str(sys.exc_info()[1])
+    finally:
+        server.terminate()
+        try: server.wait(10)
+        except subprocess.TimeoutExpired: server.kill()
+        if spool_dir is not None:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+    if server.returncode not in (0, -15, None) and 'ingest_per_s' not in results:
+        log.seek(0)
+        sys.stderr.write(log.read().decode('utf-8', 'replace')[-2000:])
+
+    output = json.dumps(results, indent=2)
+    if 'output' in opts:
+        with open(opts['output'], 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+    sys.stdout.flush()
+    sys.stderr.write('ingest {ingest_per_s}/s, broadcast {broadcast_per_s}/s, latency p50 {latency_p50_ms} ms, '\
+        'p99 {latency_p99_ms} ms, server CPU {server_cpu_percent}%, RSS {server_rss_mb} MB\n'.format(**results))
+    if 'db_lag_ms' in results:
+        sys.stderr.write('database {db_rows_per_s} rows/s, lag {db_lag_ms} ms\n'.format(**results))
+    sys.stderr.flush()
+
+@gen.coroutine
+def run(server, port, sensors, key, rate, clients, duration, warmup, proto):
+    stats = Stats()
+    conns = [Client(stats) for i in range(clients)]
+    for client in conns:
+        ioloop.IOLoop.current().add_callback(client.run, 'ws://localhost:{}/data'.format(port), proto)
+    yield gen.sleep(warmup)
+
+    stats.measuring = True
+    t_from = timing.now_ms()
+    cpu0, rss = proc_usage(server.pid)
+    bench_cpu0 = time.process_time()
+    max_rss = rss or 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        yield gen.sleep(min(1.0, max(0.0, end - time.monotonic())))
+        cpu, rss = proc_usage(server.pid)
+        max_rss = max(max_rss, rss or 0)
+        if server.poll() is not None:
+            raise RuntimeError('server stopped')
+    stats.measuring = False
+    t_to = timing.now_ms()
+    cpu1, rss = proc_usage(server.pid)
+    bench_cpu = time.process_time() - bench_cpu0
+
+    ingested = 0
+    for i in range(sensors):
+        ingested += yield store_count(port, i, key, t_from, t_to)
+    for client in conns:
+        if client.conn is not None: client.conn.close()
+
+    elapsed = (t_to - t_from)/1000
+    latencies = sorted(stats.latencies)
+    received = sum(client.received for client in conns)
+    return {
+        't_from': t_from,
+        't_to': t_to,
+        'ingested': ingested,
+        'ingest_per_s': round(ingested/elapsed, 1),
+        'expected_per_s': round(sensors*rate, 1),
+        'received': received,
+        'broadcast_per_s': round(received/elapsed, 1),
+        'received_ratio': round(received/(ingested*clients), 4) if ingested and clients else None,
+        'latency_p50_ms': percentile(latencies, 50),
+        'latency_p99_ms': percentile(latencies, 99),
+        'latency_max_ms': latencies[-1] if latencies else None,
+        'server_cpu_percent': round((cpu1 - cpu0)/elapsed*100, 1) if cpu0 is not None and cpu1 is not None else None,
+        'server_rss_mb': round(rss/1e6, 1) if rss else None,
+        'server_max_rss_mb': round(max_rss/1e6, 1) if max_rss else None,
+        'bench_cpu_percent': round(bench_cpu/elapsed*100, 1)
+    }
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# Micro-benchmark of timestamp functions (see timing.py), prints cost of one
+# call. time_now_ms() is the old implementation used by readers and database.py.
+# Usage: "python bench-timing.py [<calls>]"
+
+import sys
+import time
+import datetime
+import timeit
+
+import timing
+
+CALLS = 200000
+
+try:
+    import pytz
+    tz = pytz.timezone('Europe/Ljubljana')
+
+    def time_now_ms():
+        tt = datetime.datetime.now(tz).timetuple()
+        now = time.mktime(tt) + 3600 # WTF?!
+        if tt.tm_isdst: now += 3600
+        return int(now)*1000
+except ImportError:
+    time_now_ms = None
+
+calls = int(sys.argv[1]) if len(sys.argv) > 1 else CALLS
+mono = time.monotonic_ns()
+tests = [
+    ('time.time_ns()', time.time_ns),
+    ('time.monotonic_ns()', time.monotonic_ns),
+    ('timing.now_ms()', timing.now_ms),
+    ('timing.clock.ms()', timing.clock.ms),
+    ('timing.clock.ms(received)', lambda: timing.clock.ms(mono)),
+    ('timing.utc_datetime(ms)', lambda: timing.utc_datetime(1792347802000)),
+]
+if time_now_ms is not None:
+    tests.append(('old time_now_ms()', time_now_ms))
+
+for name, f in tests:
+    best = min(timeit.repeat(f, number=calls, repeat=3))
+    sys.stdout.write('{:28s} {:8.3f} us/call\n'.format(name, best/calls*1e6))
+sys.stdout.flush()
@@ -2,26 +2,83 @@
 # coding: utf-8
 
 # Python application for displaying data from BlueSensor in a web application.
-# Appication runs web server on a localhost and calls data reader.
-# Currently there are two data readers available:
+# Appication runs web server on a localhost and calls data readers.
+# Readers (see readers.py) run in-process with serial ports watched by IOLoop,
+# or with --subprocess as separate processes printing JSON lines.
+# Currently there are three data readers available:
+# - read-serial, which reads JSON data from BlueSensor connected to USB port;
 # - read-raw-serial, which reads raw (tab-delimited) data from BlueSensor connected to USB port;
 # - read-dust, which reads JSON formatted data from SDS011, SDS018 or SDS021 dust sensor.
+# One server can supervise any number of readers (one per USB port).
 # Credits: Gasper Zejn, Matjaz Rihtar, Matej Kovacic.
 
 import sys, os, re
 import traceback
 import datetime, time
-from pprint import pprint
+import hashlib
+import email.utils
 import json
-from tornado import ioloop, gen, websocket, web
+import logging
+from tornado import ioloop, gen, websocket, web, iostream, process, locks, escape
+from tornado.ioloop import PeriodicCallback
+from tornado.concurrent import Future
 import subprocess
-from threading import Thread
-from multiprocessing import queues, get_context
-from collections import deque
+import tempfile
+from threading import Thread, Lock
+from collections import deque, OrderedDict
 
 import database as db
+import readers
+import timing
+import metrics
+import export
+import alerts
+import hotplug
+import capture
+import agent
+import bus
+from spool import Spool, SpoolDrainer, DRAIN_BATCH
+from store import RingBuffer, json_values, aggregate, lttb
 
 DB_SAVE = 5 # every <n> sensor reports
+ROLLUP_FLUSH = 60 # seconds between writes of rollups to database
+ROLLUP_BACKLOG = 60 # max rollup flushes kept while database is not available
+ROLLUP_SHUTDOWN = 30 # max seconds to wait at exit for rollups which are being written
+BUS_CHUNK = 10000 # measurements of history in one message to web worker
+RETENTION_CHECK = 3600 # seconds between deletions of expired raw rows
+READ_CHUNK = 65536 # max bytes read from serial port or reader's stdout at once
+RESTART_DELAY = 0.5 # seconds to wait before restarting a reader, doubled after every run without data
+RESTART_MAX_DELAY = 30 # max seconds to wait before restarting a reader
+STALL_FACTOR = 5 # reader is restarted when it sends no data for <n> expected intervals between measurements
+STALL_MIN = 3 # but not sooner than after <n> seconds
+HEALTH_CHECK = 0.5 # seconds between checks of readers
+HOTPLUG_POLL = 0.25 # seconds between checks for devices when inotify is not available
+READER_STATES = ('starting', 'running', 'stalled', 'backoff', 'done', 'offline') # done: end of replay,
+                                   # offline: remote sensor without data
+WORKER_CHECK = 1 # seconds between checks of web workers (--workers)
+DB_STATS = 60 # seconds between DB writer statistics reports
+ALERT_CHECK = 1 # seconds between checks of stale alert rules
+INGEST_SAVE = 1 # seconds between saves of sequence numbers accepted from agents (--ingest)
+REMOTE_TIMEOUT = 60 # remote sensor is offline when its agent sends nothing for <n> seconds
+AGENT_RE = re.compile(r'^[A-Za-z0-9_.\-]+$') # valid agent IDs and ports of remote sensors
+SPOOL_PATH = os.path.join(os.path.dirname(__file__), 'spool') # default spool directory
+HISTORY = 86400 # measurements kept in memory per sensor (24 hours at 1 Hz)
+BACKFILL = 300 # measurements sent to new clients
+SERIES_POINTS = 1000 # default number of points returned by /api/series
+SERIES_MAX_POINTS = 10000
+EXPORT_RANGE = 86400000 # msec exported by /api/export when "from" is not given
+SNAPSHOT_MAX_WAIT = 60 # max seconds of long-poll (?wait=) of /api/latest and /api/status
+WEB_PORT = 8080 # default TCP port when serving more than one sensor
+PROTOCOL_V2 = 'bluesensor.v2' # WebSocket subprotocol of compact protocol
+LOG_LEVEL = 'info' # "debug" prints every measurement and database insert
+
+log = logging.getLogger('bluesensor')
+
+READERS = {
+    'read-serial': 'read-serial.py',
+    'read-raw-serial': 'read-raw-serial.py',
+    'read-dust': 'read-dust.py'
+}
 
 def dump(obj, detailed=False):
     sys.stdout.write('obj.type = {}\n'.format(type(obj)))
@@ -47,177 +104,1600 @@ def print_exc(f_name, msg=''):
     sys.stderr.write(err + '\n')
     sys.stderr.flush()
 
+class Sensor:
+    def __init__(self, reader_name, name, simulate=False, remote=None):
+        self.reader_name = reader_name
+        self.reader_py = os.path.join(os.path.dirname(__file__), READERS[reader_name])
+        self.name = name # USB port ID, for example '0' for ttyUSB0
+        self.usbport = DEVNAME + name # can be 'usbserialxxx' on Mac
+        self.simulate = simulate
+        self.remote = remote # (agent ID, port) of remote sensor (see IngestHandler), None for local
+        if remote is not None:
+            self.usbport = '{}:{}'.format(*remote)
+        self.remote_run = None # ID of agent's spool
+        self.remote_seq = 0 # last sequence number accepted from agent
+        self.options = {} # options of reader, for example mode of dust sensor
+        self.reader = None # in-process reader (readers.Reader)
+        self.capture = None # capture of serial data (capture.Capture), with --capture
+        self.replay = None # replayed capture (capture.Replay), with --replay
+        self.device_id = None # device_id from reader's metadata
+        self.meritve = RingBuffer(history_size)
+        self.backfill_cache = {} # protocol -> backfill message of whole history
+        self.latest = None # (time, data) of the last measurement
+        self.snapshot_cache = {} # (kind, key) -> snapshot (see snapshot())
+        self.updated = locks.Condition() # notified when snapshots change
+        self.clients = set()
+        self.tick = 1
+        # statistics (see MetricsHandler)
+        self.lines = 0 # lines or frames read from reader
+        self.parse_errors = 0 # invalid lines from reader process
+        self.restarts = 0
+        self.reader_totals = {} # counters of in-process readers which were restarted
+        # supervision (see supervise())
+        self.state = 'starting' # one of READER_STATES
+        self.state_since = timing.now_ms()
+        self.last_data = time.monotonic() # when reader last sent any data
+        self.failures = 0 # runs of reader without data since the last one with data
+        self.stalls = 0
+        self.stop_reader = None # stops running reader
+        self.wakeup = None # Future which restarts reader at once when its device appears
+        self.present = False # device existed when reader stopped
+        self.status_message = None
+        # protocol v2: metadata is sent only when it changes (rev is increased),
+        # samples are sent as [sensor, time, value of keys[0], value of keys[1], ...]
+        self.metadata = None
+        self.keys = []
+        self.rev = 0
+        self.meta_message = None
+
+    def update_metadata(self, metadata, keys):
+        if metadata is not None:
+            self.metadata = metadata
+        self.keys = keys
+        self.rev += 1
+        self.meta_message = json.dumps({
+            'type': 'meta',
+            'sensor': self.name,
+            'rev': self.rev,
+            'metadata': self.metadata,
+            'keys': self.keys
+        }).encode('utf-8')
+
+    # state of reader is sent to protocol v2 clients as
+    # {"type": "status", "sensor": ..., "state": ..., "since": <msec>, ...}
+    def set_state(self, state):
+        if state == self.state: return
+        self.state = state
+        self.state_since = timing.now_ms()
+        self.status_message = json.dumps({
+            'type': 'status',
+            'sensor': self.name,
+            'state': self.state,
+            'since': self.state_since,
+            'restarts': self.restarts,
+            'stalls': self.stalls
+        }).encode('utf-8')
+        send_message(self.clients, None, self.status_message)
+        send_message(DataHandler.clients, None, self.status_message)
+        if bus_server is not None:
+            bus_server.publish('s', self.name, self.status_message)
+        self.changed()
+
+    # snapshots of /api/latest and /api/status are out of date, long-polling
+    # requests are woken up
+    def changed(self):
+        self.snapshot_cache.clear()
+        snapshot_cache.clear()
+        self.updated.notify_all()
+        snapshot_updated.notify_all()
+
+    # chunk of history from ingest process (see bus_snapshot()), the first
+    # one replaces local history
+    def restore(self, history):
+        if history.get('first', True):
+            self.meritve = RingBuffer(history_size)
+        self.backfill_cache.clear()
+        data = history['data']
+        for i, t in enumerate(history['time']):
+            self.meritve.append(t, dict((key, column[i]) for key, column in data.items()))
+        self.device_id = history['device_id']
+        if history['keys'] != self.keys or history['metadata'] != self.metadata:
+            self.update_metadata(history['metadata'], history['keys'])
+        if history['time']:
+            self.latest = (history['time'][-1], dict((key, column[-1]) for key, column in data.items()))
+        self.changed()
+
+    # seconds without data after which reader is restarted
+    def stall_timeout(self):
+        interval = 1.0/self.options.get('rate', readers.READERS[self.reader_name].rate)
+        if self.options.get('period'):
+            interval = max(interval, self.options['period']*60) # dust sensor sleeping between measurements
+        return max(STALL_MIN, STALL_FACTOR*interval)
+
+    # returns time of measurement, later than time of previous one (time is
+    # part of the key of a row in database, see update_db)
+    def append(self, t, measurement):
+        if not isinstance(t, int):
+            try: t = int(t)
+            except: t = timing.now_ms()
+        last = self.meritve.last_time()
+        if last is not None and t <= last:
+            t = last + 1
+        self.meritve.append(t, measurement.get('data') or {})
+        self.backfill_cache.clear()
+        self.latest = (t, measurement.get('data') or {})
+        self.changed()
+        return t
+
+    # columnar history of measurements newer than since (msec)
+    def history(self, since=None):
+        t_from = None if since is None else since + 1
+        if backfill_age:
+            t_from = max(t_from or 0, self.meritve.last_time() - backfill_age*1000)
+        times, columns = self.meritve.slice(t_from, last=backfill_size)
+        return {
+            'sensor': self.name,
+            'metadata': self.metadata,
+            'time': times.tolist(),
+            'data': dict((key, json_values(column)) for key, column in columns.items())
+        }
+
+    def backfill_message(self, proto, since=None):
+        message = self.backfill_cache.get(proto) if since is None else None
+        if message is None:
+            history = self.history(since)
+            if proto == 2:
+                # metadata is already sent in meta message
+                backfill = {'type': 'backfill', 'sensor': history['sensor'],
+                            'time': history['time'], 'data': history['data']}
+            else:
+                backfill = {'backfill': history}
+            message = json.dumps(backfill).encode('utf-8')
+            if since is None:
+                self.backfill_cache[proto] = message
+        return message
+
+sensors = OrderedDict() # sensor name -> Sensor
+snapshot_cache = {} # (kind, key) -> snapshot of all sensors
+snapshot_updated = locks.Condition() # notified when snapshot of any sensor changes
+
+def find_sensor(sensor_id):
+    sensor = sensors.get(sensor_id)
+    if sensor is None:
+        for s in sensors.values():
+            if s.device_id == sensor_id:
+                return s
+    return sensor
+
 class MainHandler(web.RequestHandler):
     @gen.coroutine
     def get(self):
         try:
+            if len(sensors) > 1 and self.get_argument('sensor', None) is None:
+                # list of dashboards, one per sensor; device_id comes from
+                # devices and remote agents, so everything is escaped
+                self.write('<html><head><title>BlueSensor</title></head><body><h1>BlueSensor</h1><ul>\n')
+                for sensor in sensors.values():
+                    self.write('<li><a href="/?sensor={0}">{1} ({2})</a></li>\n'.format(
+                        escape.xhtml_escape(escape.url_escape(sensor.name)),
+                        escape.xhtml_escape(sensor.device_id or sensor.reader_name),
+                        escape.xhtml_escape(sensor.usbport)))
+                self.write('</ul></body></html>\n')
+                return
             graf_template = os.path.join(os.path.dirname(__file__), 'graf.html')
             with open(graf_template) as f:
                 html = f.read()
-            self.write(html)
+            self.write(html.replace('%DISPLAY_TZ%', display_tz))
             self.flush()
         except:
             print_exc(sys._getframe().f_code.co_name, graf_template + ': ')
 
+# WebSocket protocols:
+# - 1 (default): every message is full JSON from reader, including metadata;
+# - 2 (subprotocol "bluesensor.v2" or ?proto=2): metadata message
+#   {"type": "meta", "sensor": ..., "rev": ..., "metadata": {...}, "keys": [...]}
+#   is sent on connect and whenever metadata changes, samples are compact arrays
+#   [sensor, time, value1, value2, ...] with values in order of "keys".
 class DataHandler(websocket.WebSocketHandler):
-    clients = set()
-    meritve = deque(maxlen=300)
+    clients = set() # clients of the combined endpoint (all sensors)
+    skipped_total = 0 # samples skipped for slow clients
 
-    def open(self):
+    def get_compression_options(self):
+        # permessage-deflate compresses every message for every client
+        # separately, so it is enabled only on request (--ws-deflate)
+        return {} if ws_deflate else None
+
+    def select_subprotocol(self, subprotocols):
+        if PROTOCOL_V2 in subprotocols:
+            return PROTOCOL_V2
+        return None
+
+    def open(self, sensor_id=None):
+        self.sensor = None
+        if self.selected_subprotocol == PROTOCOL_V2 or self.get_argument('proto', '1') == '2':
+            self.proto = 2
+        else:
+            self.proto = 1
+        # backpressure: while a message is being written, samples are coalesced
+        # (only the latest sample of each sensor is kept), other messages are queued
+        self.writing = False
+        self.queue = deque()
+        self.latest = OrderedDict()
+        self.skipped = 0
+        if sensor_id is not None:
+            self.sensor = find_sensor(sensor_id)
+            if self.sensor is None:
+                self.close(1008, 'unknown sensor')
+                return
         self.send_initial()
 
+    # metadata (protocol v2) and history of measurements, or history
+    # newer than ?since=<msec> when client reconnects
     def send_initial(self):
-        initial_message = json.dumps({}) # empty json
-        self.write_message(initial_message)
-        DataHandler.clients.add(self)
+        try:
+            since = int(self.get_argument('since'))
+        except:
+            since = None
+        for sensor in ([self.sensor] if self.sensor else sensors.values()):
+            if self.proto == 2 and sensor.meta_message is not None:
+                self.send(sensor.meta_message)
+            if self.proto == 2 and sensor.status_message is not None:
+                self.send(sensor.status_message)
+            if sensor.meritve:
+                self.send(sensor.backfill_message(self.proto, since))
+        if self.sensor is None:
+            DataHandler.clients.add(self)
+        else:
+            self.sensor.clients.add(self)
 
-@gen.coroutine
-def send_update(measurement):
-    DataHandler.meritve.append(measurement)
-    for client in DataHandler.clients.copy():
+    def on_close(self):
+        DataHandler.clients.discard(self)
+        if self.sensor is not None:
+            self.sensor.clients.discard(self)
+
+    # send message (already encoded, shared by all clients), sample is
+    # the name of the sensor if message is a sample which can be skipped
+    def send(self, message, sample=None):
+        if self.writing:
+            if sample is None:
+                # samples coalesced so far are older than this message, so
+                # they are queued before it
+                self.queue.extend(self.latest.values())
+                self.latest.clear()
+                self.queue.append(message)
+            else:
+                if sample in self.latest:
+                    self.skipped += 1
+                    DataHandler.skipped_total += 1
+                self.latest[sample] = message
+            return
+        self.writing = True
+        self.write_message(message).add_done_callback(self.on_written)
+
+    def on_written(self, future):
+        self.writing = False
+        if future.exception() is not None:
+            return # connection is closed
         try:
-            client.write_message(measurement)
+            if self.queue:
+                self.send(self.queue.popleft())
+            elif self.latest:
+                sensor_name, message = self.latest.popitem(last=False)
+                self.send(message, sensor_name)
+        except websocket.WebSocketClosedError:
+            pass
+
+def send_message(clients, message, message_v2, sample=None):
+    closed = []
+    for client in clients:
+        try:
+            if client.proto == 2:
+                if message_v2 is not None:
+                    client.send(message_v2, sample)
+            elif message is not None:
+                client.send(message, sample)
+        except websocket.WebSocketClosedError:
+            closed.append(client)
         except:
             print_exc(sys._getframe().f_code.co_name, 'WebSocket: ')
+            closed.append(client)
+    for client in closed:
+        clients.discard(client)
+
+# message is JSON line from reader, it is sent to clients as it is; without
+# it (in-process readers) JSON is encoded only if there are protocol 1 clients,
+# returns message
+def send_update(sensor, measurement, message=None):
+    t = sensor.append(measurement.get('time'), measurement)
+    if t != measurement.get('time'): # missing, or not later than previous one
+        measurement['time'] = t
+        message = None
+    data = measurement.get('data') or {}
+    keys = list(data)
+    metadata = measurement.get('metadata')
+    if keys != sensor.keys or (metadata is not None and metadata != sensor.metadata):
+        sensor.update_metadata(metadata, keys)
+        send_message(sensor.clients, None, sensor.meta_message)
+        send_message(DataHandler.clients, None, sensor.meta_message)
+    if message is None and any(c.proto == 1 for clients in (sensor.clients, DataHandler.clients) for c in clients):
+        message = json.dumps(measurement)
+    encoded = message.encode('utf-8') if message is not None else None
+    sample = json.dumps([sensor.name, measurement.get('time')] + [data[key] for key in keys]).encode('utf-8')
+    send_message(sensor.clients, encoded, sample, sensor.name)
+    send_message(DataHandler.clients, encoded, sample, sensor.name)
+    return message
+
+def int_argument(handler, name, default=None):
+    value = handler.get_argument(name, None)
+    if value is None or value == '':
+        return default
+    try:
+        return int(float(value))
+    except ValueError:
+        raise web.HTTPError(400, 'invalid value of {}'.format(name))
+
+# Downsampled series of one data key for long time ranges:
+# /api/series?sensor=<sensor>&key=<key>&from=<msec>&to=<msec>&points=<n>&mode=<mode>
+# mode is "minmax" (min, max, mean and count in <points> time buckets, default),
+# "mean" (the same) or "lttb" (<points> samples selected by LTTB algorithm).
+# Recent data is read from memory, older data from database (with --data-log).
+class SeriesHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self):
+        sensor = find_sensor(self.get_argument('sensor', next(iter(sensors), '')))
+        if sensor is None:
+            raise web.HTTPError(404, 'unknown sensor')
+        key = self.get_argument('key')
+        mode = self.get_argument('mode', 'minmax')
+        if mode not in ('minmax', 'mean', 'lttb'):
+            raise web.HTTPError(400, 'unknown mode')
+        points = min(max(int_argument(self, 'points', SERIES_POINTS), 1), SERIES_MAX_POINTS)
+        store = sensor.meritve
+        t_to = int_argument(self, 'to', store.last_time() or timing.now_ms())
+        t_from = int_argument(self, 'from', store.first_time() or t_to)
+        if t_from > t_to:
+            raise web.HTTPError(400, 'from is after to')
+
+        result = {'sensor': sensor.name, 'key': key, 'mode': mode, 'from': t_from, 'to': t_to}
+        if writer is None or (len(store) and t_from >= store.first_time()):
+            result['source'] = 'memory'
+            times, values = store.column(key, t_from, t_to)
+            if times is None:
+                raise web.HTTPError(404, 'unknown key')
+            if mode == 'lttb':
+                result['time'], result['value'] = lttb(times, values, points)
+            else:
+                result.update(aggregate(times, values, t_from, t_to, points))
+        else:
+            result['source'] = 'database'
+            buckets = points*4 if mode == 'lttb' else points
+            width = max(1, -(-(t_to - t_from + 1) // buckets))
+            rows = yield ioloop.run_in_executor(None, db.dbSeries, writer,
+                                                sensor.usbport, key, t_from, t_to, width)
+            if mode == 'lttb':
+                result['time'], result['value'] = lttb([r[0] for r in rows], [r[3] for r in rows], points)
+            else:
+                result['width'] = width
+                result['time'] = [r[0] for r in rows]
+                result['min'] = [r[1] for r in rows]
+                result['max'] = [r[2] for r in rows]
+                result['mean'] = [r[3] for r in rows]
+                result['count'] = [r[4] for r in rows]
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(result))
+
+# Bulk export of saved measurements (with --data-log):
+# /api/export?sensor=<sensor>&from=<msec>&to=<msec>&format=<format>&keys=<key1,key2,...>
+# format is "ndjson" (default), "csv", "parquet" or "arrow" (Arrow IPC stream);
+# rows have time (msec), device_id and one column per data key (all current
+# keys of sensor by default). Rows are read from database with a server-side
+# cursor and written out in chunks, so any time range is exported in constant memory.
+class ExportHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self):
+        if writer is None:
+            raise web.HTTPError(400, 'database is not used (see --data-log)')
+        sensor = find_sensor(self.get_argument('sensor', next(iter(sensors), '')))
+        if sensor is None:
+            raise web.HTTPError(404, 'unknown sensor')
+        name = self.get_argument('format', 'ndjson')
+        if name not in export.FORMATS:
+            raise web.HTTPError(400, 'unknown format')
+        if not export.available(name):
+            raise web.HTTPError(501, 'format {} needs pyarrow'.format(name))
+        t_to = int_argument(self, 'to', timing.now_ms())
+        t_from = int_argument(self, 'from', t_to - EXPORT_RANGE)
+        if t_from > t_to:
+            raise web.HTTPError(400, 'from is after to')
+        keys = [key for key in self.get_argument('keys', '').split(',') if key]
+        if not keys:
+            keys = list(sensor.keys) or (yield ioloop.run_in_executor(None, db.dbKeys, writer,
+                                                                        sensor.usbport, t_from, t_to))
+
+        out = export.FORMATS[name](keys)
+        query = db.DBExport(writer, sensor.usbport, keys, t_from, t_to)
+        try:
             try:
-                DataHandler.clients.remove(client)
-            except: pass
+                yield ioloop.run_in_executor(None, query.open)
+            except db.psycopg2.pool.PoolError:
+                raise web.HTTPError(503, 'no free database connection')
+            self.set_header('Content-Type', out.content_type)
+            self.set_header('Content-Disposition', 'attachment; filename="{}-{}-{}.{}"'.format(
+                sensor.name, t_from, t_to, out.extension))
+            self.write(out.begin())
+            while True:
+                rows = yield ioloop.run_in_executor(None, query.fetch)
+                if not rows: break
+                self.write(out.chunk(rows))
+                yield self.flush() # wait until the client takes it
+            self.write(out.end())
+        except iostream.StreamClosedError:
+            pass
+        finally:
+            yield ioloop.run_in_executor(None, query.close)
+        log.debug('Exported %d rows of %s', query.rows, sensor.name)
+
+# Snapshots for clients which poll: /api/latest (the last measurement of all
+# sensors or of ?sensor=<name or device_id>, only ?key=<key> if given) and
+# /api/status (state of readers). A snapshot is serialized once after it has
+# changed (see Sensor.changed) and served with ETag and Last-Modified, so
+# requests with If-None-Match or If-Modified-Since get 304 while nothing has
+# changed. With ?wait=<seconds> and If-None-Match the response waits until
+# the snapshot changes (long-poll).
+class SnapshotHandler(web.RequestHandler):
+    kind = None # 'latest' or 'status'
+
+    @gen.coroutine
+    def get(self):
+        sensor = None
+        if self.get_argument('sensor', None) is not None:
+            sensor = find_sensor(self.get_argument('sensor'))
+            if sensor is None:
+                raise web.HTTPError(404, 'unknown sensor')
+        key = self.get_argument('key', None) if self.kind == 'latest' else None
+        try:
+            wait = min(max(float(self.get_argument('wait', 0)), 0), SNAPSHOT_MAX_WAIT)
+        except ValueError:
+            raise web.HTTPError(400, 'invalid value of wait')
+        self.snapshot = snapshot(self.kind, sensor, key)
+        self.set_etag_header()
+        if wait and self.check_etag_header():
+            deadline = ioloop.time() + wait
+            updated = sensor.updated if sensor is not None else snapshot_updated
+            while self.check_etag_header():
+                if not (yield updated.wait(deadline)):
+                    break # timeout
+                self.snapshot = snapshot(self.kind, sensor, key)
+                self.set_etag_header()
+        body, etag, modified = self.snapshot
+        if body is None:
+            raise web.HTTPError(404, 'no measurement' if key is None else 'unknown key')
+        self.set_header('Cache-Control', 'no-cache')
+        if modified is not None:
+            self.set_header('Last-Modified', timing.utc_datetime(modified))
+        if self.check_etag_header() or (modified is not None and not_modified_since(self.request, modified)):
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        self.write(body)
+
+    def compute_etag(self):
+        return self.snapshot[1]
+
+class LatestHandler(SnapshotHandler):
+    kind = 'latest'
+
+class StatusHandler(SnapshotHandler):
+    kind = 'status'
+
+# If-Modified-Since of request (without If-None-Match) is not before msec
+def not_modified_since(request, modified):
+    since = request.headers.get('If-Modified-Since')
+    if since is None or 'If-None-Match' in request.headers:
+        return False
+    try:
+        since = email.utils.parsedate_to_datetime(since)
+    except (TypeError, ValueError):
+        return False
+    return since.replace(tzinfo=None) >= timing.utc_datetime(modified - modified % 1000)
+
+# (JSON bytes, ETag, msec of last change) of kind ('latest' or 'status') of
+# sensor (None for all sensors), JSON is None when there is nothing to show
+def snapshot(kind, sensor=None, key=None):
+    cache = snapshot_cache if sensor is None else sensor.snapshot_cache
+    result = cache.get((kind, key))
+    if result is not None:
+        return result
+    if sensor is None:
+        parts = [snapshot(kind, s, key) for s in sensors.values()]
+        parts = [part for part in parts if part[0] is not None]
+        body = b'{"sensors": [' + b', '.join(part[0] for part in parts) + b']}'
+        modified = max((part[2] for part in parts), default=None)
+    else:
+        body = None; modified = None
+        if kind == 'status':
+            body = {'sensor': sensor.name, 'reader': sensor.reader_name, 'source': sensor.usbport,
+                    'device_id': sensor.device_id, 'state': sensor.state, 'since': sensor.state_since,
+                    'restarts': sensor.restarts, 'stalls': sensor.stalls}
+            modified = sensor.state_since
+        elif sensor.latest is not None:
+            t, data = sensor.latest
+            body = {'sensor': sensor.name, 'device_id': sensor.device_id, 'time': t}
+            if key is None:
+                body['data'] = data
+            elif data.get(key) is not None:
+                body['key'] = key; body['value'] = data[key]
+            else:
+                body = None
+            modified = t
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+    etag = '"{}"'.format(hashlib.md5(body).hexdigest()) if body is not None else None
+    result = cache[(kind, key)] = (body, etag, modified)
+    return result
+
+# Batches of measurements from remote reader agents (see agent.py), with
+# --ingest: POST /api/ingest?agent=<id>&reader=<reader>&run=<id of spool>
+# with lines "<seq>\t<port>\t<JSON measurement>" (compressed, see
+# Content-Encoding). They are processed as measurements of sensor
+# "<agent>-<port>", which is created when its first batch arrives. Sequence
+# numbers which were already accepted are skipped, so a batch sent again is
+# not processed twice. Response is
+# {"ack": {<port>: <last accepted seq>}, "accepted": <n>, "duplicates": <n>}.
+class IngestHandler(web.RequestHandler):
+    batches = 0
+    received_bytes = 0 # compressed bytes of batches
+    duplicates = 0
+
+    def post(self):
+        global ingest_dirty
+        if ingest_token is not None and self.request.headers.get('Authorization') != 'Bearer ' + ingest_token:
+            raise web.HTTPError(403, 'invalid token')
+        agent_id = self.get_argument('agent')
+        if not AGENT_RE.match(agent_id):
+            raise web.HTTPError(400, 'invalid agent')
+        run = self.get_argument('run', '')
+        reader_name = reader_for(self.get_argument('reader', 'read-serial'))
+        try:
+            body = agent.decompress(self.request.body, self.request.headers.get('Content-Encoding'))
+        except Exception as e:
+            raise web.HTTPError(400, str(e))
+        records = []
+        for line in body.split(b'\n'):
+            if not line: continue
+            try:
+                seq, port, data = line.split(b'\t', 2)
+                seq = int(seq); port = port.decode('utf-8')
+            except ValueError:
+                raise web.HTTPError(400, 'invalid line')
+            if not AGENT_RE.match(port):
+                raise web.HTTPError(400, 'invalid port')
+            records.append((seq, port, data))
+        IngestHandler.batches += 1
+        IngestHandler.received_bytes += len(self.request.body)
+        ack = {}; accepted = 0; duplicates = 0
+        for seq, port, data in records:
+            sensor = remote_sensor(agent_id, port, reader_name)
+            if sensor.remote_run != run: # spool of agent is new, numbering started again
+                sensor.remote_run = run
+                sensor.remote_seq = 0
+            if seq <= sensor.remote_seq:
+                duplicates += 1
+            else:
+                sensor.remote_seq = seq
+                sensor.set_state('running')
+                process_line(sensor, data)
+                accepted += 1
+            ack[port] = sensor.remote_seq
+        if accepted:
+            ingest_dirty = True
+        IngestHandler.duplicates += duplicates
+        self.write({'ack': ack, 'accepted': accepted, 'duplicates': duplicates})
+
+# sensor of agent's port, created when it first sends data
+def remote_sensor(agent_id, port, reader_name):
+    name = '{}-{}'.format(agent_id, port)
+    sensor = sensors.get(name)
+    if sensor is None:
+        sensor = sensors[name] = Sensor(reader_name, name, remote=(agent_id, port))
+        log.info('Remote sensor %s (%s) of agent %s', name, reader_name, agent_id)
+        if engine is not None:
+            engine.add_sensor(name, timing.now_ms())
+        if bus_server is not None:
+            bus_server.publish('n', name, json.dumps(remote_info(sensor)))
+    return sensor
+
+def remote_info(sensor):
+    return {'agent': sensor.remote[0], 'port': sensor.remote[1], 'reader': sensor.reader_name,
+            'run': sensor.remote_run, 'seq': sensor.remote_seq}
+
+# sequence numbers accepted from agents are kept in file given with --ingest,
+# so that batches sent again after restart of server are not processed twice
+ingest_dirty = False
+
+def load_ingest_state(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return
+    for info in state.values():
+        sensor = remote_sensor(info['agent'], info['port'], info['reader'])
+        sensor.remote_run = info['run']
+        sensor.remote_seq = info['seq']
+        sensor.state = 'offline'
+
+def save_ingest_state():
+    global ingest_dirty
+    if not ingest_dirty: return
+    ingest_dirty = False
+    try:
+        with open(ingest_path + '.tmp', 'w') as f:
+            json.dump(dict((sensor.name, remote_info(sensor)) for sensor in sensors.values()
+                           if sensor.remote is not None), f)
+        os.replace(ingest_path + '.tmp', ingest_path)
+    except:
+        print_exc(sys._getframe().f_code.co_name, ingest_path + ': ')
+
+BROADCAST = metrics.Histogram(metrics.TIME_BUCKETS) # seconds to send one measurement to all clients
+ALERT_EVAL = metrics.Histogram(metrics.TIME_BUCKETS) # seconds to evaluate alert rules of one measurement
+
+# Prometheus metrics of readers, clients, history buffers and database
+class MetricsHandler(web.RequestHandler):
+    def get(self):
+        m = metrics.Exposition()
+        ss = list(sensors.values())
+        def labels(sensor):
+            return {'sensor': sensor.name, 'reader': sensor.reader_name}
+        if role != 'worker': # readers run in ingest process
+            m.counter('reader_lines_total', 'Lines or frames read from reader.',
+                      [(labels(s), s.lines) for s in ss])
+            m.counter('reader_parse_errors_total', 'Lines from reader which are not valid measurements.',
+                      [(labels(s), s.parse_errors + reader_stat(s, 'parse_errors')) for s in ss])
+            for name, help in (('frames', 'Valid frames from dust sensor.'),
+                               ('corrupt_frames', 'Frames from dust sensor with wrong checksum.'),
+                               ('dropped_bytes', 'Bytes from dust sensor which are not part of any frame.')):
+                samples = [(labels(s), reader_stat(s, name)) for s in ss if s.reader_name == 'read-dust']
+                if samples:
+                    m.counter('reader_{}_total'.format(name), help, samples)
+            m.counter('reader_restarts_total', 'Restarts of reader.', [(labels(s), s.restarts) for s in ss])
+            samples = [(labels(s), s.capture.bytes) for s in ss if s.capture is not None]
+            if samples:
+                m.counter('reader_captured_bytes_total', 'Bytes of serial data written to capture.', samples)
+            samples = [(labels(s), s.replay.records) for s in ss if s.replay is not None]
+            if samples:
+                m.counter('reader_replayed_records_total', 'Records of capture fed to reader.', samples)
+            m.counter('reader_stalls_total', 'Readers stopped because they sent no data.',
+                      [(labels(s), s.stalls) for s in ss])
+            m.gauge('reader_state', 'State of reader (1 for the current state).',
+                    [(dict(labels(s), state=state), int(s.state == state)) for s in ss for state in READER_STATES])
+            m.gauge('reader_failures', 'Runs of reader without data since the last one with data.',
+                    [(labels(s), s.failures) for s in ss])
+            now = time.monotonic()
+            m.gauge('reader_last_data_age_seconds', 'Seconds since reader sent any data.',
+                    [(labels(s), round(now - s.last_data, 3)) for s in ss])
+        m.histogram('broadcast_seconds', 'Time to send one measurement to all clients.', [({}, BROADCAST)])
+        if role != 'ingest': # clients are served by workers
+            clients = list(DataHandler.clients)
+            samples = [({'sensor': '*'}, len(DataHandler.clients))]
+            for s in ss:
+                samples.append(({'sensor': s.name}, len(s.clients)))
+                clients += s.clients
+            m.gauge('clients', 'Connected WebSocket clients (sensor "*" for all sensors).', samples)
+            queued = metrics.Histogram(metrics.SIZE_BUCKETS)
+            queued_bytes = metrics.Histogram(metrics.BYTE_BUCKETS)
+            for client in clients:
+                queued.observe(len(client.queue) + len(client.latest))
+                queued_bytes.observe(sum(len(message) for message in client.queue) +
+                                     sum(len(message) for message in client.latest.values()))
+            m.histogram('client_send_queue_messages', 'Messages waiting to be sent, per client.', [({}, queued)])
+            m.histogram('client_send_queue_bytes', 'Bytes waiting to be sent, per client.', [({}, queued_bytes)])
+            m.counter('client_skipped_total', 'Samples skipped for slow clients.', [({}, DataHandler.skipped_total)])
+        m.gauge('history_samples', 'Measurements in history buffer.', [(labels(s), len(s.meritve)) for s in ss])
+        m.gauge('history_bytes', 'Memory of history buffer.', [(labels(s), s.meritve.nbytes()) for s in ss])
+        if engine is not None:
+            m.counter('alerts_fired_total', 'Alerts fired by rule.',
+                      [({'rule': rule.name}, engine.fired.get(rule.name, 0)) for rule in engine.rules])
+            m.gauge('alerts_active', 'Alerts which are firing.', [({}, len(engine.active()))])
+            m.histogram('alert_eval_seconds', 'Time to evaluate alert rules of one measurement.',
+                        [({}, ALERT_EVAL)])
+        rss = metrics.process_rss()
+        if rss is not None:
+            m.gauge('process_resident_memory_bytes', 'Resident memory of server.', [({}, rss)])
+        if bus_server is not None:
+            m.gauge('bus_subscribers', 'Web workers subscribed to bus.', [({}, len(bus_server.subscribers))])
+            m.counter('bus_messages_total', 'Messages published on bus.', [({}, bus_server.published)])
+            m.counter('bus_dropped_subscribers_total', 'Web workers dropped from bus because they were too slow.',
+                      [({}, bus_server.dropped)])
+        if ingest_path is not None and role != 'worker':
+            m.counter('ingest_batches_total', 'Batches received from agents.', [({}, IngestHandler.batches)])
+            m.counter('ingest_bytes_total', 'Compressed bytes of batches received from agents.',
+                      [({}, IngestHandler.received_bytes)])
+            m.counter('ingest_duplicates_total', 'Measurements from agents which were already received.',
+                      [({}, IngestHandler.duplicates)])
+        if writer is not None and role != 'worker':
+            stats = writer.stats()
+            if spool is None: # otherwise rows wait in spool (spool_pending_bytes)
+                m.gauge('db_queue_rows', 'Rows waiting to be written to database.', [({}, stats['queue'])])
+            for name, help in (('written', 'Rows written to database.'),
+                               ('dropped', 'Rows dropped because database buffer was full.'),
+                               ('failed', 'Rows which database rejected.')):
+                m.counter('db_{}_rows_total'.format(name), help, [({}, stats[name])])
+            m.histogram('db_batch_rows', 'Rows written to database at once.', [({}, writer.batch_sizes)])
+            m.histogram('db_flush_seconds', 'Time to write one batch to database.', [({}, writer.flush_seconds)])
+            if writer.rollups is not None:
+                m.counter('db_rollup_values_total', 'Values added to rollups.', [({}, writer.rollups.values)])
+                m.gauge('db_rollup_backlog', 'Rollup flushes waiting for database.', [({}, len(rollup_backlog))])
+                m.counter('db_rollup_dropped_total', 'Rollup flushes dropped because backlog was full.',
+                          [({}, rollup_dropped)])
+            m.counter('db_expired_rows_total', 'Raw rows deleted by retention.', [({}, expired_rows)])
+        if spool is not None:
+            stats = spool.stats()
+            m.gauge('spool_pending_bytes', 'Bytes in spool not yet written to database.', [({}, stats['pending'])])
+            m.gauge('spool_bytes', 'Size of spool.', [({}, stats['size'])])
+            m.counter('spool_appended_total', 'Records appended to spool.', [({}, stats['appended'])])
+            m.counter('spool_lost_total', 'Records removed from full spool before they were written.',
+                      [({}, stats['lost'])])
+            m.counter('spool_drained_total', 'Records written from spool to database.', [({}, drainer.drained)])
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(m.text())
+
+# counter of sensor's in-process readers (current one and restarted ones)
+def reader_stat(sensor, name):
+    value = sensor.reader_totals.get(name, 0)
+    if sensor.reader is not None:
+        value += sensor.reader.stats().get(name, 0)
+    return value
+
+# Alert events (see alerts.py) of rules given with --alerts: events of alerts
+# which are firing are sent on connect, then every new event
+class AlertsHandler(websocket.WebSocketHandler):
+    clients = set()
+
+    def open(self):
+        for event in engine.active() if engine is not None else list(relayed_alerts.values()):
+            self.write_message(json.dumps(event))
+        AlertsHandler.clients.add(self)
+
+    def on_close(self):
+        AlertsHandler.clients.discard(self)
+
+def on_alert(event):
+    sensor = sensors[event['sensor']]
+    log.warning('Alert %s %s on sensor %s: %s', event['rule'], event['state'], sensor.name,
+                event['message'] or event['key'] or '')
+    message = json.dumps(event)
+    send_alert(message)
+    if bus_server is not None:
+        bus_server.publish('a', sensor.name, message)
+    if writer is not None:
+        ioloop.run_in_executor(None, save_alert, sensor.usbport, event)
+
+def send_alert(message):
+    for client in list(AlertsHandler.clients):
+        try:
+            client.write_message(message)
+        except websocket.WebSocketClosedError:
+            AlertsHandler.clients.discard(client)
+
+def save_alert(source, event):
+    try:
+        db.dbInsertAlert(writer, source, event)
+    except:
+        print_exc(sys._getframe().f_code.co_name)
+
+# row of measurement taken at time t (msec) is dated t, so (source, date)
+# identifies the measurement and a measurement saved twice is skipped
+def update_db(source, data, t):
+    try:
+        log.debug('Inserting data into db')
+        if spool is not None:
+            spool.append(db.sqlDate(db.msDate(t)), source, data)
+        else:
+            writer.insert(source, data, db.msDate(t))
+    except:
+        print_exc(sys._getframe().f_code.co_name)
+
+# rollups (see database.Rollups) are written every ROLLUP_FLUSH seconds, in
+# order; when database is not available they wait in backlog, and when it is
+# full the oldest flush is dropped (its buckets can be filled again from raw
+# rows with rollup-db.py)
+rollup_backlog = deque()
+rollup_flushing = False
+rollup_dropped = 0 # flushes dropped from full backlog
+rollup_lock = Lock() # held while flushes are written, so that shutdown waits for it
+
+# blocking: writes flushes of backlog in order, each is removed when written
+def write_rollups():
+    with rollup_lock:
+        while rollup_backlog:
+            db.dbUpsertRollups(writer, rollup_backlog[0])
+            rollup_backlog.popleft()
 
 @gen.coroutine
-def update_db(sensor, data):
+def flush_rollups():
+    global rollup_flushing, rollup_dropped
+    if len(rollup_backlog) >= ROLLUP_BACKLOG:
+        i = 1 if rollup_flushing else 0 # first one is being written
+        tables = rollup_backlog[i]
+        del rollup_backlog[i]
+        rollup_dropped += 1
+        log.warning('Rollup backlog is full, dropped %d rollup rows (%d flushes dropped so far)',
+                    sum(len(rows) for rows in tables.values()), rollup_dropped)
+    rollup_backlog.append(writer.rollups.take())
+    if rollup_flushing: return
+    rollup_flushing = True
     try:
-        print('Inserting data into db', flush=True)
-        db.dbInsert(sensor, data)
-    except: pass
+        yield ioloop.run_in_executor(None, write_rollups)
+    except:
+        print_exc(sys._getframe().f_code.co_name)
+    finally:
+        rollup_flushing = False
+
+# raw rows older than --db-retention days are deleted, rollups are kept
+expired_rows = 0
+expiring = False
+
+@gen.coroutine
+def expire_rows():
+    global expired_rows, expiring
+    if expiring: return
+    expiring = True
+    try:
+        deleted = yield ioloop.run_in_executor(None, db.dbExpire, writer,
+                                               timing.now_ms() - db_retention*86400000)
+        expired_rows += deleted
+        if deleted:
+            log.info('Deleted %d raw rows older than %d days', deleted, db_retention)
+    except:
+        print_exc(sys._getframe().f_code.co_name)
+    finally:
+        expiring = False
+
+def print_db_stats():
+    sys.stderr.write('DB writer: {}\n'.format(json.dumps(writer.stats())))
+    if spool is not None:
+        sys.stderr.write('DB spool: {}\n'.format(json.dumps(spool.stats())))
+    sys.stderr.flush()
+
+def process_line(sensor, line):
+    line = line.strip()
+    if not line: return
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', 'replace')
+
+    sensor.lines += 1
+    sensor.last_data = time.monotonic()
+    log.debug('Got JSON: %r', line)
+    try:
+        measurement = json.loads(line)
+        if not isinstance(measurement, dict):
+            raise ValueError('JSON object expected')
+    except:
+        sensor.parse_errors += 1
+        print_exc(sys._getframe().f_code.co_name, 'invalid JSON: ')
+        return
+    process_measurement(sensor, measurement, line)
+
+def update_device_id(sensor, measurement):
+    if sensor.device_id is None:
+        try:
+            sensor.device_id = str(measurement['metadata']['device_id'])
+        except: pass
 
-# async thread for reading subprocess' stdout
-def enque_output(out, queue):
+# measurement from in-process reader (line is None) or from reader's stdout
+def process_measurement(sensor, measurement, line=None):
+    update_device_id(sensor, measurement)
+    t = time.perf_counter()
+    line = send_update(sensor, measurement, line)
+    BROADCAST.observe(time.perf_counter() - t)
+    if bus_server is not None:
+        # published once, web workers send it to their clients
+        if line is None: line = json.dumps(measurement)
+        bus_server.publish('m', sensor.name, line)
+    if engine is not None:
+        t = time.perf_counter()
+        engine.sample(sensor.name, sensor.meritve.last_time(), measurement.get('data') or {},
+                      timing.now_ms())
+        ALERT_EVAL.observe(time.perf_counter() - t)
+    if writer is not None and writer.rollups is not None:
+        writer.rollups.add(sensor.usbport, sensor.meritve.last_time(), measurement.get('data') or {})
+    if db_use and db_save and (sensor.tick % db_save) == 0:
+        update_db(sensor.usbport, line if line is not None else json.dumps(measurement),
+                  sensor.meritve.last_time())
+    sensor.tick += 1
+
+# line which reader wrote to its stderr (messages and tracebacks), goes to
+# log, never parsed as a measurement
+def process_error_line(sensor, line):
+    line = line.rstrip()
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', 'replace')
+    if line:
+        log.warning('Reader of sensor %s: %s', sensor.name, line)
+
+# thread for reading subprocess' stdout or stderr (Windows only, pipes can't
+# be polled there)
+def enque_output(out, loop, sensor, handle=process_line):
     try:
-        for line in iter(out.readline, ''):
-            queue.put(line)
+        for line in iter(out.readline, b''):
+            loop.add_callback(handle, sensor, line)
         out.close()
     except: pass
 
 @gen.coroutine
-def reader(ioloop):
+def read_stream(stream, sensor, handle=process_line):
+    # drain every complete line from the reader's stdout (or stderr) as soon
+    # as it arrives
+    buf = b''
     while True:
-        try:
-            cmd = [sys.executable, reader_py, sensor_name]
-            if simulate: cmd.append('simulate')
-            # this subprocess creation with pipes works on Unix and Windows!
-            proc = subprocess.Popen(cmd, bufsize=1, universal_newlines=True,
-                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            q = queues.Queue(ctx=get_context())
-            t = Thread(target=enque_output, args=(proc.stdout, q))
+        chunk = yield stream.read_bytes(READ_CHUNK, partial=True)
+        lines = (buf + chunk).split(b'\n')
+        buf = lines.pop() # incomplete line, if any
+        for line in lines:
+            handle(sensor, line)
+
+@gen.coroutine
+def read_errors(stream, sensor):
+    try:
+        yield read_stream(stream, sensor, process_error_line)
+    except iostream.StreamClosedError:
+        pass
+
+# one run of reader as separate process, returns when it stops
+@gen.coroutine
+def reader(loop, sensor):
+    proc = None
+    try:
+        cmd = [sys.executable, sensor.reader_py, sensor.name]
+        if sensor.simulate: cmd.append('simulate')
+        for name, value in sensor.options.items():
+            cmd += ['--' + name, str(value)]
+        if capture_dir is not None and not sensor.simulate:
+            cmd += ['--capture', capture_path(sensor)]
+        if sys.platform.startswith('win'):
+            proc = subprocess.Popen(cmd, bufsize=0,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            sensor.stop_reader = proc.kill
+            sensor.set_state('running')
+            t = Thread(target=enque_output, args=(proc.stdout, loop, sensor))
+            t.daemon = True; t.start()
+            t = Thread(target=enque_output, args=(proc.stderr, loop, sensor, process_error_line))
             t.daemon = True; t.start()
+            yield loop.run_in_executor(None, proc.wait)
+        else:
+            # reader's stdout is hooked straight into the IOLoop
+            proc = process.Subprocess(cmd,
+                       stdout=process.Subprocess.STREAM, stderr=process.Subprocess.STREAM)
+            sensor.stop_reader = proc.proc.kill
+            sensor.set_state('running')
+            loop.add_callback(read_errors, proc.stderr, sensor)
+            yield read_stream(proc.stdout, sensor)
+    except iostream.StreamClosedError:
+        pass
+    except:
+        print_exc(sys._getframe().f_code.co_name)
+    finally:
+        sensor.stop_reader = None
+        if proc is not None:
+            p = getattr(proc, 'proc', proc)
+            try:
+                if p.poll() is None: p.kill()
+                p.wait()
+            except: pass
 
-            tick = 1
-            while True:
+# one run of in-process reader: serial port is read when IOLoop reports it
+# is readable, returns when reader stops
+@gen.coroutine
+def run_reader(loop, sensor):
+    poller = None
+    fd = None
+    try:
+        rd = sensor.reader = readers.READERS[sensor.reader_name](
+            sensor.usbport, sensor.simulate, **sensor.options)
+        closed = Future()
+        def stop():
+            if not closed.done(): closed.set_result(None)
+        sensor.stop_reader = stop
+        if sensor.simulate:
+            sys.stderr.write('Reading {} data from simulated {}...\n'.format(rd.label, sensor.usbport))
+            sys.stderr.flush()
+            sensor.set_state('running')
+            schedule = timing.Schedule(rd.rate)
+            while not closed.done():
+                for t in schedule.due():
+                    sensor.lines += 1
+                    sensor.last_data = time.monotonic()
+                    process_measurement(sensor, rd.simulated(t))
+                yield gen.sleep(schedule.delay())
+            return
+        if sensor.replay is not None:
+            yield replay(sensor, rd, closed)
+            return
+        rd.open(blocking=False)
+        rd.serial.write(rd.start_commands())
+        if capture_dir is not None and sensor.capture is None:
+            sensor.capture = capture.Capture(capture_path(sensor), sensor.reader_name,
+                                             sensor.usbport, sensor.options)
+        if rd.poll_interval:
+            poller = PeriodicCallback(lambda: rd.serial.write(rd.poll()), rd.poll_interval*1000)
+            poller.start()
+        sys.stderr.write('Reading {} data from {}...\n'.format(rd.label, sensor.usbport))
+        sys.stderr.flush()
+        def on_readable(fd, events):
+            try:
+                data = os.read(fd, READ_CHUNK)
+                received = time.monotonic_ns()
+                if not data:
+                    raise EOFError('device is closed')
+            except BlockingIOError:
+                return
+            except:
+                print_exc('run_reader', sensor.usbport + ': ')
+                loop.remove_handler(fd)
+                stop()
+                return
+            sensor.last_data = received/1e9
+            if sensor.capture is not None:
+                sensor.capture.append(data, received)
+            for measurement in rd.feed(data, received):
+                sensor.lines += 1
                 try:
-                    line = q.get_nowait().strip() # get next line from subprocess
+                    process_measurement(sensor, measurement)
                 except:
-                    yield gen.sleep(1) # wait 1 second
-                    continue # no output yet
+                    print_exc('run_reader')
+        fd = rd.fileno()
+        loop.add_handler(fd, on_readable, loop.READ)
+        sensor.set_state('running')
+        yield closed
+    except:
+        print_exc(sys._getframe().f_code.co_name)
+    finally:
+        sensor.stop_reader = None
+        if fd is not None:
+            loop.remove_handler(fd)
+        if poller is not None:
+            poller.stop()
+        if sensor.reader is not None:
+            sensor.reader.close()
+            for name, value in sensor.reader.stats().items():
+                sensor.reader_totals[name] = sensor.reader_totals.get(name, 0) + value
+            sensor.reader = None
 
-                print('Got JSON: %r' % line, flush=True)
+# Replay of capture (--replay) through in-process reader rd, continues where
+# the previous run stopped; returns when stopped, or waits in state "done"
+# at the end of capture
+@gen.coroutine
+def replay(sensor, rd, closed):
+    rp = sensor.replay
+    sys.stderr.write('Replaying {} data of {} from {}...\n'.format(rd.label, sensor.usbport, rp.path))
+    sys.stderr.flush()
+    sensor.set_state('running')
+    while not closed.done() and not rp.done:
+        for data, received in rp.due():
+            sensor.last_data = time.monotonic()
+            for measurement in rd.feed(data, received):
+                sensor.lines += 1
                 try:
-                    measurement = json.loads(line)
-                    #print(measurement, flush=True)
-                    ioloop.add_callback(send_update, measurement)
-                    if db_use and (tick % db_save) == 0:
-                        ioloop.add_callback(update_db, USBPORT, line)
-                    tick += 1
+                    process_measurement(sensor, measurement)
                 except:
-                    print_exc(sys._getframe().f_code.co_name, 'invalid JSON: ')
-                    yield gen.sleep(1) # wait 1 second
-                    continue
-        except:
-            print_exc(sys._getframe().f_code.co_name)
-            yield gen.sleep(5) # wait 5 seconds
+                    print_exc('replay')
+        yield gen.sleep(rp.delay())
+    if rp.done:
+        sys.stderr.write('Replayed {} records of {}\n'.format(rp.records, rp.path))
+        sys.stderr.flush()
+        sensor.set_state('done')
+        yield closed
+
+def capture_path(sensor):
+    return os.path.join(capture_dir, os.path.basename(sensor.usbport) + '.cap')
+
+# Runs reader of sensor and restarts it when it stops, after a delay which
+# doubles with every run without data (up to RESTART_MAX_DELAY). Reader is
+# restarted at once when its device appears (see hotplug.py), and is stopped
+# by check_readers() when it stalls.
+@gen.coroutine
+def supervise(loop, sensor, run):
+    while True:
+        sensor.set_state('starting')
+        started = sensor.last_data = time.monotonic()
+        yield run(loop, sensor)
+        sensor.restarts += 1
+        if sensor.last_data > started:
+            sensor.failures = 0
+        else:
+            sensor.failures += 1
+        delay = min(RESTART_MAX_DELAY, RESTART_DELAY*2**sensor.failures)
+        sys.stderr.write('Reader {} for {} stopped, restarting in {:g} seconds\n'.format(
+            sensor.reader_name, sensor.usbport, delay))
+        sys.stderr.flush()
+        sensor.set_state('backoff')
+        sensor.wakeup = Future()
+        sensor.present = os.path.exists(sensor.usbport)
+        try:
+            yield gen.with_timeout(datetime.timedelta(seconds=delay), sensor.wakeup)
+            sys.stderr.write('Device {} appeared, restarting reader\n'.format(sensor.usbport))
+            sys.stderr.flush()
+        except gen.TimeoutError:
+            pass
+        finally:
+            sensor.wakeup = None
+
+# stop readers which didn't send any data for STALL_FACTOR expected intervals
+def check_readers():
+    now = time.monotonic()
+    for sensor in sensors.values():
+        if sensor.remote is not None:
+            if sensor.state == 'running' and now - sensor.last_data > REMOTE_TIMEOUT:
+                sensor.set_state('offline')
+            continue
+        if sensor.state == 'running' and sensor.replay is None and now - sensor.last_data > sensor.stall_timeout():
+            sensor.stalls += 1
+            sensor.set_state('stalled')
+            sys.stderr.write('Reader {} for {} stalled (no data for {:.1f} seconds), restarting\n'.format(
+                sensor.reader_name, sensor.usbport, now - sensor.last_data))
+            sys.stderr.flush()
+            if sensor.stop_reader is not None:
+                sensor.stop_reader()
+
+def device_added(path):
+    for sensor in sensors.values():
+        if sensor.usbport == path and sensor.wakeup is not None and not sensor.wakeup.done():
+            sensor.wakeup.set_result(None)
+
+def on_hotplug(fd, events):
+    for path in watcher.read():
+        device_added(path)
+
+# without inotify: devices of waiting readers which appeared since they stopped
+def poll_devices():
+    for sensor in sensors.values():
+        if sensor.wakeup is not None and not sensor.simulate:
+            present = os.path.exists(sensor.usbport)
+            if present and not sensor.present:
+                device_added(sensor.usbport)
+            sensor.present = present
+
+# Web workers (--workers): ingest process runs readers and database writer and
+# publishes measurements on local bus (see bus.py), every worker keeps its own
+# copy of sensors' history and sends measurements to its WebSocket clients.
+relayed_alerts = OrderedDict() # worker: (rule, sensor) -> event of alert which is firing
+
+# ingest: messages for a new worker
+# messages for new subscriber of bus: state of sensors is taken at once
+# (history is copied), history is encoded later in chunks of BUS_CHUNK
+# measurements while BusServer writes them
+def bus_snapshot():
+    parts = []
+    for sensor in sensors.values():
+        if sensor.remote is not None:
+            parts.append(bus.encode('n', sensor.name, json.dumps(remote_info(sensor))))
+        times, columns = sensor.meritve.slice()
+        parts.append((sensor.name, times, columns, {'metadata': sensor.metadata, 'keys': sensor.keys,
+                                                    'device_id': sensor.device_id}))
+        if sensor.status_message is not None:
+            parts.append(bus.encode('s', sensor.name, sensor.status_message))
+    for event in engine.active() if engine is not None else []:
+        parts.append(bus.encode('a', event['sensor'], json.dumps(event)))
+    return (message for part in parts for message in
+            ([part] if isinstance(part, bytes) else history_messages(*part)))
+
+def history_messages(name, times, columns, info):
+    for i in range(0, max(len(times), 1), BUS_CHUNK):
+        history = {'first': i == 0, 'time': times[i:i + BUS_CHUNK].tolist(),
+                   'data': dict((key, json_values(column[i:i + BUS_CHUNK])) for key, column in columns.items())}
+        history.update(info)
+        yield bus.encode('h', name, json.dumps(history))
+
+# worker: message from ingest process
+def on_bus_message(kind, name, payload):
+    sensor = sensors.get(name)
+    if kind == 'n' and sensor is None:
+        info = json.loads(payload.decode('utf-8'))
+        sensors[name] = Sensor(info['reader'], name, remote=(info['agent'], info['port']))
+        return
+    if sensor is None: return
+    if kind == 'm':
+        line = payload.decode('utf-8')
+        measurement = json.loads(line)
+        update_device_id(sensor, measurement)
+        t = time.perf_counter()
+        send_update(sensor, measurement, line)
+        BROADCAST.observe(time.perf_counter() - t)
+    elif kind == 's':
+        sensor.status_message = payload
+        status = json.loads(payload.decode('utf-8'))
+        sensor.state = status['state']
+        sensor.state_since = status['since']
+        sensor.restarts = status['restarts']
+        sensor.stalls = status['stalls']
+        sensor.changed()
+        send_message(sensor.clients, None, payload)
+        send_message(DataHandler.clients, None, payload)
+    elif kind == 'a':
+        event = json.loads(payload.decode('utf-8'))
+        if event['state'] == 'firing':
+            relayed_alerts[(event['rule'], name)] = event
+        else:
+            relayed_alerts.pop((event['rule'], name), None)
+        send_alert(payload.decode('utf-8'))
+    elif kind == 'h':
+        sensor.restore(json.loads(payload.decode('utf-8')))
+
+def start_worker(i):
+    cmd = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--worker', str(i), '--bus', bus_path]
+    return subprocess.Popen(cmd)
+
+# ingest: restart workers which stopped
+def check_workers():
+    for i, proc in enumerate(worker_procs):
+        if proc.poll() is not None:
+            sys.stderr.write('Web worker {} stopped with code {}, restarting\n'.format(i, proc.returncode))
+            sys.stderr.flush()
+            worker_procs[i] = start_worker(i)
+
+def reader_for(arg):
+    if re.match(r'read-dust', arg): return 'read-dust'
+    if re.match(r'read-raw-serial', arg): return 'read-raw-serial'
+    return 'read-serial' # default
+
+def usage():
+    sys.stderr.write('This application must be called with parameters specifying reader and port number.\n')
+    sys.stderr.write('For example:\n')
+    sys.stderr.write('$ python bluesensor-server.py read-raw-serial 0\n')
+    sys.stderr.write('  for reading data from BlueSensor connected to ttyUSB0\n')
+    sys.stderr.write('$ python bluesensor-server.py read-dust 1\n')
+    sys.stderr.write('  for reading data from dust sensor connected to ttyUSB1\n')
+    sys.stderr.write('$ python bluesensor-server.py --port 8080 read-serial 0 read-serial 1 read-dust 2\n')
+    sys.stderr.write('  for reading data from three sensors in one server on TCP port 8080\n')
+    sys.stderr.write('Add "simulate" after a port number to simulate that sensor.\n')
+    sys.stderr.write('Options:\n')
+    sys.stderr.write('  --port <n>          TCP port of web server\n')
+    sys.stderr.write('  --subprocess        run readers as separate processes\n')
+    sys.stderr.write('  --ws-deflate        compress WebSocket messages (permessage-deflate)\n')
+    sys.stderr.write('  --workers <n>       serve clients from <n> web worker processes\n')
+    sys.stderr.write('  --bus <path>        Unix socket of workers\' bus (default in temporary directory)\n')
+    sys.stderr.write('  --ingest-port <n>   TCP port of /metrics (and /api/ingest) of readers and database with --workers\n')
+    sys.stderr.write('  --ingest <file>     accept measurements of remote agents on /api/ingest, state is kept in <file>\n')
+    sys.stderr.write('  --ingest-token <t>  token which agents must send (--token of agent)\n')
+    sys.stderr.write('  --history <n>       measurements kept in memory per sensor\n')
+    sys.stderr.write('  --backfill <n>      measurements sent to new clients\n')
+    sys.stderr.write('  --backfill-age <s>  max age of measurements sent to new clients in seconds\n')
+    sys.stderr.write('  --tz <zone>         time zone of dates in web application (default {})\n'.format(timing.DISPLAY_TZ))
+    sys.stderr.write('  --log-level <l>     "debug" (every measurement), "info", "warning" or "error"\n')
+    sys.stderr.write('  --alerts <file>     JSON file with alert rules (see alerts.py)\n')
+    sys.stderr.write('  --rate <n>          measurements per second of simulated or polled sensors\n')
+    sys.stderr.write('  --dust-mode <m>     "active" (sensor reports every second) or "query" (server polls it)\n')
+    sys.stderr.write('  --dust-period <n>   working period of dust sensor in minutes (0 for continuous)\n')
+    sys.stderr.write('  --capture <dir>     record data of serial ports into <dir>/<device>.cap\n')
+    sys.stderr.write('  --replay <dir>      read data of sensors from <dir>/<device>.cap instead of serial ports\n')
+    sys.stderr.write('  --replay-speed <n>  replay <n> times faster than captured, "max" for as fast as possible\n')
+    sys.stderr.write('  --data-log <n>      save every <n>-th measurement into database (0 for rollups only)\n')
+    sys.stderr.write('  --db-rollup <l>     rollup levels, for example "1m,1h,1d" (default) or "none"\n')
+    sys.stderr.write('  --db-retention <d>  delete saved measurements older than <d> days (rollups are kept)\n')
+    sys.stderr.write('  --db-batch <n>      max rows written to database at once\n')
+    sys.stderr.write('  --db-buffer <n>     max rows waiting to be written to database (with --spool none)\n')
+    sys.stderr.write('  --db-pool <n>       number of database connections\n')
+    sys.stderr.write('  --db-overflow <m>   "drop" or "block" when database buffer is full (with --spool none)\n')
+    sys.stderr.write('  --db-schema <n>     database layout: 1 (JSON in table data) or 2 (typed, partitioned)\n')
+    sys.stderr.write('  --spool <dir>       local spool directory for database ("none" to disable)\n')
+    sys.stderr.write('  --spool-fsync <m>   "always", "interval" or "never"\n')
+    sys.stderr.write('  --spool-size <n>    max size of local spool in MB\n')
+    sys.stderr.flush()
 
 # Reopen stdout and stderr with buffer size 0 (unbuffered) - only in python 2.7
 #sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 #sys.stderr = os.fdopen(sys.stderr.fileno(), 'w', 0)
 
-db_use = False; db_save = DB_SAVE
+OPTIONS = ('port', 'log-level', 'tz', 'alerts', 'workers', 'worker', 'bus', 'ingest-port', 'ingest', 'ingest-token', 'history', 'backfill', 'backfill-age', 'rate', 'dust-mode', 'dust-period',
+           'capture', 'replay', 'replay-speed',
+           'data-log', 'db-rollup', 'db-retention', 'db-batch', 'db-buffer', 'db-pool', 'db-overflow', 'db-schema',
+           'spool', 'spool-fsync', 'spool-size')
+FLAGS = ('ws-deflate', 'subprocess')
+
+def int_option(name, default, minimum=1):
+    try:
+        value = int(opts[name])
+        if value < minimum:
+            value = default
+    except KeyError:
+        value = default
+    except ValueError:
+        sys.stderr.write('Error: invalid value \'{}\' for --{}\n'.format(opts[name], name))
+        sys.stderr.flush()
+        value = default
+    return value
 
-argv = []; vf = False
+opts = {}
+argv = []; opt = None
 for arg in sys.argv:
-    if re.match(r'^-', arg) or vf:
-        if re.match(r'--data-log', arg):
-            db_use = True
-            vf = True
-        elif vf:
-            try:
-                db_save = int(arg)
-                if db_save <= 0:
-                    db_save = DB_SAVE
-            except ValueError:
-                db_save = DB_SAVE
-            vf = False
+    if opt is not None:
+        opts[opt] = arg
+        opt = None
+    elif re.match(r'^-', arg):
+        if arg.lstrip('-') in OPTIONS:
+            opt = arg.lstrip('-')
+        elif arg.lstrip('-') in FLAGS:
+            opts[arg.lstrip('-')] = True
         else:
             sys.stderr.write('Error: unknown argument \'{}\'\n'.format(arg))
             sys.stderr.flush()
-            vf = False
     else:
         argv.append(arg)
 
-if len(argv) == 1:
-    sys.stderr.write('This application must be called with parameters specifying reader and port number.\n')
-    sys.stderr.write('For example:\n')
-    sys.stderr.write('$ python bluesensor-server.py read-raw-serial 0\n')
-    sys.stderr.write('  for reading data from BlueSensor connected to ttyUSB0\n')
-    sys.stderr.write('$ python bluesensor-server.py read-dust 1\n')
-    sys.stderr.write('  for reading data from dust sensor connected to ttyUSB1\n')
+db_use = 'data-log' in opts
+db_save = int_option('data-log', DB_SAVE, 0)
+db_retention = int_option('db-retention', 0, 0) # days, 0 for no limit
+rollup_levels = db.ROLLUP_LEVELS
+if 'db-rollup' in opts:
+    names = [] if opts['db-rollup'] == 'none' else opts['db-rollup'].split(',')
+    rollup_levels = tuple(level for level in db.ROLLUP_LEVELS if level[0] in names)
+    if len(rollup_levels) != len(names):
+        sys.stderr.write('Error: invalid value \'{}\' for --db-rollup\n'.format(opts['db-rollup']))
+        sys.stderr.flush()
+        sys.exit(1)
+port_id = int_option('port', None)
+ws_deflate = 'ws-deflate' in opts
+log_level = opts.get('log-level', LOG_LEVEL).upper()
+if log_level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR'):
+    sys.stderr.write('Error: invalid value \'{}\' for --log-level\n'.format(opts['log-level']))
     sys.stderr.flush()
     sys.exit(1)
-
-sensor_name = str(argv[1])
-if re.match(r'read-dust', sensor_name):
-    reader_py = os.path.join(os.path.dirname(__file__), 'read-dust.py')
-elif re.match(r'read-raw-serial', sensor_name):
-    reader_py = os.path.join(os.path.dirname(__file__), 'read-raw-serial.py')
-#elif re.match(r'read-serial', sensor_name):
-else: # default
-    reader_py = os.path.join(os.path.dirname(__file__), 'read-serial.py')
-
-if not os.path.isfile(reader_py):
-    sys.stderr.write('Error: file "{}" doesn\'t exist\n'.format(reader_py))
+logging.basicConfig(level=log_level, format='%(message)s')
+if log_level != 'DEBUG': # a line per HTTP request only with debug
+    logging.getLogger('tornado.access').setLevel(logging.WARNING)
+display_tz = opts.get('tz', timing.DISPLAY_TZ)
+if not re.match(r'^[A-Za-z0-9_+\-/]+$', display_tz):
+    sys.stderr.write('Error: invalid time zone \'{}\'\n'.format(display_tz))
     sys.stderr.flush()
-    sys.exit(2)
+    sys.exit(1)
+# serial ports can't be watched by IOLoop on Windows
+use_subprocess = 'subprocess' in opts or sys.platform.startswith('win')
+history_size = int_option('history', HISTORY)
+backfill_size = int_option('backfill', BACKFILL)
+backfill_age = int_option('backfill-age', 0, 0) # seconds, 0 for no limit
+ingest_path = opts.get('ingest') # central server of remote agents, may have no local sensors
+ingest_token = opts.get('ingest-token')
+if len(argv) == 1 and ingest_path is None:
+    usage()
+    sys.exit(1)
+
+DEVNAME = readers.DEVNAME # '/dev/ttyUSB' on linux, 'COM' on Windows
+
+# list of <reader> <port> [simulate] groups
+reader_name = None
+for arg in argv[1:]:
+    if re.match(r'read-', arg):
+        if reader_name is not None:
+            sys.stderr.write('Error: missing USB port number for {}\n'.format(reader_name))
+            sys.stderr.flush()
+            sys.exit(3)
+        reader_name = reader_for(arg)
+        reader_py = os.path.join(os.path.dirname(__file__), READERS[reader_name])
+        if not os.path.isfile(reader_py):
+            sys.stderr.write('Error: file "{}" doesn\'t exist\n'.format(reader_py))
+            sys.stderr.flush()
+            sys.exit(2)
+    elif reader_name is not None:
+        if arg in sensors:
+            sys.stderr.write('Error: USB port {} is used more than once\n'.format(arg))
+            sys.stderr.flush()
+            sys.exit(3)
+        sensors[arg] = Sensor(reader_name, arg)
+        reader_name = None
+    elif len(sensors) > 0:
+        list(sensors.values())[-1].simulate = True
+    else:
+        usage()
+        sys.exit(1)
 
-if len(argv) < 3:
+if reader_name is not None or (len(sensors) == 0 and ingest_path is None):
     sys.stderr.write('Error: missing USB port number (for example from 0 to 3)\n')
     sys.stderr.flush()
     sys.exit(3)
-else:
-    sensor_name = str(argv[2])
-    port_id = int('808' + sensor_name) # set port number according to sensor number
 
-if sys.platform.startswith('win'):
-    DEVNAME = 'COM'
-elif sys.platform.startswith('darwin'):
-    DEVNAME = '/dev/tty.'
-else: # linux
-    DEVNAME = '/dev/ttyUSB'
-USBPORT = DEVNAME + sensor_name # can be 'usbserialxxx' on Mac
+if opts.get('dust-mode') not in (None,) + readers.SDS_MODES:
+    sys.stderr.write('Error: invalid value \'{}\' for --dust-mode\n'.format(opts['dust-mode']))
+    sys.stderr.flush()
+    sys.exit(1)
+if opts.get('db-overflow') not in (None, 'drop', 'block'):
+    sys.stderr.write('Error: invalid value \'{}\' for --db-overflow\n'.format(opts['db-overflow']))
+    usage()
+    sys.exit(1)
+rate = None
+if 'rate' in opts:
+    try:
+        rate = float(opts['rate'])
+        if not rate > 0: raise ValueError()
+    except ValueError:
+        sys.stderr.write('Error: invalid value \'{}\' for --rate\n'.format(opts['rate']))
+        sys.stderr.flush()
+        sys.exit(1)
+capture_dir = opts.get('capture')
+if capture_dir is not None and not os.path.isdir(capture_dir):
+    sys.stderr.write('Error: directory \'{}\' doesn\'t exist\n'.format(capture_dir))
+    sys.stderr.flush()
+    sys.exit(2)
+try:
+    replay_speed = capture.parse_speed(opts.get('replay-speed', '1'))
+except ValueError:
+    sys.stderr.write('Error: invalid value \'{}\' for --replay-speed\n'.format(opts['replay-speed']))
+    sys.stderr.flush()
+    sys.exit(1)
+if 'replay' in opts and use_subprocess:
+    sys.stderr.write('Error: --replay can\'t be used with --subprocess\n')
+    sys.stderr.flush()
+    sys.exit(1)
+for sensor in sensors.values():
+    if rate is not None: sensor.options['rate'] = rate
+    if 'replay' in opts and not sensor.simulate and 'worker' not in opts:
+        path = os.path.join(opts['replay'], os.path.basename(sensor.usbport) + '.cap')
+        try:
+            sensor.replay = capture.Replay(path, replay_speed)
+            if sensor.replay.reader != sensor.reader_name:
+                raise ValueError('capture of {}, not {}'.format(sensor.replay.reader, sensor.reader_name))
+        except (OSError, ValueError) as e:
+            sys.stderr.write('Error: can\'t replay \'{}\': {}\n'.format(path, e))
+            sys.stderr.flush()
+            sys.exit(2)
+    if sensor.reader_name == 'read-dust':
+        if 'dust-mode' in opts: sensor.options['mode'] = opts['dust-mode']
+        if 'dust-period' in opts: sensor.options['period'] = int_option('dust-period', 0, 0)
+
+# "single" (one process), "ingest" (readers and database, --workers) or "worker" (web server)
+role = 'single'
+workers = int_option('workers', 0, 0)
+if 'worker' in opts:
+    role = 'worker'
+elif workers > 0:
+    role = 'ingest'
+    if sys.platform.startswith('win'):
+        sys.stderr.write('Error: --workers is not supported on Windows\n')
+        sys.stderr.flush()
+        sys.exit(1)
+bus_server = None
+
+engine = None
+if 'alerts' in opts and role != 'worker':
+    try:
+        rules = alerts.load_rules(opts['alerts'])
+    except Exception as e:
+        sys.stderr.write('Error: invalid alert rules in \'{}\': {}\n'.format(opts['alerts'], e))
+        sys.stderr.flush()
+        sys.exit(1)
+    engine = alerts.Engine(rules, list(sensors), on_alert, timing.now_ms())
 
-simulate = len(argv) > 3
+if port_id is None:
+    if len(sensors) == 1:
+        port_id = int('808' + list(sensors)[0]) # set port number according to sensor number
+    else:
+        port_id = WEB_PORT
+bus_path = opts.get('bus') or os.path.join(tempfile.gettempdir(), 'bluesensor-{}.sock'.format(port_id))
 
 STATIC_PATH = os.path.join(os.path.dirname(__file__), 'static')
 app = web.Application([
     (r"/", MainHandler),
     (r"/data", DataHandler),
+    (r"/data/([^/]+)", DataHandler),
+    (r"/api/series", SeriesHandler),
+    (r"/api/export", ExportHandler),
+    (r"/api/latest", LatestHandler),
+    (r"/api/status", StatusHandler),
+    (r"/alerts", AlertsHandler),
+    (r"/metrics", MetricsHandler),
     (r'/static/(.*)', web.StaticFileHandler, {'path': STATIC_PATH})
 ])
-app.listen(port_id) # webserver listening TCP port
+ingest_routes = [(r"/api/ingest", IngestHandler)] if ingest_path is not None else []
+if role == 'single':
+    app.add_handlers(r'.*', ingest_routes)
+    app.listen(port_id) # webserver listening TCP port
+elif role == 'worker':
+    app.listen(port_id, reuse_port=True) # shared by all workers
+elif 'ingest-port' in opts:
+    # remote agents send measurements to ingest process
+    web.Application([(r"/metrics", MetricsHandler)] + ingest_routes).listen(int_option('ingest-port', None))
+elif ingest_path is not None:
+    sys.stderr.write('Error: --ingest with --workers needs --ingest-port\n')
+    sys.stderr.flush()
+    sys.exit(1)
 
-if db_use:
-    db_use = db.dbOpen()
+writer = None; spool = None; drainer = None
+if db_use and role == 'worker':
+    # only for queries (/api/series, /api/export), ingest process writes measurements
+    writer = db.DBWriter(pool_size=1, schema=int_option('db-schema', db.SCHEMA), rollups=rollup_levels)
+elif db_use:
+    writer = db.DBWriter(batch_size=int_option('db-batch', db.BATCH_SIZE),
+                         buffer_size=int_option('db-buffer', db.BUFFER_SIZE),
+                         pool_size=int_option('db-pool', db.POOL_SIZE),
+                         overflow=opts.get('db-overflow', 'drop'),
+                         schema=int_option('db-schema', db.SCHEMA),
+                         rollups=rollup_levels)
+    spool_path = opts.get('spool', SPOOL_PATH)
+    if spool_path != 'none':
+        # measurements go to local spool first, drainer writes them to database
+        # in batches of --db-batch rows; spool is the buffer, its size is limited
+        # with --spool-size and it never blocks, so buffer options don't apply
+        for name in ('db-buffer', 'db-overflow'):
+            if name in opts:
+                sys.stderr.write('Error: --{} applies only with --spool none\n'.format(name))
+                sys.stderr.flush()
+                sys.exit(1)
+        try:
+            spool = Spool(spool_path, max_size=int_option('spool-size', 1024)*1024*1024,
+                          fsync=opts.get('spool-fsync', 'interval'))
+        except:
+            print_exc('spool', spool_path + ': ')
+            sys.exit(4)
+        drainer = SpoolDrainer(spool, writer.write_batch, int_option('db-batch', DRAIN_BATCH))
+        drainer.start()
+    else:
+        writer.start()
 
-sys.stdout.write('Starting Sensor web server with {}\n'.format(reader_py))
-sys.stdout.write('To connect, open http://localhost:' + str(port_id) + '/\n')
-sys.stdout.flush()
 ioloop = ioloop.IOLoop.current()
-ioloop.add_callback(reader, ioloop)
-ioloop.start()
+if role == 'worker':
+    parent_pid = os.getppid()
+    ioloop.add_callback(bus.subscribe, bus_path, on_bus_message,
+                        lambda: print_exc('on_bus_message'))
+    # stop when ingest process is gone
+    PeriodicCallback(lambda: os.getppid() != parent_pid and ioloop.stop(), WORKER_CHECK*1000).start()
+else:
+    for sensor in sensors.values():
+        sys.stdout.write('Starting Sensor web server with {} on {}\n'.format(
+            sensor.reader_py if use_subprocess else sensor.reader_name, sensor.usbport))
+    sys.stdout.write('To connect, open http://localhost:' + str(port_id) + '/\n')
+    sys.stdout.flush()
+    for sensor in sensors.values():
+        ioloop.add_callback(supervise, ioloop, sensor, reader if use_subprocess else run_reader)
+    PeriodicCallback(check_readers, HEALTH_CHECK*1000).start()
+    watcher = None
+    if not all(sensor.simulate or sensor.replay is not None for sensor in sensors.values()):
+        try:
+            watcher = hotplug.Watcher(os.path.dirname(DEVNAME) or '.')
+            ioloop.add_handler(watcher.fileno(), on_hotplug, ioloop.READ)
+        except OSError:
+            PeriodicCallback(poll_devices, HOTPLUG_POLL*1000).start()
+    if writer is not None:
+        PeriodicCallback(print_db_stats, DB_STATS*1000).start()
+        if writer.rollups is not None:
+            PeriodicCallback(flush_rollups, ROLLUP_FLUSH*1000).start()
+        if db_retention:
+            ioloop.add_callback(expire_rows)
+            PeriodicCallback(expire_rows, RETENTION_CHECK*1000).start()
+    if engine is not None:
+        PeriodicCallback(lambda: engine.check(timing.now_ms()), ALERT_CHECK*1000).start()
+    if ingest_path is not None:
+        load_ingest_state(ingest_path)
+        PeriodicCallback(save_ingest_state, INGEST_SAVE*1000).start()
+worker_procs = []
+if role == 'ingest':
+    bus_server = bus.BusServer(bus_path, bus_snapshot)
+    worker_procs = [start_worker(i) for i in range(workers)]
+    PeriodicCallback(check_workers, WORKER_CHECK*1000).start()
+try:
+    ioloop.start()
+finally:
+    for proc in worker_procs:
+        if proc.poll() is None: proc.terminate()
+    for sensor in sensors.values():
+        if sensor.capture is not None:
+            sensor.capture.close()
+    if ingest_path is not None and role != 'worker':
+        save_ingest_state()
+    if bus_server is not None:
+        bus_server.close()
+    if drainer is not None:
+        drainer.stop()
+    if writer is not None and writer.rollups is not None and role != 'worker':
+        # a flush which is being written is removed from backlog when it is
+        # done, so it isn't merged into database twice
+        if rollup_lock.acquire(timeout=ROLLUP_SHUTDOWN):
+            rollup_lock.release()
+            rollup_backlog.append(writer.rollups.take())
+            try:
+                write_rollups()
+            except:
+                print_exc('rollups')
+        else:
+            sys.stderr.write('Rollups were not written, database is not responding\n')
+    if writer is not None:
+        writer.stop() # write out buffered rows
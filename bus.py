@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor local message bus (used with --workers)
+# The ingest process, which runs readers and the database writer, publishes
+# every measurement once to a Unix domain socket; web workers subscribe to it
+# and do the fan-out to their WebSocket clients. Messages are lines
+# "<kind> <sensor> <payload>\n", where payload is JSON without newlines:
+# - "m": measurement (JSON line of reader);
+# - "s": status of reader (see Sensor.set_state);
+# - "a": alert event (see alerts.py);
+# - "h": history of sensor, sent to new subscribers before other messages,
+#   in chunks (first one replaces history of subscriber, others are added).
+# Messages published in one IOLoop iteration are written to subscribers at
+# once; a subscriber which falls more than BUFFER bytes behind is dropped
+# (it reconnects and gets history again). Snapshot for a new subscriber is
+# written part by part, waiting for each to be sent, so that a long history
+# doesn't stop the IOLoop; messages published meanwhile wait in its backlog.
+
+import os
+import socket
+from tornado import gen, iostream, netutil
+from tornado.ioloop import IOLoop
+from tornado.tcpserver import TCPServer
+
+BUFFER     = 64*1024*1024 # max bytes waiting to be written to one subscriber
+READ_CHUNK = 65536
+RETRY      = 1 # seconds between reconnects of subscriber
+
+def encode(kind, sensor, payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return b' '.join((kind.encode('ascii'), sensor.encode('utf-8'), payload)) + b'\n'
+
+# (kind, sensor, payload bytes) of one message line
+def decode(line):
+    kind, sensor, payload = line.split(b' ', 2)
+    return kind.decode('ascii'), sensor.decode('utf-8'), payload
+
+class BusServer(TCPServer):
+    # snapshot() returns iterable of messages (bytes) for a new subscriber,
+    # with state as it was when snapshot() was called
+    def __init__(self, path, snapshot):
+        TCPServer.__init__(self)
+        self.path = path
+        self.snapshot = snapshot
+        self.subscribers = {} # stream -> backlog while snapshot is written, None after it
+        self.pending = []
+        self.published = 0
+        self.dropped = 0 # subscribers dropped because they were too slow
+        self.add_socket(netutil.bind_unix_socket(path))
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        self.subscribers[stream] = backlog = bytearray()
+        try:
+            for part in self.snapshot():
+                yield stream.write(part)
+            if self.subscribers.get(stream) is backlog:
+                stream.max_write_buffer_size = BUFFER
+                self.subscribers[stream] = None
+                stream.write(bytes(backlog))
+            yield stream.read_until_close() # subscribers don't send anything
+        except iostream.StreamClosedError:
+            pass
+        finally:
+            self.subscribers.pop(stream, None)
+
+    def publish(self, kind, sensor, payload):
+        if not self.subscribers: return
+        if not self.pending:
+            IOLoop.current().add_callback(self.flush)
+        self.pending.append(encode(kind, sensor, payload))
+        self.published += 1
+
+    def flush(self):
+        data = b''.join(self.pending)
+        self.pending = []
+        for stream, backlog in list(self.subscribers.items()):
+            try:
+                if backlog is not None:
+                    backlog += data
+                    if len(backlog) > BUFFER:
+                        raise iostream.StreamBufferFullError('backlog is full')
+                else:
+                    stream.write(data)
+            except iostream.StreamBufferFullError:
+                self.dropped += 1
+                self.subscribers.pop(stream, None)
+                stream.close()
+            except iostream.StreamClosedError:
+                self.subscribers.pop(stream, None)
+
+    def close(self):
+        self.stop()
+        for stream in list(self.subscribers):
+            stream.close()
+        try: os.remove(self.path)
+        except OSError: pass
+
+# Subscriber: calls on_message(kind, sensor, payload) for every message,
+# reconnects when connection is lost
+@gen.coroutine
+def subscribe(path, on_message, on_error=None):
+    while True:
+        try:
+            stream = iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            yield stream.connect(path)
+            buf = b''
+            while True:
+                chunk = yield stream.read_bytes(READ_CHUNK, partial=True)
+                lines = (buf + chunk).split(b'\n')
+                buf = lines.pop() # incomplete message, if any
+                for line in lines:
+                    try:
+                        on_message(*decode(line))
+                    except Exception:
+                        if on_error is not None: on_error()
+        except (iostream.StreamClosedError, OSError):
+            pass
+        yield gen.sleep(RETRY)
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor capture of serial data
+# Bytes read from a serial port are appended to a capture file exactly as
+# they were received, with time of receipt, so that a device can be replayed
+# later through the same parsing path (Reader.feed). File starts with MAGIC
+# and a JSON line with reader, port and options of reader; every record is
+# RECORD (time of receipt in msec since epoch, number of bytes) followed by
+# the bytes. Files are append-only: capturing again into the same file adds
+# records to it, and a capture which is still being written can be replayed
+# up to its last complete record.
+# Replay memory-maps the file and returns records at their original pace,
+# <speed> times faster, or as fast as possible (speed None). Paced replay
+# timestamps measurements as if device were sending them now; replay at max
+# speed keeps their original times (for filling database from captures).
+
+import json
+import mmap
+import struct
+import time
+
+from timing import clock
+
+MAGIC        = b'BSCAP1\n'
+RECORD       = struct.Struct('<qI') # msec since epoch, number of bytes
+FLUSH        = 1.0 # max seconds of records kept in write buffer
+BUFFER       = 65536 # bytes of write buffer
+REPLAY_BATCH = 256 # max records returned at once
+
+class Capture:
+    def __init__(self, path, reader, port, options=None):
+        self.path = path
+        self.file = open(path, 'ab', buffering=BUFFER)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC + json.dumps({'reader': reader, 'port': port,
+                                                'options': options or {}}).encode('utf-8') + b'\n')
+        else:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    self.file.close()
+                    raise ValueError('{} is not a capture file'.format(path))
+        self.flushed = time.monotonic()
+        self.records = 0
+        self.bytes = 0
+
+    # data received at monotonic time received (ns)
+    def append(self, data, received=None):
+        self.file.write(RECORD.pack(clock.ms(received), len(data)))
+        self.file.write(data)
+        self.records += 1
+        self.bytes += len(data)
+        now = time.monotonic()
+        if now - self.flushed > FLUSH:
+            self.file.flush()
+            self.flushed = now
+
+    def close(self):
+        self.file.close()
+
+class Replay:
+    # speed is multiple of original pace, None for max speed
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a capture file'.format(path))
+            self.header = json.loads(f.readline().decode('utf-8'))
+            self.pos = f.tell()
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.reader = self.header.get('reader')
+        self.records = 0
+        self.first = None # (msec of first record, monotonic ns when it was replayed)
+        self.next = self.read()
+
+    # next record (msec, bytes), None at the end
+    def read(self):
+        pos = self.pos
+        if pos + RECORD.size > len(self.map):
+            return None
+        t, n = RECORD.unpack_from(self.map, pos)
+        if pos + RECORD.size + n > len(self.map):
+            return None # incomplete record
+        self.pos = pos + RECORD.size + n
+        return t, self.map[pos + RECORD.size:self.pos]
+
+    @property
+    def done(self):
+        return self.next is None
+
+    # monotonic time (ns) when record of time t (msec) is due
+    def due_time(self, t):
+        return self.first[1] + int((t - self.first[0])*1000000/self.speed)
+
+    # (bytes, monotonic time received (ns)) of records which are due
+    def due(self):
+        records = []
+        now = time.monotonic_ns()
+        while self.next is not None and len(records) < REPLAY_BATCH:
+            t, data = self.next
+            if self.speed is None:
+                received = clock.mono(t)
+            else:
+                if self.first is None:
+                    self.first = (t, now)
+                received = self.due_time(t)
+                if received > now: break
+            records.append((data, received))
+            self.records += 1
+            self.next = self.read()
+        return records
+
+    # seconds until next record is due
+    def delay(self):
+        if self.next is None or self.speed is None or self.first is None:
+            return 0.0
+        return max(0.0, (self.due_time(self.next[0]) - time.monotonic_ns())/1e9)
+
+    def close(self):
+        self.map.close()
+
+# speed of replay from option value: number or "max"
+def parse_speed(value):
+    if value == 'max':
+        return None
+    speed = float(value)
+    if not speed > 0:
+        raise ValueError('speed must be positive or "max"')
+    return speed
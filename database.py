@@ -3,26 +3,53 @@
 
 # BlueSensor database functions
 
-import sys, os
+import os
+import sys
 import traceback
-import datetime, time, pytz
-from pprint import pprint
+import datetime, time
 import json
 import psycopg2
 import psycopg2.extensions
-from threading import Lock
+import psycopg2.extras
+import psycopg2.pool
+from threading import Lock, Condition, Thread
+from collections import deque
+
+import timing
+import metrics
 
 DBHOST = 'localhost'
-DBNAME = 'bluesensor'
+DBNAME = os.environ.get('BLUESENSOR_DB', 'bluesensor') # another database with BLUESENSOR_DB (tests)
 DBUSER = 'postgres'
 DBPWD  = 'password'
 TABLE  = 'data'
+# Dates in all tables are UTC (rows saved by older versions into table DATA
+# have local time of the server, migrate-db.py converts them with
+# --source-tz).
 
-db = None
-cs = None
-db_lock = Lock()
+# Storage layout (schema):
+# 1: table DATA with whole JSON from reader (jsonb) per measurement;
+# 2: DEVICES (source, metadata and list of data keys of a device),
+#    SENSORS (one row per data key of a device) and SAMPLES (date, device,
+#    array of values in order of device's keys), partitioned by month.
+SCHEMA   = 1
+DEVICES  = 'devices'
+SENSORS  = 'sensors'
+SAMPLES  = 'samples'
+ALERTS   = 'alerts'
+# Rollup tables (min/max/sum/count of every data key per source and time
+# bucket), 'rollup_<level>', maintained by Rollups
+ROLLUP_LEVELS = (('1m', 60000), ('1h', 3600000), ('1d', 86400000)) # level, msec of bucket
+ROLLUP_PREFIX = 'rollup_'
+RETENTION_BATCH = 10000 # max raw rows deleted at once by dbExpire
+SERIES_GAPS = 20 # max queries of raw rows for buckets without rollups, one query for more gaps
 
-tz = pytz.timezone('Europe/Ljubljana')
+BATCH_SIZE  = 500   # max rows written in one INSERT
+BATCH_AGE   = 1.0   # max seconds a row waits in buffer before it is written
+BUFFER_SIZE = 10000 # max rows waiting in buffer
+POOL_SIZE   = 2     # connections (and writer threads) in the pool
+RETRY_DELAY = 5     # seconds to wait after a failed write
+QUERY_CONNECTIONS = 2 # extra connections in the pool for queries
 
 def print_exc(f_name, msg=''):
     exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -30,59 +57,638 @@ def print_exc(f_name, msg=''):
     err = '{}({}): {}'.format(f_name, exc_tb.tb_lineno, msg) + exc[-1].strip()
     sys.stderr.write(err + '\n')
 
-def time_now_ms():
-    tt = datetime.datetime.now(tz).timetuple()
-    now = time.mktime(tt) + 3600 # WTF?!
-    if tt.tm_isdst: now += 3600
-    return int(now)*1000
-
-def sqlDate(dt=None):
-    # PostgreSQL timestamp (ISO 8601) without time zone
+def sqlDate(dt):
+    # PostgreSQL timestamp (ISO 8601) without time zone, in UTC; rows are
+    # dated with time of measurement (see msDate), never with time of insert
     #sdt = '1980-01-01 12:00:00.000000'# + '+00:00'
     sdt = None
     try:
-        if dt is None:
-            dt = datetime.datetime.now()
         sdt = dt.strftime('%Y-%m-%d %H:%M:%S.%f')
         #sdt += '+00:00'
     except:
         print_exc(sys._getframe().f_code.co_name)
     return sdt
 
-def dbInsert(source, data):
-    rc = False
-    try:
-        # Table DATA: 0: id (serial, primary key),
-        # 1: date, 2: source, 3: data
-        values = (sqlDate(), source, data)
-        cs.execute("INSERT INTO {tn} ("\
-            "date, source, data"\
-            ") VALUES (%s,%s,%s)"\
-            .format(tn=TABLE), values)
-        db.commit()
-        rc = True
-    except:
-        print_exc(sys._getframe().f_code.co_name)
-    return rc
+def msDate(ms):
+    # msec since epoch to timestamp of date column
+    return timing.utc_datetime(ms)
 
-def dbOpen():
-    global db, cs
-    rc = False
-    try:
-        with db_lock:
-            if db is None or cs is None:
-                sys.stderr.write('Connecting to db {0}:{1} as user {2}\n'\
-                    .format(DBHOST, DBNAME, DBUSER))
-                db = psycopg2.connect(host=DBHOST, dbname=DBNAME, user=DBUSER, password=DBPWD)
-                db.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-                cs = db.cursor()
-        # Table DATA: 0: id (serial, primary key),
-        # 1: date, 2: source, 3: data
-        cs.execute("CREATE TABLE IF NOT EXISTS {tn} (id serial PRIMARY KEY, "\
-            "date timestamp, source text, data jsonb"\
-            ")".format(tn=TABLE))
-        db.commit()
-        rc = True
-    except:
-        print_exc(sys._getframe().f_code.co_name)
-    return rc
+# min/max/mean/count of one data key of source between t_from and t_to (msec),
+# in buckets of width msec; returns rows (bucket start, min, max, mean, count).
+# Buckets at least as wide as a rollup level are read from its rollup table,
+# those which have no rollups from raw rows.
+def dbSeries(writer, source, key, t_from, t_to, width):
+    levels = [level for level, w in writer.rollups.levels if w <= width] if writer.rollups else []
+    if not levels:
+        return dbRawSeries(writer, source, key, t_from, t_to, width, t_from)
+    rows = writer.query("SELECT "\
+        "(floor((extract(epoch FROM bucket)*1000 - %(from_ms)s)/%(width)s)*%(width)s + %(from_ms)s)::bigint AS b, "\
+        "min(min), max(max), (sum(sum)/sum(count))::float8, sum(count)::bigint FROM {rn} "\
+        "WHERE source = %(source)s AND key = %(key)s AND bucket >= %(from)s AND bucket <= %(to)s "\
+        "GROUP BY b ORDER BY b".format(rn=ROLLUP_PREFIX + levels[-1]),
+        {'source': source, 'key': key, 'from_ms': t_from, 'width': width,
+         'from': msDate(t_from), 'to': msDate(t_to)})
+    # buckets without rollups (data older than rollups, rollups which are not
+    # written yet or were lost) are read from raw rows, a query per gap
+    have = set(row[0] for row in rows)
+    gaps = []
+    for b in range(t_from, t_to + 1, width):
+        if b in have: continue
+        if gaps and gaps[-1][1] == b:
+            gaps[-1][1] = b + width
+        else:
+            gaps.append([b, b + width])
+    if not gaps:
+        return rows
+    if len(gaps) > SERIES_GAPS:
+        raw = [row for row in dbRawSeries(writer, source, key, gaps[0][0], min(gaps[-1][1] - 1, t_to),
+                                           width, t_from) if row[0] not in have]
+    else:
+        raw = []
+        for lo, hi in gaps:
+            raw += dbRawSeries(writer, source, key, lo, min(hi - 1, t_to), width, t_from)
+    return sorted(list(rows) + raw, key=lambda row: row[0])
+
+# min/max/mean/count of one data key from raw rows, buckets are aligned to
+# align (msec)
+def dbRawSeries(writer, source, key, t_from, t_to, width, align):
+    params = {'source': source, 'key': key, 'from_ms': align, 'width': width,
+              'from': msDate(t_from), 'to': msDate(t_to)}
+    if writer.schema == 2:
+        return writer.query("SELECT "\
+            "(floor((extract(epoch FROM s.date)*1000 - %(from_ms)s)/%(width)s)*%(width)s + %(from_ms)s)::bigint AS b, "\
+            "min(s.value[d.idx]), max(s.value[d.idx]), avg(s.value[d.idx]), count(s.value[d.idx]) "\
+            "FROM {sn} s JOIN (SELECT id, array_position(keys, %(key)s) AS idx FROM {dn} "\
+            "WHERE source = %(source)s) d ON s.device = d.id "\
+            "WHERE s.date >= %(from)s AND s.date <= %(to)s AND d.idx IS NOT NULL "\
+            "GROUP BY b HAVING count(s.value[d.idx]) > 0 ORDER BY b".format(sn=SAMPLES, dn=DEVICES), params)
+    return writer.query("SELECT "\
+        "(floor((extract(epoch FROM date)*1000 - %(from_ms)s)/%(width)s)*%(width)s + %(from_ms)s)::bigint AS b, "\
+        "min(v), max(v), avg(v), count(v) FROM ("\
+        "SELECT date, CASE WHEN jsonb_typeof(data->'data'->%(key)s) = 'number' "\
+        "THEN (data->'data'->>%(key)s)::float8 END AS v FROM {tn} "\
+        "WHERE source = %(source)s AND date >= %(from)s AND date <= %(to)s"\
+        ") s WHERE v IS NOT NULL GROUP BY b ORDER BY b".format(tn=TABLE), params)
+
+# data keys of source saved between t_from and t_to (msec)
+def dbKeys(writer, source, t_from, t_to):
+    if writer.schema == 2:
+        rows = writer.query("SELECT DISTINCT unnest(keys) FROM {dn} WHERE source = %s".format(dn=DEVICES),
+                            (source,))
+    else:
+        rows = writer.query("SELECT DISTINCT jsonb_object_keys(data->'data') FROM {tn} "\
+            "WHERE source = %s AND date >= %s AND date <= %s AND jsonb_typeof(data->'data') = 'object'"\
+            .format(tn=TABLE), (source, msDate(t_from), msDate(t_to)))
+    return sorted(r[0] for r in rows)
+
+# Rows of source between t_from and t_to (msec) with values of data keys
+# flattened into columns: (time msec, device_id, value of keys[0], ...).
+# Rows are read with a server-side (named) cursor in chunks of itersize,
+# so any number of rows is exported in constant memory. open(), fetch()
+# and close() are blocking and are called from a thread.
+EXPORT_ITERSIZE = 5000
+
+class DBExport:
+    def __init__(self, writer, source, keys, t_from, t_to, itersize=EXPORT_ITERSIZE):
+        self.writer = writer
+        self.source = source
+        self.keys = keys
+        self.t_from = t_from
+        self.t_to = t_to
+        self.itersize = itersize
+        self.pool = None
+        self.conn = None
+        self.cs = None
+        self.rows = 0
+
+    def sql(self):
+        params = {'source': self.source, 'from': msDate(self.t_from), 'to': msDate(self.t_to)}
+        columns = []
+        for n, key in enumerate(self.keys):
+            params['k{}'.format(n)] = key
+            if self.writer.schema == 2:
+                columns.append("s.value[array_position(d.keys, %(k{})s::text)]".format(n))
+            else:
+                columns.append("CASE WHEN jsonb_typeof(data->'data'->%(k{0})s) = 'number' "\
+                    "THEN (data->'data'->>%(k{0})s)::float8 END".format(n))
+        if self.writer.schema == 2:
+            sql = "SELECT (extract(epoch FROM s.date)*1000)::bigint, d.device_id{c} "\
+                "FROM {sn} s JOIN {dn} d ON s.device = d.id "\
+                "WHERE d.source = %(source)s AND s.date >= %(from)s AND s.date <= %(to)s "\
+                "ORDER BY s.date".format(sn=SAMPLES, dn=DEVICES, c=''.join(', ' + c for c in columns))
+        else:
+            # time of measurement if it is saved, else date of row
+            sql = "SELECT CASE WHEN jsonb_typeof(data->'time') = 'number' AND (data->>'time')::float8 > 0 "\
+                "THEN (data->>'time')::float8::bigint ELSE (extract(epoch FROM date)*1000)::bigint END, "\
+                "data->'metadata'->>'device_id'{c} FROM {tn} "\
+                "WHERE source = %(source)s AND date >= %(from)s AND date <= %(to)s "\
+                "ORDER BY date".format(tn=TABLE, c=''.join(', ' + c for c in columns))
+        return sql, params
+
+    def open(self):
+        self.pool = self.writer.connect()
+        self.conn = self.pool.getconn()
+        self.cs = self.conn.cursor(name='export_{}'.format(id(self)))
+        self.cs.itersize = self.itersize
+        sql, params = self.sql()
+        self.cs.execute(sql, params)
+
+    # next chunk of rows, [] at the end
+    def fetch(self):
+        rows = self.cs.fetchmany(self.itersize)
+        self.rows += len(rows)
+        return rows
+
+    def close(self):
+        if self.conn is None: return
+        broken = self.conn.closed != 0
+        try:
+            if self.cs is not None and not broken:
+                self.cs.close()
+            self.conn.rollback() # end of read-only transaction
+        except:
+            broken = True
+        self.pool.putconn(self.conn, close=broken)
+        self.conn = None; self.cs = None
+
+def dbCreate(cs, schema=SCHEMA):
+    dbCreateAlerts(cs)
+    dbCreateRollups(cs)
+    if schema == 2:
+        dbCreateSamples(cs)
+        return
+    # Table DATA: 0: id (serial, primary key),
+    # 1: date, 2: source, 3: data
+    cs.execute("CREATE TABLE IF NOT EXISTS {tn} (id serial PRIMARY KEY, "\
+        "date timestamp, source text, data jsonb"\
+        ")".format(tn=TABLE))
+    # (source, date) is unique, so replayed rows are skipped
+    cs.execute("CREATE UNIQUE INDEX IF NOT EXISTS {tn}_source_date_key "\
+        "ON {tn} (source, date)".format(tn=TABLE))
+
+def dbCreateSamples(cs):
+    # Table DEVICES: 0: id (serial, primary key), 1: source, 2: device_id,
+    # 3: metadata, 4: keys (data keys, in order of values in SAMPLES)
+    cs.execute("CREATE TABLE IF NOT EXISTS {dn} (id serial PRIMARY KEY, "\
+        "source text NOT NULL, device_id text, metadata jsonb NOT NULL, keys text[] NOT NULL, "\
+        "UNIQUE (source, metadata, keys))".format(dn=DEVICES))
+    # Table SENSORS: 0: id (serial, primary key), 1: device, 2: idx (index in
+    # SAMPLES.value), 3: key, 4: label, 5: model, 6: unit, 7: color
+    cs.execute("CREATE TABLE IF NOT EXISTS {nn} (id serial PRIMARY KEY, "\
+        "device integer NOT NULL REFERENCES {dn} (id), idx integer NOT NULL, key text NOT NULL, "\
+        "label text, model text, unit text, color text, "\
+        "UNIQUE (device, key))".format(nn=SENSORS, dn=DEVICES))
+    # Table SAMPLES: 0: date, 1: device, 2: value (NULL if value is not a number),
+    # partitioned by month (see dbCreatePartition)
+    cs.execute("CREATE TABLE IF NOT EXISTS {sn} ("\
+        "date timestamp NOT NULL, device integer NOT NULL, value double precision[] NOT NULL"\
+        ") PARTITION BY RANGE (date)".format(sn=SAMPLES))
+    # (device, date) is unique, so replayed rows are skipped
+    cs.execute("CREATE UNIQUE INDEX IF NOT EXISTS {sn}_device_date_key "\
+        "ON {sn} (device, date)".format(sn=SAMPLES))
+    cs.execute("CREATE INDEX IF NOT EXISTS {sn}_date_brin "\
+        "ON {sn} USING brin (date)".format(sn=SAMPLES))
+
+def dbCreateAlerts(cs):
+    # Table ALERTS: 0: id (serial, primary key), 1: date, 2: source,
+    # 3: rule, 4: state ('firing' or 'resolved'), 5: data (alert event)
+    cs.execute("CREATE TABLE IF NOT EXISTS {an} (id serial PRIMARY KEY, "\
+        "date timestamp NOT NULL, source text, rule text NOT NULL, state text NOT NULL, data jsonb"\
+        ")".format(an=ALERTS))
+    cs.execute("CREATE INDEX IF NOT EXISTS {an}_date_idx "\
+        "ON {an} (date)".format(an=ALERTS))
+
+def dbCreateRollups(cs):
+    # Tables ROLLUP_<level>: 0: source, 1: key, 2: bucket (start of time
+    # bucket), 3: min, 4: max, 5: sum, 6: count (of numeric values)
+    for level, width in ROLLUP_LEVELS:
+        cs.execute("CREATE TABLE IF NOT EXISTS {rn} ("\
+            "source text NOT NULL, key text NOT NULL, bucket timestamp NOT NULL, "\
+            "min double precision, max double precision, sum double precision, count bigint NOT NULL, "\
+            "PRIMARY KEY (source, key, bucket))".format(rn=ROLLUP_PREFIX + level))
+
+# rows (source, key, bucket, min, max, sum, count) of rollup tables
+# {level: rows}; rows are merged with rows already saved, so the same
+# bucket can be written more than once; blocking
+def dbUpsertRollups(writer, tables):
+    writer.execute_values([("INSERT INTO {rn} (source, key, bucket, min, max, sum, count) VALUES %s "\
+            "ON CONFLICT (source, key, bucket) DO UPDATE SET "\
+            "min = least({rn}.min, excluded.min), max = greatest({rn}.max, excluded.max), "\
+            "sum = {rn}.sum + excluded.sum, count = {rn}.count + excluded.count"\
+            .format(rn=ROLLUP_PREFIX + level), rows) for level, rows in tables.items() if rows])
+
+# Fill rollup buckets between t_from and t_to (msec) which are not in rollup
+# tables from raw rows (saved before rollups were used); blocking
+def dbRebuildRollups(writer, t_from, t_to):
+    if writer.schema == 2:
+        values = "SELECT d.source, s.date, k.key, k.v FROM {sn} s JOIN {dn} d ON s.device = d.id, "\
+            "unnest(d.keys, s.value) AS k(key, v) WHERE s.date >= %(from)s AND s.date < %(to)s"\
+            .format(sn=SAMPLES, dn=DEVICES)
+    else:
+        values = "SELECT source, date, kv.key, CASE WHEN jsonb_typeof(kv.value) = 'number' "\
+            "THEN kv.value::text::float8 END AS v FROM {tn}, jsonb_each(data->'data') kv "\
+            "WHERE date >= %(from)s AND date < %(to)s AND jsonb_typeof(data->'data') = 'object'".format(tn=TABLE)
+    for level, width in ROLLUP_LEVELS:
+        writer.execute("INSERT INTO {rn} (source, key, bucket, min, max, sum, count) "\
+            "SELECT source, key, 'epoch'::timestamp + floor(extract(epoch FROM date)*1000/%(width)s)*%(width)s "\
+            "* interval '1 millisecond' AS b, min(v), max(v), sum(v), count(v) FROM ({values}) s "\
+            "WHERE v IS NOT NULL GROUP BY source, key, b ON CONFLICT DO NOTHING"\
+            .format(rn=ROLLUP_PREFIX + level, values=values),
+            {'width': width, 'from': msDate(t_from), 'to': msDate(t_to)})
+
+# Delete raw rows (table DATA or SAMPLES) older than t (msec), rollups are
+# kept; whole partitions of SAMPLES are dropped; returns rows deleted
+def dbExpire(writer, t):
+    cutoff = msDate(t)
+    deleted = 0
+    if writer.schema == 2:
+        for (name,) in writer.query("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "\
+                "WHERE i.inhparent = %s::regclass ORDER BY c.relname", (SAMPLES,)):
+            month = name[-6:-2] + '-' + name[-2:] # samples_YYYYMM
+            y, m = int(month[:4]), int(month[5:])
+            end = datetime.datetime(y + 1, 1, 1) if m == 12 else datetime.datetime(y, m + 1, 1)
+            if end <= cutoff:
+                deleted += writer.query("SELECT count(*) FROM {}".format(name))[0][0]
+                with writer.partition_lock:
+                    writer.execute("DROP TABLE {}".format(name))
+                    writer.partitions.discard(month)
+            elif datetime.datetime(y, m, 1) < cutoff:
+                deleted += writer.execute("DELETE FROM {} WHERE date < %s".format(name), (cutoff,))
+        return deleted
+    while True:
+        n = writer.execute("DELETE FROM {tn} WHERE id IN (SELECT id FROM {tn} WHERE date < %s LIMIT {batch})"\
+            .format(tn=TABLE, batch=RETENTION_BATCH), (cutoff,))
+        deleted += n
+        if n < RETENTION_BATCH:
+            return deleted
+
+# alert event (see alerts.py) of source, blocking
+def dbInsertAlert(writer, source, event):
+    writer.execute("INSERT INTO {an} (date, source, rule, state, data) "\
+        "VALUES (%s, %s, %s, %s, %s)".format(an=ALERTS),
+        (msDate(event['time']), source, event['rule'], event['state'], json.dumps(event)))
+
+def dbCreatePartition(cs, month):
+    # month is 'YYYY-MM'
+    y, m = int(month[:4]), int(month[5:7])
+    ny, nm = (y + 1, 1) if m == 12 else (y, m + 1)
+    cs.execute("CREATE TABLE IF NOT EXISTS {sn}_{y:04d}{m:02d} PARTITION OF {sn} "\
+        "FOR VALUES FROM ('{y:04d}-{m:02d}-01') TO ('{ny:04d}-{nm:02d}-01')"\
+        .format(sn=SAMPLES, y=y, m=m, ny=ny, nm=nm))
+
+def number(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value == value:
+        return value
+    return None
+
+# Convert rows (date, source, data) to SAMPLES rows (date, device, values),
+# devices maps (source, metadata, keys) to DEVICES.id and is updated.
+def samplesRows(cs, rows, devices):
+    samples = []
+    for date, source, data in rows:
+        if not isinstance(data, dict):
+            data = json.loads(data)
+        values = data.get('data') or {}
+        metadata = data.get('metadata') or {}
+        keys = tuple(sorted(values)) # JSONB does not keep order of keys
+        dkey = (source, json.dumps(metadata, sort_keys=True), keys)
+        device = devices.get(dkey)
+        if device is None:
+            device = devices[dkey] = dbDevice(cs, source, metadata, keys)
+        samples.append((date, device, [number(values[k]) for k in keys]))
+    return samples
+
+def dbDevice(cs, source, metadata, keys):
+    cs.execute("INSERT INTO {dn} (source, device_id, metadata, keys) VALUES (%s,%s,%s,%s) "\
+        "ON CONFLICT (source, metadata, keys) DO UPDATE SET device_id = EXCLUDED.device_id "\
+        "RETURNING id".format(dn=DEVICES),
+        (source, metadata.get('device_id'), json.dumps(metadata), list(keys)))
+    device = cs.fetchone()[0]
+    sensors = metadata.get('sensors') or {}
+    for idx, key in enumerate(keys):
+        info = (list(sensors.get(key) or []) + [None]*4)[:4]
+        cs.execute("INSERT INTO {nn} (device, idx, key, label, model, unit, color) "\
+            "VALUES (%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (device, key) DO NOTHING".format(nn=SENSORS),
+            [device, idx + 1, key] + info)
+    return device
+
+# In-memory rollups of measurements, add() is called for every measurement
+# (also those not saved with --data-log <n>). Only accumulators of the finest
+# level are updated per value (min, max, sum, count per source, data key and
+# bucket); coarser levels are computed from them in take(), which returns
+# rows for dbUpsertRollups and starts new accumulators. Rows of a bucket which
+# is still open are merged in database with rows written later.
+class Rollups:
+    def __init__(self, levels=ROLLUP_LEVELS):
+        self.levels = levels
+        self.width = levels[0][1]
+        self.acc = {} # (source, key, bucket msec) -> [min, max, sum, count]
+        self.values = 0 # values added
+
+    def add(self, source, t, data):
+        bucket = t - t % self.width
+        acc = self.acc
+        for key, value in data.items():
+            value = number(value)
+            if value is None: continue
+            a = acc.get((source, key, bucket))
+            if a is None:
+                acc[(source, key, bucket)] = [value, value, value, 1]
+            else:
+                if value < a[0]: a[0] = value
+                elif value > a[1]: a[1] = value
+                a[2] += value
+                a[3] += 1
+            self.values += 1
+
+    def take(self):
+        acc = self.acc
+        self.acc = {}
+        tables = {}
+        for level, width in self.levels:
+            if width != self.width:
+                merged = {}
+                for (source, key, bucket), a in acc.items():
+                    k = (source, key, bucket - bucket % width)
+                    m = merged.get(k)
+                    if m is None:
+                        merged[k] = list(a)
+                    else:
+                        m[0] = min(m[0], a[0]); m[1] = max(m[1], a[1])
+                        m[2] += a[2]; m[3] += a[3]
+                acc = merged
+            tables[level] = [(source, key, msDate(bucket), a[0], a[1], a[2], a[3])
+                             for (source, key, bucket), a in acc.items()]
+        return tables
+
+# Asynchronous write-behind writer: rows are buffered in memory and written
+# in batches (multi-row INSERT) by writer threads through a connection pool,
+# so a slow database never blocks the caller.
+# When buffer is full, insert() either drops the row (overflow='drop')
+# or waits until there is room for it (overflow='block').
+class DBWriter:
+    def __init__(self, batch_size=BATCH_SIZE, batch_age=BATCH_AGE, buffer_size=BUFFER_SIZE,
+                 pool_size=POOL_SIZE, overflow='drop', schema=SCHEMA, rollups=ROLLUP_LEVELS):
+        self.batch_size = max(1, batch_size)
+        self.batch_age = batch_age
+        self.buffer_size = max(self.batch_size, buffer_size)
+        self.pool_size = max(1, pool_size)
+        self.overflow = overflow
+        self.buffer = deque() # (enqueue time, row)
+        self.cond = Condition()
+        self.schema = schema
+        self.rollups = Rollups(rollups) if rollups else None
+        self.pool = None
+        self.created = False
+        self.devices = {} # schema 2: (source, metadata, keys) -> DEVICES.id
+        self.partitions = set() # schema 2: months with SAMPLES partition
+        self.partition_lock = Lock()
+        self.running = False
+        self.threads = []
+        # statistics
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.flush_time = 0.0 # total seconds spent in flushes
+        self.last_flush_time = 0.0
+        self.last_batch_size = 0
+        self.batch_sizes = metrics.Histogram(metrics.SIZE_BUCKETS) # rows per flush
+        self.flush_seconds = metrics.Histogram(metrics.TIME_BUCKETS)
+
+    def start(self):
+        self.running = True
+        for n in range(self.pool_size):
+            t = Thread(target=self.run, name='DBWriter-{}'.format(n))
+            t.daemon = True; t.start()
+            self.threads.append(t)
+
+    def stop(self, timeout=10):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join(timeout)
+        if self.pool is not None:
+            try: self.pool.closeall()
+            except: pass
+
+    # date is time of measurement (see msDate)
+    def insert(self, source, data, date):
+        row = (date, source, data)
+        with self.cond:
+            if len(self.buffer) >= self.buffer_size:
+                if self.overflow != 'block':
+                    self.dropped += 1
+                    return False
+                while self.running and len(self.buffer) >= self.buffer_size:
+                    self.cond.wait()
+            self.buffer.append((time.monotonic(), row))
+            if len(self.buffer) == 1 or len(self.buffer) >= self.batch_size:
+                self.cond.notify_all()
+        return True
+
+    def stats(self):
+        flushes = self.flushes
+        return {
+            'queue': len(self.buffer),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'flushes': flushes,
+            'last_batch_size': self.last_batch_size,
+            'last_flush_ms': round(self.last_flush_time*1000, 3),
+            'avg_flush_ms': round(self.flush_time*1000/flushes, 3) if flushes else 0.0
+        }
+
+    def next_batch(self):
+        with self.cond:
+            while True:
+                if self.buffer:
+                    age = time.monotonic() - self.buffer[0][0]
+                    if not self.running or len(self.buffer) >= self.batch_size or age >= self.batch_age:
+                        break
+                    self.cond.wait(self.batch_age - age)
+                elif not self.running:
+                    return None
+                else:
+                    self.cond.wait()
+            n = min(self.batch_size, len(self.buffer))
+            batch = [self.buffer.popleft()[1] for i in range(n)]
+            self.cond.notify_all() # wake up blocked insert()
+            return batch
+
+    def connect(self):
+        with self.cond:
+            if self.pool is None:
+                sys.stderr.write('Connecting to db {0}:{1} as user {2} (pool of {3})\n'\
+                    .format(DBHOST, DBNAME, DBUSER, self.pool_size))
+                self.pool = psycopg2.pool.ThreadedConnectionPool(1, self.pool_size + QUERY_CONNECTIONS,
+                    host=DBHOST, dbname=DBNAME, user=DBUSER, password=DBPWD)
+                self.created = False
+            pool = self.pool
+        if not self.created:
+            conn = pool.getconn()
+            try:
+                with conn.cursor() as cs:
+                    dbCreate(cs, self.schema)
+                conn.commit()
+                self.created = True
+            except:
+                conn.rollback()
+                raise
+            finally:
+                pool.putconn(conn)
+        return pool
+
+    def write(self, rows):
+        pool = self.connect()
+        conn = pool.getconn()
+        broken = False
+        try:
+            with conn.cursor() as cs:
+                if self.schema == 2:
+                    self.write_samples(conn, cs, rows)
+                else:
+                    psycopg2.extras.execute_values(cs, "INSERT INTO {tn} ("\
+                        "date, source, data"\
+                        ") VALUES %s ON CONFLICT DO NOTHING".format(tn=TABLE), rows, page_size=len(rows))
+            conn.commit()
+        except:
+            self.devices.clear() # new devices may have been rolled back
+            broken = conn.closed != 0
+            if not broken:
+                try: conn.rollback()
+                except: broken = True
+            raise
+        finally:
+            pool.putconn(conn, close=broken)
+
+    def write_samples(self, conn, cs, rows):
+        samples = samplesRows(cs, rows, self.devices)
+        conn.commit() # new devices
+        months = set(str(row[0])[:7] for row in samples) - self.partitions
+        if months:
+            with self.partition_lock:
+                for month in months:
+                    dbCreatePartition(cs, month)
+                conn.commit()
+                self.partitions |= months
+        psycopg2.extras.execute_values(cs, "INSERT INTO {sn} ("\
+            "date, device, value"\
+            ") VALUES %s ON CONFLICT DO NOTHING".format(sn=SAMPLES), samples, page_size=len(samples))
+
+    # run a read-only query through the pool, returns all rows
+    def query(self, sql, params=None):
+        pool = self.connect()
+        conn = pool.getconn()
+        broken = False
+        try:
+            with conn.cursor() as cs:
+                cs.execute(sql, params)
+                rows = cs.fetchall()
+            conn.rollback() # end of read-only transaction
+            return rows
+        except:
+            broken = conn.closed != 0
+            if not broken:
+                try: conn.rollback()
+                except: broken = True
+            raise
+        finally:
+            pool.putconn(conn, close=broken)
+
+    # run one statement through the pool and commit it, returns rows affected
+    def execute(self, sql, params=None):
+        pool = self.connect()
+        conn = pool.getconn()
+        broken = False
+        try:
+            with conn.cursor() as cs:
+                cs.execute(sql, params)
+                rowcount = cs.rowcount
+            conn.commit()
+            return rowcount
+        except:
+            broken = conn.closed != 0
+            if not broken:
+                try: conn.rollback()
+                except: broken = True
+            raise
+        finally:
+            pool.putconn(conn, close=broken)
+
+    # insert rows with statements (sql with VALUES %s, rows) in one transaction
+    def execute_values(self, statements):
+        pool = self.connect()
+        conn = pool.getconn()
+        broken = False
+        try:
+            with conn.cursor() as cs:
+                for sql, rows in statements:
+                    psycopg2.extras.execute_values(cs, sql, rows, page_size=BATCH_SIZE)
+            conn.commit()
+        except:
+            broken = conn.closed != 0
+            if not broken:
+                try: conn.rollback()
+                except: broken = True
+            raise
+        finally:
+            pool.putconn(conn, close=broken)
+
+    def write_rows(self, rows):
+        # write rows one by one, skipping rows rejected by the database
+        written = 0
+        for row in rows:
+            try:
+                self.write([row])
+                written += 1
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                raise
+            except psycopg2.DatabaseError:
+                print_exc(sys._getframe().f_code.co_name, 'row {}: '.format(row[:2]))
+        return written
+
+    # write one batch, raises exception only if database is not available
+    def write_batch(self, rows):
+        t = time.monotonic()
+        try:
+            self.write(rows)
+            written = len(rows)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
+        except psycopg2.DatabaseError:
+            # invalid data in batch
+            written = self.write_rows(rows)
+        self.flushed(len(rows), written, time.monotonic() - t)
+        return written
+
+    def flushed(self, rows, written, t):
+        with self.cond:
+            self.written += written
+            self.failed += rows - written
+            self.flushes += 1
+            self.flush_time += t
+            self.last_flush_time = t
+            self.last_batch_size = rows
+            self.batch_sizes.observe(rows)
+            self.flush_seconds.observe(t)
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None: return
+            try:
+                self.write_batch(batch)
+            except:
+                print_exc(sys._getframe().f_code.co_name)
+                with self.cond:
+                    # put rows back (if there is room) and try again later
+                    kept = max(0, min(len(batch), self.buffer_size - len(self.buffer)))
+                    now = time.monotonic()
+                    for row in reversed(batch[:kept]):
+                        self.buffer.appendleft((now, row))
+                    self.failed += len(batch) - kept
+                    if not self.running: return
+                    self.cond.wait(RETRY_DELAY)
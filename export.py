@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor export formats (served on /api/export)
+# Rows are (time msec, device_id, value of keys[0], value of keys[1], ...),
+# as read by database.DBExport. Each format encodes a chunk of rows at a
+# time, so that the response is streamed without keeping it in memory.
+# Parquet and Arrow need pyarrow (optional, "pip install pyarrow").
+
+import io
+import csv
+import json
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+class Format:
+    content_type = 'application/octet-stream'
+    extension = ''
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.columns = ['time', 'device_id'] + list(keys)
+
+    # bytes before the first chunk
+    def begin(self):
+        return b''
+
+    # bytes of a chunk of rows
+    def chunk(self, rows):
+        raise NotImplementedError
+
+    # bytes after the last chunk
+    def end(self):
+        return b''
+
+# one JSON object per line
+class NDJSONFormat(Format):
+    content_type = 'application/x-ndjson'
+    extension = 'ndjson'
+
+    def chunk(self, rows):
+        columns = self.columns
+        return ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows).encode('utf-8')
+
+class CSVFormat(Format):
+    content_type = 'text/csv; charset=utf-8'
+    extension = 'csv'
+
+    def __init__(self, keys):
+        Format.__init__(self, keys)
+        self.buf = io.StringIO()
+        self.writer = csv.writer(self.buf, lineterminator='\n')
+
+    def take(self):
+        data = self.buf.getvalue().encode('utf-8')
+        self.buf.seek(0); self.buf.truncate()
+        return data
+
+    def begin(self):
+        self.writer.writerow(self.columns)
+        return self.take()
+
+    def chunk(self, rows):
+        self.writer.writerows(rows)
+        return self.take()
+
+# file-like object collecting bytes written by pyarrow writers
+class Sink:
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+# typed columns: time as UTC timestamp, device_id as string, values as float64
+class ArrowFormat(Format):
+    content_type = 'application/vnd.apache.arrow.stream'
+    extension = 'arrows'
+
+    def __init__(self, keys):
+        Format.__init__(self, keys)
+        self.schema = pyarrow.schema([('time', pyarrow.timestamp('ms', tz='UTC')), ('device_id', pyarrow.string())] +
+                                     [(key, pyarrow.float64()) for key in keys])
+        self.sink = Sink()
+        self.writer = None
+
+    def open_writer(self):
+        return pyarrow.ipc.new_stream(self.sink, self.schema)
+
+    def begin(self):
+        self.writer = self.open_writer()
+        return self.sink.take()
+
+    def chunk(self, rows):
+        columns = list(zip(*rows))
+        batch = pyarrow.record_batch([pyarrow.array(column, type=field.type)
+                                      for column, field in zip(columns, self.schema)], schema=self.schema)
+        self.writer.write_batch(batch)
+        return self.sink.take()
+
+    def end(self):
+        self.writer.close()
+        return self.sink.take()
+
+# one row group per chunk
+class ParquetFormat(ArrowFormat):
+    content_type = 'application/vnd.apache.parquet'
+    extension = 'parquet'
+
+    def open_writer(self):
+        return pyarrow.parquet.ParquetWriter(self.sink, self.schema)
+
+FORMATS = {
+    'ndjson': NDJSONFormat,
+    'csv': CSVFormat,
+    'arrow': ArrowFormat,
+    'parquet': ParquetFormat
+}
+
+# formats which can be used with installed modules
+def available(name):
+    return name in FORMATS and (pyarrow is not None or not issubclass(FORMATS[name], ArrowFormat))
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor hotplug of serial devices
+# Directory of serial devices (/dev) is watched with inotify (Linux, through
+# ctypes), so that a reader is restarted as soon as its USB device is plugged
+# in again instead of after its restart delay. Watcher() raises OSError where
+# inotify is not available; the server polls for devices then.
+
+import os
+import struct
+import ctypes
+import ctypes.util
+
+IN_ATTRIB   = 0x00000004 # udev sets owner and mode after device is created
+IN_MOVED_TO = 0x00000080
+IN_CREATE   = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC  = 0o2000000
+EVENT = struct.Struct('iIII') # wd, mask, cookie, len (of name)
+
+class Watcher:
+    def __init__(self, path):
+        self.path = path
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1: ' + os.strerror(ctypes.get_errno()))
+        if libc.inotify_add_watch(self.fd, path.encode(), IN_CREATE | IN_ATTRIB | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch {}: {}'.format(path, os.strerror(errno)))
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    # paths of devices which were created or changed, [] if there are no events
+    def read(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        paths = []
+        pos = 0
+        while pos + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0').decode('utf-8', 'replace')
+            pos += length
+            if name:
+                paths.append(os.path.join(self.path, name))
+        return paths
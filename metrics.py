@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor metrics in Prometheus text format (served on /metrics)
+# Counters on the hot path are plain integer attributes of the objects they
+# belong to (sensors, clients, DB writer), histograms only do one bisect and
+# two additions per observation; everything else is collected when /metrics
+# is requested.
+
+import os
+from bisect import bisect_left
+
+PREFIX = 'bluesensor_'
+
+# latency buckets in seconds, size buckets in rows or bytes
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+BYTE_BUCKETS = (0, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1) # last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def label_text(labels):
+    if not labels: return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels.items()) + '}'
+
+# Builder of one /metrics response
+class Exposition:
+    def __init__(self):
+        self.lines = []
+
+    # samples are (labels dict, value)
+    def metric(self, name, kind, help, samples):
+        name = PREFIX + name
+        self.lines.append('# HELP {} {}'.format(name, help))
+        self.lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            self.lines.append('{}{} {}'.format(name, label_text(labels), value))
+
+    def counter(self, name, help, samples):
+        self.metric(name, 'counter', help, samples)
+
+    def gauge(self, name, help, samples):
+        self.metric(name, 'gauge', help, samples)
+
+    # histograms are (labels dict, Histogram)
+    def histogram(self, name, help, histograms):
+        name = PREFIX + name
+        self.lines.append('# HELP {} {}'.format(name, help))
+        self.lines.append('# TYPE {} histogram'.format(name))
+        for labels, h in histograms:
+            counts = list(h.counts) # copy, may be updated by other threads
+            total = 0
+            for bound, count in zip(h.buckets + ('+Inf',), counts):
+                total += count
+                le = dict(labels); le['le'] = bound
+                self.lines.append('{}_bucket{} {}'.format(name, label_text(le), total))
+            self.lines.append('{}_sum{} {}'.format(name, label_text(labels), h.sum))
+            self.lines.append('{}_count{} {}'.format(name, label_text(labels), total))
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+# resident memory of this process in bytes (Linux), None if unknown
+def process_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except:
+        return None
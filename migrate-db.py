@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# Migration of BlueSensor database from table DATA (schema 1, whole JSON per
+# measurement) to typed tables DEVICES, SENSORS and SAMPLES partitioned by
+# month (schema 2, see database.py). Run bluesensor-server.py with
+# "--db-schema 2" after migration.
+# Usage: "python migrate-db.py --source-tz <zone> [--utc-after <id>] [--batch <n>] [--drop]"
+# Migration can be interrupted and started again, it continues after the last
+# migrated row. With --drop table DATA is removed when all rows are migrated.
+# Dates in table DATA saved by older versions are local time of the server,
+# new tables have UTC: --source-tz (for example "Europe/Ljubljana", or "UTC"
+# when all dates are UTC) is time zone of old dates, which are converted to
+# UTC; rows with ID greater than --utc-after <id> were saved in UTC. Rows
+# are read in order of ID, so the hour repeated when daylight saving time
+# ends is converted to two different UTC hours.
+
+import sys
+import traceback
+import time
+import datetime
+import zoneinfo
+import psycopg2
+
+import database as db
+
+BATCH = 10000 # rows read and written at once
+STATE = 'migration' # table with ID of the last migrated row
+
+def print_exc(f_name, msg=''):
+    exc_type, exc_obj, exc_tb = sys.exc_info()
+    exc = traceback.format_exception_only(exc_type, exc_obj)
+    err = '{}({}): {}'.format(f_name, exc_tb.tb_lineno, msg) + exc[-1].strip()
+    sys.stderr.write(err + '\n')
+    sys.stderr.flush()
+
+def connect():
+    conn = psycopg2.connect(host=db.DBHOST, dbname=db.DBNAME, user=db.DBUSER, password=db.DBPWD)
+    return conn
+
+def table_size(cs, table):
+    # size of table with indexes (and partitions)
+    cs.execute("SELECT coalesce(sum(pg_total_relation_size(relid)), pg_total_relation_size(%s::regclass)) "\
+        "FROM pg_partition_tree(%s::regclass)", (table, table))
+    return int(cs.fetchone()[0])
+
+# local time dt of row with ID row_id to UTC; last is {source: last UTC date}
+def to_utc(row_id, source, dt, last):
+    if source_tz is None or (utc_after is not None and row_id > utc_after):
+        return dt
+    utc = dt.replace(tzinfo=source_tz).astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    prev = last.get(source)
+    if prev is not None and utc < prev:
+        # second occurrence of an hour repeated when daylight saving time ends
+        later = dt.replace(tzinfo=source_tz, fold=1).astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        if later >= prev: utc = later
+    last[source] = utc
+    return utc
+
+def usage():
+    sys.stderr.write('Usage: python migrate-db.py --source-tz <zone> [--utc-after <id>] [--batch <n>] [--drop]\n')
+    sys.exit(1)
+
+batch = BATCH; drop = False; source_tz = False; utc_after = None
+args = sys.argv[1:]
+while args:
+    arg = args.pop(0)
+    if arg == '--batch' and args:
+        try:
+            batch = max(1, int(args.pop(0)))
+        except ValueError:
+            sys.stderr.write('Error: invalid batch size\n')
+            sys.exit(1)
+    elif arg == '--source-tz' and args:
+        name = args.pop(0)
+        try:
+            source_tz = None if name.upper() == 'UTC' else zoneinfo.ZoneInfo(name)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            sys.stderr.write('Error: unknown time zone \'{}\'\n'.format(name))
+            sys.exit(1)
+    elif arg == '--utc-after' and args:
+        try:
+            utc_after = int(args.pop(0))
+        except ValueError:
+            sys.stderr.write('Error: invalid row ID\n')
+            sys.exit(1)
+    elif arg == '--drop':
+        drop = True
+    else:
+        sys.stderr.write('Error: unknown argument \'{}\'\n'.format(arg))
+        usage()
+if source_tz is False:
+    sys.stderr.write('Error: --source-tz is required, dates of old rows are local time of the server\n')
+    usage()
+
+try:
+    writer = db.DBWriter(batch_size=batch, schema=2)
+    writer.connect() # creates tables of schema 2
+
+    state = connect()
+    state.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    scs = state.cursor()
+    scs.execute("CREATE TABLE IF NOT EXISTS {st} (name text PRIMARY KEY, last_id integer)".format(st=STATE))
+    scs.execute("SELECT last_id FROM {st} WHERE name = %s".format(st=STATE), (db.TABLE,))
+    row = scs.fetchone()
+    last_id = row[0] if row else 0
+    scs.execute("SELECT count(*) FROM {tn} WHERE id > %s".format(tn=db.TABLE), (last_id,))
+    total = scs.fetchone()[0]
+    sys.stderr.write('Migrating {} rows of table {} after ID {}\n'.format(total, db.TABLE, last_id))
+    sys.stderr.flush()
+
+    src = connect()
+    cs = src.cursor(name='migrate') # server-side cursor
+    cs.itersize = batch
+    cs.execute("SELECT id, date, source, data FROM {tn} WHERE id > %s ORDER BY id"\
+        .format(tn=db.TABLE), (last_id,))
+    done = 0; t = time.monotonic(); last = {}
+    while True:
+        rows = cs.fetchmany(batch)
+        if not rows: break
+        writer.write_batch([(to_utc(r[0], r[2], r[1], last), r[2], r[3]) for r in rows])
+        last_id = rows[-1][0]
+        scs.execute("INSERT INTO {st} (name, last_id) VALUES (%s, %s) "\
+            "ON CONFLICT (name) DO UPDATE SET last_id = EXCLUDED.last_id".format(st=STATE),
+            (db.TABLE, last_id))
+        done += len(rows)
+        sys.stderr.write('{}/{} rows ({:.0f} rows/s)\n'.format(done, total, done/max(time.monotonic() - t, 0.001)))
+        sys.stderr.flush()
+    cs.close()
+    src.close()
+
+    if writer.failed:
+        sys.stderr.write('{} rows could not be migrated\n'.format(writer.failed))
+    old_size = table_size(scs, db.TABLE)
+    new_size = table_size(scs, db.SAMPLES) + table_size(scs, db.DEVICES) + table_size(scs, db.SENSORS)
+    sys.stderr.write('Size of table {}: {:.1f} MB, size of new tables: {:.1f} MB\n'\
+        .format(db.TABLE, old_size/1e6, new_size/1e6))
+    if drop and not writer.failed:
+        sys.stderr.write('Removing table {}\n'.format(db.TABLE))
+        scs.execute("DROP TABLE {tn}".format(tn=db.TABLE))
+        scs.execute("DELETE FROM {st} WHERE name = %s".format(st=STATE), (db.TABLE,))
+    sys.stderr.flush()
+    writer.stop()
+    state.close()
+except KeyboardInterrupt:
+    sys.stderr.write('Interrupted, run again to continue\n')
+    sys.exit(1)
+except:
+    print_exc('migrate-db')
+    sys.exit(2)
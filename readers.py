@@ -0,0 +1,513 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor data readers
+# Every reader parses data of one device connected to USB port and returns
+# measurements as dicts in our JSON format. Readers are run by
+# bluesensor-server.py in-process (serial port is watched by IOLoop), or
+# in separate processes by read-serial.py, read-raw-serial.py and
+# read-dust.py, which print measurements as JSON lines to stdout. Data of
+# serial port can be captured into a file and replayed (see capture.py).
+
+import sys, os
+import traceback
+import time
+import serial
+import json
+import random
+import struct
+import socket
+
+from timing import clock, Schedule
+import capture
+import agent
+
+if sys.platform.startswith('win'):
+    DEVNAME = 'COM'
+elif sys.platform.startswith('darwin'):
+    DEVNAME = '/dev/tty.'
+else: # linux
+    DEVNAME = '/dev/ttyUSB'
+
+def print_exc(f_name, msg=''):
+    exc_type, exc_obj, exc_tb = sys.exc_info()
+    exc = traceback.format_exception_only(exc_type, exc_obj)
+    err = '{}({}): {}'.format(f_name, exc_tb.tb_lineno, msg) + exc[-1].strip()
+    sys.stderr.write(err + '\n')
+    sys.stderr.flush()
+
+def number(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return v
+
+# Readers are driven by arrival of data from device, measurements are
+# timestamped with monotonic time (ns) when their data was received (see
+# timing.Clock); times of one reader are strictly increasing (measurements
+# decoded from one read get consecutive milliseconds), because time is
+# part of the key of a row in database. rate (per second) is
+# rate of simulated measurements (default 1), or of polling for devices
+# which are polled.
+class Reader:
+    label = 'JSON' # kind of data, for messages
+    rate = 1.0     # simulated measurements per second
+    values = 0     # number of simulated values
+    poll_interval = None # seconds between poll() commands, None if not polled
+
+    def __init__(self, port, simulate=False, rate=None):
+        self.port = port
+        self.simulate = simulate
+        if rate is not None:
+            self.rate = float(rate)
+            if not self.rate > 0:
+                raise ValueError('rate must be positive')
+        self.serial = None
+        self.va = [None]*self.values
+        self.last_time = 0 # msec of last measurement
+
+    # msec since epoch of measurement received at monotonic time t (ns),
+    # later than time of previous measurement
+    def timestamp(self, t=None):
+        ms = clock.ms(t)
+        if ms <= self.last_time:
+            ms = self.last_time + 1
+        self.last_time = ms
+        return ms
+
+    # open serial port, non-blocking reads are done from fileno()
+    def open(self, blocking=True):
+        self.serial = serial.Serial(port=self.port, baudrate=9600, parity=serial.PARITY_NONE,
+                                    stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS,
+                                    timeout=None if blocking else 0)
+        return self.serial
+
+    def close(self):
+        if self.serial is not None:
+            try: self.serial.close()
+            except: pass
+            self.serial = None
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    # bytes written to device after it is opened
+    def start_commands(self):
+        return b''
+
+    # bytes written to device every poll_interval seconds
+    def poll(self):
+        return b''
+
+    # bytes read from serial port at monotonic time received (ns)
+    # -> list of complete measurements
+    def feed(self, data, received=None):
+        raise NotImplementedError
+
+    # counters of reader, {name: value}
+    def stats(self):
+        return {}
+
+    # one simulated measurement at monotonic time t (ns)
+    def simulated(self, t=None):
+        raise NotImplementedError
+
+    def sim_value(self, n, max, fluc):
+        va = self.va
+        plus = random.random() > 0.5
+        diff = random.random()*(max*fluc/100)
+        if va[n] is None: va[n] = max/2
+        if plus: va[n] += diff
+        else: va[n] -= diff
+        if va[n] > max: va[n] -= 2*diff
+        elif va[n] < 0: va[n] += 2*diff
+        return va[n]
+
+# Reader of line based data, parse_line() converts one line to measurement
+class LineReader(Reader):
+    def __init__(self, port, simulate=False, rate=None):
+        Reader.__init__(self, port, simulate, rate)
+        self.buf = b''
+        self.errors = 0 # lines which could not be parsed
+
+    def feed(self, data, received=None):
+        lines = (self.buf + data).split(b'\n')
+        self.buf = lines.pop() # incomplete line, if any
+        measurements = []
+        for line in lines:
+            line = line.strip()
+            if not line: continue
+            try:
+                measurement = self.parse_line(line.decode('utf-8', 'replace'), received)
+                if measurement is not None:
+                    measurements.append(measurement)
+            except:
+                self.errors += 1
+                print_exc(sys._getframe().f_code.co_name, '{}: '.format(self.port))
+        return measurements
+
+    def stats(self):
+        return {'parse_errors': self.errors}
+
+    def parse_line(self, line, received=None):
+        raise NotImplementedError
+
+# JSON data from BlueSensor
+class SerialReader(LineReader):
+    values = 6
+
+    def parse_line(self, line, received=None):
+        data = json.loads(line)
+        if not isinstance(data, dict):
+            raise ValueError('JSON object expected')
+        if data.get('time') is None or data['time'] == 0:
+            data['time'] = self.timestamp(received)
+        return data
+
+    def simulated(self, t=None):
+        return {
+            "metadata": {
+                "device_name": "Serial sensor",
+                "device_id": "SER1",
+                "device_location": "IJS",
+                "sensors": {
+                    "gas1": ["Gas 1", "Gas 1", "raw value", "black"],
+                    "gas2": ["Gas 2", "Gas 2", "raw value", "green"],
+                    "humidity": ["Hum 1", "DHT-22", "%", "blue"],
+                    "temp1": ["Temp 1", "DHT-22", "°C", "orange"],
+                    "temp2": ["Temp 2", "DS18B20", "°C", "red"],
+                    "temp3": ["Temp 3", "DS18B20", "°C", "yellow"]
+                }
+            },
+            "time": self.timestamp(t),
+            "data": {
+                "gas1": round(self.sim_value(0, 10, 20), 2),
+                "gas2": round(self.sim_value(1, 10, 20), 2),
+                "humidity": round(self.sim_value(2, 100, 5), 2),
+                "temp1": round(self.sim_value(3, 50, 2), 2),
+                "temp2": round(self.sim_value(4, 50, 2), 2),
+                "temp3": round(self.sim_value(5, 50, 2), 2)
+            }
+        }
+
+# raw (comma-delimited) data: device name, device ID, location and
+# (label, value) of gas1, gas2, humidity, temp1, temp2 and temp3
+class RawSerialReader(LineReader):
+    label = 'RAW'
+    values = 6
+
+    def parse_line(self, line, received=None):
+        return self.measurement(line.split(','), received)
+
+    def measurement(self, values, t=None):
+        return {
+            "metadata": {
+                "device_name": str(values[0]),
+                "device_id": str(values[1]),
+                "device_location": str(values[2]),
+                "sensors": {
+                    "gas1": [str(values[3]), "Gas 1", "raw value", "black"],
+                    "gas2": [str(values[5]), "Gas 2", "raw value", "green"],
+                    "humidity": [str(values[7]), "DHT-22", "%", "blue"],
+                    "temp1": [str(values[9]), "DHT-22", "°C", "orange"],
+                    "temp2": [str(values[11]), "DS18B20", "°C", "red"],
+                    "temp3": [str(values[13]), "DS18B20", "°C", "yellow"]
+                }
+            },
+            "time": self.timestamp(t),
+            "data": {
+                "gas1": round(number(values[4]), 2),
+                "gas2": round(number(values[6]), 2),
+                "humidity": round(number(values[8]), 2),
+                "temp1": round(number(values[10]), 2),
+                "temp2": round(number(values[12]), 2),
+                "temp3": round(number(values[14]), 2)
+            }
+        }
+
+    def simulated(self, t=None):
+        return self.measurement([
+            'Raw sensor', 'RAW1', 'IJS',
+            'Gas 1', self.sim_value(0, 10, 20),
+            'Gas 2', self.sim_value(1, 10, 20),
+            'Hum 1', self.sim_value(2, 100, 5),
+            'Temp 1', self.sim_value(3, 50, 2),
+            'Temp 2', self.sim_value(4, 50, 2),
+            'Temp 3', self.sim_value(5, 50, 2)
+        ], t)
+
+# SDS011, SDS018 and SDS021 dust sensors
+# Forked from: https://github.com/aqicn/sds-sensor-reader
+# For Arduino code see: https://github.com/FriskByBergen/SDS011
+# Frames from sensor are 10 bytes: 0xAA, command (0xC0 data, 0xC5 reply to
+# command), 6 data bytes, checksum (sum of data bytes) and 0xAB. Data frame
+# has PM2.5 and PM10 in 0.1 ug/m3 (little endian) and 2 bytes of device ID.
+# Commands to sensor are 19 bytes: 0xAA, 0xB4, command, 12 data bytes,
+# device ID (0xFFFF for all), checksum and 0xAB.
+
+SDS_HEAD     = 0xAA
+SDS_TAIL     = 0xAB
+SDS_DATA     = 0xC0
+SDS_REPLY    = 0xC5
+SDS_FRAME    = 10
+SDS_MODE     = 2 # command: set reporting mode (0 active, 1 query)
+SDS_QUERY    = 4 # command: query data
+SDS_SLEEP    = 6 # command: set sleep (0) or work (1)
+SDS_PERIOD   = 8 # command: set working period in minutes (0 continuous)
+SDS_MODES    = ('active', 'query')
+SDS_BATCH    = 256 # frames unpacked at once
+SDS_STRUCT   = struct.Struct('<BBHHHBB') # head, command, pm25, pm10, device ID, checksum, tail
+
+# Decode frames in buf (bytes or bytearray) from position pos on, returns
+# (list of (pm25, pm10), position after last complete frame, number of
+# corrupt frames, number of skipped bytes). Bytes after the returned
+# position may be start of a frame and must be kept for the next call.
+# Consecutive frames are unpacked in bulk, a bad frame makes decoder
+# resynchronize on the next header byte.
+def sds_decode(buf, pos=0):
+    values = []; corrupt = 0; skipped = 0
+    n = len(buf)
+    while pos < n:
+        i = buf.find(SDS_HEAD, pos)
+        if i < 0:
+            skipped += n - pos
+            pos = n
+            break
+        skipped += i - pos
+        pos = i
+        frames = min((n - i) // SDS_FRAME, SDS_BATCH)
+        if not frames: break # incomplete frame
+        for head, cmd, pm25, pm10, device, checksum, tail in \
+                SDS_STRUCT.iter_unpack(buf[i:i + frames*SDS_FRAME]):
+            if head != SDS_HEAD or tail != SDS_TAIL or (cmd != SDS_DATA and cmd != SDS_REPLY) or \
+                    ((pm25 & 0xFF) + (pm25 >> 8) + (pm10 & 0xFF) + (pm10 >> 8) +
+                     (device & 0xFF) + (device >> 8)) & 0xFF != checksum:
+                if head == SDS_HEAD and (cmd == SDS_DATA or cmd == SDS_REPLY):
+                    corrupt += 1
+                skipped += 1
+                pos += 1
+                break
+            if cmd == SDS_DATA:
+                values.append((pm25/10, pm10/10))
+            pos += SDS_FRAME
+    return values, pos, corrupt, skipped
+
+# command frame for sensor
+def sds_command(cmd, data=(), device=0xFFFF):
+    frame = bytearray(19)
+    frame[0] = SDS_HEAD; frame[1] = 0xB4; frame[2] = cmd
+    frame[3:3 + len(data)] = bytes(data)
+    frame[15] = device & 0xFF; frame[16] = device >> 8
+    frame[17] = sum(frame[2:17]) & 0xFF
+    frame[18] = SDS_TAIL
+    return bytes(frame)
+
+class SDS021_Reader(Reader):
+    label = 'DUST'
+    values = 2
+
+    # mode is "active" (sensor reports every second) or "query" (data is
+    # queried <rate> times per second), period is working period in minutes
+    # (sensor sleeps between measurements, 0 for continuous), None leaves
+    # the setting of sensor as it is
+    def __init__(self, port, simulate=False, rate=None, mode=None, period=None):
+        Reader.__init__(self, port, simulate, rate)
+        if mode is not None and mode not in SDS_MODES:
+            raise ValueError('unknown mode {}'.format(mode))
+        self.mode = mode
+        self.period = None if period is None else min(max(int(period), 0), 30)
+        if mode == 'query':
+            self.poll_interval = 1.0/self.rate
+        self.buf = bytearray()
+        self.frames = 0  # valid data frames
+        self.corrupt = 0 # frames with bad checksum or tail
+        self.dropped = 0 # bytes which are not part of any frame
+
+    def start_commands(self):
+        commands = b''
+        if self.mode is not None:
+            commands += sds_command(SDS_SLEEP, (1, 1)) # wake up
+            commands += sds_command(SDS_MODE, (1, SDS_MODES.index(self.mode)))
+        if self.period is not None:
+            commands += sds_command(SDS_PERIOD, (1, self.period))
+        return commands
+
+    def poll(self):
+        return sds_command(SDS_QUERY)
+
+    def feed(self, data, received=None):
+        buf = self.buf
+        buf += data
+        values, pos, corrupt, skipped = sds_decode(buf)
+        del buf[:pos]
+        self.frames += len(values)
+        self.corrupt += corrupt
+        self.dropped += skipped
+        return [self.measurement(v, received) for v in values]
+
+    def stats(self):
+        return {'frames': self.frames, 'corrupt_frames': self.corrupt, 'dropped_bytes': self.dropped}
+
+    def measurement(self, values, t=None):
+        return {
+            "metadata": {
+                "device_name": "Senzor trdnih delcev",
+                "device_id": "DUST1",
+                "device_location": "IJS",
+                "sensors": {
+                    "pm25": ["PM 2.5", "SDS021", "ug/m3", "red"],
+                    "pm10": ["PM 10", "SDS021", "ug/m3", "blue"]
+                }
+            },
+            "time": self.timestamp(t),
+            "data": {
+                "pm25": round(values[0], 2),
+                "pm10": round(values[1], 2)
+            }
+        }
+
+    def simulated(self, t=None):
+        return self.measurement([self.sim_value(0, 25, 10), self.sim_value(1, 50, 10)], t)
+
+READERS = {
+    'read-serial': SerialReader,
+    'read-raw-serial': RawSerialReader,
+    'read-dust': SDS021_Reader
+}
+
+# Main loop of reader scripts (subprocess mode): read from serial port
+# <argv[1]> (or simulate with "simulate") and print measurements as JSON
+# lines. With "--capture <file>" data of serial port is also appended to
+# capture file, with "--replay <file>" it is read from capture file instead
+# of serial port, at original pace or "--speed <n>" times faster ("max" for
+# as fast as possible). With "--agent <url>" measurements are sent to
+# central server instead of printed (see agent.py), options "--agent-id",
+# "--agent-spool", "--compression" and "--token" are passed to agent.
+# Other options "--<name> <value>" are passed to reader_class.
+def run(reader_class, argv=sys.argv):
+    # Reopen stdout and stderr with buffer size 0 (unbuffered) - only in python 2.7
+    #sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    #sys.stderr = os.fdopen(sys.stderr.fileno(), 'w', 0)
+
+    if len(argv) == 1:
+        sys.stderr.write('This application must be called with parameter specifying ID of a USB port where BlueSensor is conneccted.\n')
+        sys.stderr.write('For example: "{} 0" for reading from device connected to /dev/ttyUSB0.\n'.format(os.path.basename(argv[0])))
+        sys.stderr.flush()
+        sys.exit()
+
+    usbport = DEVNAME + argv[1] # can be 'usbserialxxx' on Mac
+    simulate = False; options = {}
+    args = argv[2:]
+    while args:
+        arg = args.pop(0)
+        if arg == 'simulate':
+            simulate = True
+        elif arg.startswith('--') and args:
+            options[arg[2:]] = args.pop(0)
+        else:
+            if arg.startswith('--'):
+                sys.stderr.write('Error: missing value of {}\n'.format(arg))
+            else:
+                sys.stderr.write('Error: unknown argument \'{}\'\n'.format(arg))
+            sys.stderr.write('Usage: {} <port> [simulate] [--<option> <value> ...]\n'.format(os.path.basename(argv[0])))
+            sys.stderr.flush()
+            sys.exit(1)
+    capture_path = options.pop('capture', None)
+    replay_path = options.pop('replay', None)
+    speed = options.pop('speed', '1')
+    agent_url = options.pop('agent', None)
+    agent_id = options.pop('agent-id', socket.gethostname())
+    agent_spool = options.pop('agent-spool', os.path.join(agent.SPOOL_PATH, os.path.basename(usbport)))
+    compression = options.pop('compression', 'gzip')
+    token = options.pop('token', None)
+    name = [name for name, cls in READERS.items() if cls is reader_class][0]
+    ag = None
+    try:
+        reader = reader_class(usbport, simulate, **options)
+        output = print_measurements
+        if agent_url is not None:
+            ag = agent.Agent(agent_url, agent_id, name, argv[1], agent_spool, compression, token)
+            output = ag.append
+            sys.stderr.write('Sending measurements to {} as {}-{}...\n'.format(agent_url, agent_id, argv[1]))
+        if replay_path is not None:
+            replay(reader, capture.Replay(replay_path, capture.parse_speed(speed)), name, output, ag)
+            return
+        cap = None
+        if not reader.simulate:
+            ser = reader.open()
+            ser.write(reader.start_commands())
+            if capture_path is not None:
+                cap = capture.Capture(capture_path, name, usbport, options)
+    except:
+        print_exc(sys._getframe().f_code.co_name)
+        if ag is not None:
+            ag.stop()
+        sys.exit(1)
+    if not reader.simulate:
+        sys.stderr.write('Reading {} data from {}...\n'.format(reader.label, usbport))
+    else:
+        sys.stderr.write('Reading {} data from simulated {}...\n'.format(reader.label, usbport))
+    sys.stderr.flush()
+
+    schedule = Schedule(reader.rate if reader.simulate else 1.0/(reader.poll_interval or 1))
+    while True:
+        try:
+            if reader.simulate:
+                measurements = [reader.simulated(t) for t in schedule.due()]
+            else:
+                if reader.poll_interval and schedule.due():
+                    ser.write(reader.poll())
+                ser.timeout = schedule.delay() if reader.poll_interval else None
+                # blocks until data is available (or next poll)
+                data = ser.read(ser.in_waiting or 1)
+                received = time.monotonic_ns()
+                if cap is not None and data:
+                    cap.append(data, received)
+                measurements = reader.feed(data, received)
+            output(measurements)
+            if reader.simulate:
+                time.sleep(schedule.delay())
+        except KeyboardInterrupt:
+            if cap is not None:
+                cap.close()
+            if ag is not None:
+                ag.stop()
+            sys.stderr.write('Quit!\n')
+            sys.stderr.flush()
+            sys.exit(0)
+        except:
+            print_exc(sys._getframe().f_code.co_name)
+            time.sleep(1) # wait 1 second
+
+def print_measurements(measurements):
+    for measurement in measurements:
+        sys.stdout.write(json.dumps(measurement) + '\n')
+    if measurements:
+        sys.stdout.flush()
+
+# output measurements of capture file, returns at its end (when agent has
+# sent all of them)
+def replay(reader, rp, name, output=print_measurements, ag=None):
+    if rp.reader != name:
+        raise ValueError('{} is a capture of {}, not {}'.format(rp.path, rp.reader, name))
+    sys.stderr.write('Replaying {} data of {} from {}...\n'.format(reader.label, rp.header.get('port'), rp.path))
+    sys.stderr.flush()
+    try:
+        while not rp.done:
+            measurements = []
+            for data, received in rp.due():
+                measurements += reader.feed(data, received)
+            output(measurements)
+            time.sleep(rp.delay())
+        sys.stderr.write('Replayed {} records\n'.format(rp.records))
+        sys.stderr.flush()
+        if ag is not None:
+            while ag.spool.pending() > 0:
+                time.sleep(0.1)
+            sys.stderr.write('Sent {} measurements\n'.format(ag.sent))
+    except KeyboardInterrupt:
+        sys.stderr.write('Quit!\n')
+    sys.stderr.flush()
+    rp.close()
+    if ag is not None:
+        ag.stop()
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# Rollups of BlueSensor measurements saved before rollups were used (see
+# database.py): buckets which are missing in rollup tables are computed from
+# raw rows (table DATA, or SAMPLES with --schema 2), one day at a time.
+# Buckets which already exist are not changed.
+# Usage: "python rollup-db.py [--schema <n>] [--from <msec>] [--to <msec>]"
+
+import sys
+import traceback
+import time
+
+import database as db
+import timing
+
+DAY = 86400000 # msec of rows rolled up at once
+
+OPTIONS = ('schema', 'from', 'to')
+
+def print_exc(f_name, msg=''):
+    exc_type, exc_obj, exc_tb = sys.exc_info()
+    exc = traceback.format_exception_only(exc_type, exc_obj)
+    err = '{}({}): {}'.format(f_name, exc_tb.tb_lineno, msg) + exc[-1].strip()
+    sys.stderr.write(err + '\n')
+    sys.stderr.flush()
+
+def usage():
+    sys.stderr.write('Usage: python rollup-db.py [--schema <n>] [--from <msec>] [--to <msec>]\n')
+    sys.stderr.flush()
+
+opts = {}
+args = sys.argv[1:]
+while args:
+    arg = args.pop(0)
+    if arg.startswith('--') and arg[2:] in OPTIONS and args:
+        opts[arg[2:]] = args.pop(0)
+    else:
+        usage()
+        sys.exit(1)
+try:
+    schema = int(opts.get('schema', db.SCHEMA))
+    t_from = int(opts['from']) if 'from' in opts else None
+    t_to = int(opts.get('to', timing.now_ms()))
+except ValueError:
+    usage()
+    sys.exit(1)
+
+try:
+    writer = db.DBWriter(schema=schema)
+    if t_from is None:
+        table = db.SAMPLES if schema == 2 else db.TABLE
+        first = writer.query("SELECT min(date) FROM {}".format(table))[0][0]
+        if first is None:
+            sys.stderr.write('No rows in table {}\n'.format(table))
+            sys.exit(0)
+        t_from = int((first - db.msDate(0)).total_seconds()*1000)
+    t_from -= t_from % DAY
+    t = time.monotonic()
+    for day in range(t_from, t_to, DAY):
+        db.dbRebuildRollups(writer, day, min(day + DAY, t_to))
+        sys.stderr.write('{} ({:.1f} s)\n'.format(timing.utc_datetime(day).date(), time.monotonic() - t))
+        sys.stderr.flush()
+    writer.stop()
+except KeyboardInterrupt:
+    sys.stderr.write('Interrupted, run again to continue\n')
+    sys.exit(1)
+except:
+    print_exc('rollup-db')
+    sys.exit(2)
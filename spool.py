@@ -0,0 +1,294 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor durable local spool
+# Measurements are appended to segment files on a local disk first, and a
+# background drainer replays them into the database in batches once it is
+# reachable. Each record is one line: "<date>\t<source>\t<data>\n".
+# Position of the drainer is kept in a checkpoint file, so records are
+# never lost when the server or the database is restarted.
+
+import sys, os, re
+import traceback
+import time
+import json
+from threading import Lock, Condition, Thread, Event
+
+SEGMENT_SIZE = 16*1024*1024   # bytes in one segment file
+MAX_SIZE     = 1024*1024*1024 # max bytes of all segment files
+FSYNC        = 'interval'     # 'always', 'interval' or 'never'
+FSYNC_DELAY  = 1.0            # seconds between fsyncs with FSYNC = 'interval'
+DRAIN_BATCH  = 1000           # max records written to database at once
+READ_SIZE    = 1024*1024      # bytes read from segment file at once
+RETRY_DELAY  = 1              # seconds to wait after first failed write
+RETRY_MAX    = 60             # max seconds between retries
+
+SEGMENT_RE = re.compile(r'^(\d{16})\.spool$')
+
+def print_exc(f_name, msg=''):
+    exc_type, exc_obj, exc_tb = sys.exc_info()
+    exc = traceback.format_exception_only(exc_type, exc_obj)
+    err = '{}({}): {}'.format(f_name, exc_tb.tb_lineno, msg) + exc[-1].strip()
+    sys.stderr.write(err + '\n')
+    sys.stderr.flush()
+
+class Spool:
+    def __init__(self, path, segment_size=SEGMENT_SIZE, max_size=MAX_SIZE,
+                 fsync=FSYNC, fsync_delay=FSYNC_DELAY):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max(max_size, 2*segment_size)
+        self.fsync = fsync
+        self.fsync_delay = fsync_delay
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        self.fd = None
+        self.dirty = False
+        self.appended = 0 # records
+        self.lost = 0     # records removed by size cap before they were drained
+        os.makedirs(path, exist_ok=True)
+        self.segments = sorted(int(m.group(1)) for m in
+            (SEGMENT_RE.match(f) for f in os.listdir(path)) if m)
+        self.sizes = dict((seq, os.path.getsize(self.segment_file(seq))) for seq in self.segments)
+        # records per segment are counted once here and then as they are
+        # appended, so size cap never reads segment files
+        self.counts = dict((seq, self.count_records(seq)) for seq in self.segments)
+        self.checkpoint = self.load_checkpoint()
+        cp_seq, cp_offset = self.checkpoint
+        # drained records of checkpoint's segment
+        self.cp_records = self.count_records(cp_seq, cp_offset) if cp_seq in self.sizes else 0
+        self.open_segment((self.segments[-1] + 1) if self.segments else 1)
+
+    def segment_file(self, seq):
+        return os.path.join(self.path, '{:016d}.spool'.format(seq))
+
+    def load_checkpoint(self):
+        try:
+            with open(os.path.join(self.path, 'checkpoint')) as f:
+                cp = json.load(f)
+            return (int(cp['segment']), int(cp['offset']))
+        except FileNotFoundError:
+            pass
+        except:
+            print_exc(sys._getframe().f_code.co_name)
+        return (self.segments[0] if self.segments else 1, 0)
+
+    def save_checkpoint(self, seq, offset):
+        cp_file = os.path.join(self.path, 'checkpoint')
+        with open(cp_file + '.tmp', 'w') as f:
+            json.dump({'segment': seq, 'offset': offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(cp_file + '.tmp', cp_file)
+
+    def open_segment(self, seq):
+        # called with lock held (or from __init__)
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+        self.fd = os.open(self.segment_file(seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.seq = seq
+        if seq not in self.sizes:
+            self.segments.append(seq)
+            self.sizes[seq] = 0
+            self.counts[seq] = 0
+
+    def append(self, date, source, data):
+        record = '{}\t{}\t{}\n'.format(date, source, data).encode('utf-8')
+        with self.lock:
+            if self.sizes[self.seq] >= self.segment_size:
+                self.open_segment(self.seq + 1)
+                self.enforce_size()
+            os.write(self.fd, record)
+            self.sizes[self.seq] += len(record)
+            self.counts[self.seq] += 1
+            self.appended += 1
+            if self.fsync == 'always':
+                os.fsync(self.fd)
+            else:
+                self.dirty = True
+            self.cond.notify_all()
+
+    def enforce_size(self):
+        # remove oldest segments when spool is bigger than max_size
+        while sum(self.sizes.values()) > self.max_size and len(self.segments) > 1:
+            seq = self.segments.pop(0)
+            self.sizes.pop(seq)
+            count = self.counts.pop(seq)
+            cp_seq, cp_offset = self.checkpoint
+            if cp_seq <= seq:
+                lost = count - (self.cp_records if cp_seq == seq else 0)
+                self.lost += lost
+                self.checkpoint = (self.segments[0], 0)
+                self.cp_records = 0
+                sys.stderr.write('Spool is full, removed {} records not yet saved\n'.format(lost))
+                sys.stderr.flush()
+            try: os.remove(self.segment_file(seq))
+            except: print_exc(sys._getframe().f_code.co_name)
+
+    # records in the first <size> bytes of segment (whole segment without size)
+    def count_records(self, seq, size=None):
+        try:
+            count = 0
+            with open(self.segment_file(seq), 'rb') as f:
+                while size is None or size > 0:
+                    chunk = f.read(READ_SIZE if size is None else min(READ_SIZE, size))
+                    if not chunk: break
+                    count += chunk.count(b'\n')
+                    if size is not None: size -= len(chunk)
+            return count
+        except:
+            return 0
+
+    def sync(self):
+        # fsync of a duplicate, so that open_segment() and close() can close
+        # self.fd meanwhile and append() doesn't wait for the disk
+        with self.lock:
+            if not self.dirty or self.fd is None: return
+            self.dirty = False
+            fd = os.dup(self.fd)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.fsync(self.fd)
+                os.close(self.fd)
+                self.fd = None
+
+    def pending(self):
+        # bytes not yet written to database
+        with self.lock:
+            cp_seq, cp_offset = self.checkpoint
+            return sum(size for seq, size in self.sizes.items() if seq >= cp_seq) - cp_offset
+
+    def stats(self):
+        return {
+            'segments': len(self.segments),
+            'size': sum(self.sizes.values()),
+            'pending': self.pending(),
+            'appended': self.appended,
+            'lost': self.lost
+        }
+
+    # read up to max_records complete records from the checkpoint on,
+    # returns (records, (segment, offset) after them)
+    def read(self, max_records):
+        with self.lock:
+            seq, offset = self.checkpoint
+            if seq not in self.sizes:
+                later = [s for s in self.segments if s > seq]
+                if not later: return [], self.checkpoint
+                seq, offset = later[0], 0
+            end = self.sizes[seq]
+            last = seq == self.seq
+        if offset >= end:
+            if last: return [], (seq, offset)
+            return [], (seq + 1, 0) # segment drained, continue with next one
+        records = []
+        size = min(end - offset, READ_SIZE)
+        with open(self.segment_file(seq), 'rb') as f:
+            f.seek(offset)
+            buf = f.read(size)
+            while b'\n' not in buf and size < end - offset:
+                buf += f.read(min(end - offset - size, READ_SIZE)) # very long record
+                size = len(buf)
+        pos = 0
+        while len(records) < max_records:
+            nl = buf.find(b'\n', pos)
+            if nl < 0: break
+            line = buf[pos:nl].decode('utf-8', 'replace')
+            pos = nl + 1
+            fields = line.split('\t', 2)
+            if len(fields) == 3:
+                records.append(tuple(fields))
+        if pos == 0 and not last and size >= end - offset:
+            return [], (seq + 1, 0) # torn record at the end of old segment
+        return records, (seq, offset + pos)
+
+    # mark records up to position (<records> records read since the last
+    # commit) as written to database, remove segments which are fully drained
+    def commit(self, position, records=0):
+        seq, offset = position
+        with self.lock:
+            if seq == self.checkpoint[0]:
+                self.cp_records += records
+            else:
+                self.cp_records = records
+            self.checkpoint = position
+            drained = [s for s in self.segments if s < seq]
+            for s in drained:
+                self.segments.remove(s)
+                self.sizes.pop(s, None)
+                self.counts.pop(s, None)
+        self.save_checkpoint(seq, offset)
+        for s in drained:
+            try: os.remove(self.segment_file(s))
+            except: print_exc(sys._getframe().f_code.co_name)
+
+# Background thread which replays spooled records into the database
+# through write_batch(rows), which must raise an exception if database
+# is not reachable. Rows are (date, source, data) tuples. With delay, the
+# drainer waits <delay> seconds after a batch which was not full, so that
+# records are written in bigger batches.
+class SpoolDrainer:
+    def __init__(self, spool, write_batch, batch_size=DRAIN_BATCH, delay=0):
+        self.spool = spool
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.delay = delay
+        self.running = False
+        self.stopped = Event()
+        self.thread = None
+        self.drained = 0
+        self.retry = 0
+
+    def start(self):
+        self.running = True
+        self.stopped.clear()
+        self.thread = Thread(target=self.run, name='SpoolDrainer')
+        self.thread.daemon = True; self.thread.start()
+
+    def stop(self, timeout=10):
+        with self.spool.cond:
+            self.running = False
+            self.stopped.set()
+            self.spool.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.spool.close()
+
+    def run(self):
+        delay = RETRY_DELAY
+        last_sync = time.monotonic()
+        while True:
+            if self.spool.fsync == 'interval' and time.monotonic() - last_sync >= self.spool.fsync_delay:
+                try: self.spool.sync()
+                except: print_exc(sys._getframe().f_code.co_name)
+                last_sync = time.monotonic()
+            try:
+                records, position = self.spool.read(self.batch_size)
+                if records:
+                    self.write_batch(records)
+                    self.drained += len(records)
+                if position != self.spool.checkpoint:
+                    self.spool.commit(position, len(records))
+                delay = RETRY_DELAY
+                self.retry = 0
+                if records and len(records) < self.batch_size and self.delay:
+                    if self.stopped.wait(self.delay): return
+                    continue
+                if records or position[0] != self.spool.seq:
+                    continue # more records are waiting
+            except:
+                print_exc(sys._getframe().f_code.co_name)
+                self.retry += 1
+                if self.stopped.wait(delay): return
+                delay = min(delay*2, RETRY_MAX)
+                continue
+            with self.spool.cond:
+                if not self.running: return
+                self.spool.cond.wait(self.spool.fsync_delay)
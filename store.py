@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor in-memory store of recent measurements
+# Every sensor has a columnar ring buffer: preallocated array of int64
+# timestamps (msec) and one float64 array of values per data key.
+# Values which are not numbers (for example "none") are stored as NaN.
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+NAN = float('nan')
+INF = float('inf')
+
+class RingBuffer:
+    __slots__ = ('capacity', 'times', 'columns', 'start', 'count')
+
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self.times = array('q', bytes(8*self.capacity))
+        self.columns = {} # data key -> array('d')
+        self.start = 0 # physical index of the oldest sample
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        return (len(self.columns) + 1)*8*self.capacity
+
+    def append(self, t, values):
+        capacity = self.capacity
+        if self.count < capacity:
+            i = (self.start + self.count) % capacity
+            self.count += 1
+        else:
+            i = self.start
+            self.start = (self.start + 1) % capacity
+        self.times[i] = t
+        columns = self.columns
+        for key, value in values.items():
+            column = columns.get(key)
+            if column is None:
+                column = columns[key] = array('d', [NAN])*capacity
+            try:
+                column[i] = value
+            except TypeError:
+                try: column[i] = float(value)
+                except (TypeError, ValueError): column[i] = NAN
+        if len(columns) > len(values):
+            for key, column in columns.items():
+                if key not in values:
+                    column[i] = NAN
+
+    def first_time(self):
+        return self.times[self.start] if self.count else None
+
+    def last_time(self):
+        return self.times[(self.start + self.count - 1) % self.capacity] if self.count else None
+
+    # logical index of the first sample with time >= t (times are ascending)
+    def index(self, t):
+        times = self.times; start = self.start; capacity = self.capacity
+        lo = 0; hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[(start + mid) % capacity] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, t_from=None, t_to=None):
+        # logical indexes [lo, hi) of samples with t_from <= time <= t_to
+        lo = 0 if t_from is None else self.index(t_from)
+        hi = self.count if t_to is None else self.index(t_to + 1)
+        return lo, max(lo, hi)
+
+    def _slice(self, column, lo, hi):
+        # contiguous copy of logical range [lo, hi) of column
+        capacity = self.capacity
+        a = (self.start + lo) % capacity
+        b = a + (hi - lo)
+        if b <= capacity:
+            return column[a:b]
+        return column[a:] + column[:b - capacity]
+
+    # samples with t_from <= time <= t_to (or only the last samples),
+    # returns (times, {key: values}) as arrays
+    def slice(self, t_from=None, t_to=None, last=None):
+        lo, hi = self.range(t_from, t_to)
+        if last is not None:
+            lo = max(lo, hi - last)
+        times = self._slice(self.times, lo, hi)
+        return times, dict((key, self._slice(column, lo, hi)) for key, column in self.columns.items())
+
+    # column of one data key, or None if key is unknown
+    def column(self, key, t_from=None, t_to=None):
+        column = self.columns.get(key)
+        if column is None:
+            return None, None
+        lo, hi = self.range(t_from, t_to)
+        return self._slice(self.times, lo, hi), self._slice(column, lo, hi)
+
+    # last sample as (time, {key: value})
+    def last(self):
+        if not self.count: return None, {}
+        i = (self.start + self.count - 1) % self.capacity
+        return self.times[i], dict((key, column[i]) for key, column in self.columns.items())
+
+# NaN and infinity are not valid JSON, use null instead
+def json_values(values):
+    return [None if v != v or v == INF or v == -INF else v for v in values]
+
+def json_value(v):
+    return None if v != v or v == INF or v == -INF else v
+
+# Downsampling of one column (times ascending) for long time ranges.
+# Buckets are equal time intervals, values are reduced with builtins over
+# array slices, so there is no Python loop over every sample.
+
+# min/max/mean/count of values in <points> buckets between t_from and t_to
+def aggregate(times, values, t_from, t_to, points):
+    width = max(1, -(-(t_to - t_from + 1) // points)) # ceil
+    result = {'width': width, 'time': [], 'min': [], 'max': [], 'mean': [], 'count': []}
+    lo = bisect_left(times, t_from)
+    end = bisect_right(times, t_to)
+    b = t_from
+    while lo < end:
+        b_end = b + width
+        hi = bisect_left(times, b_end, lo, end)
+        if hi > lo:
+            chunk = values[lo:hi]
+            total = sum(chunk)
+            if total != total or total == INF or total == -INF:
+                chunk = [v for v in chunk if v == v and v != INF and v != -INF]
+                total = sum(chunk)
+            if chunk:
+                result['time'].append(b)
+                result['min'].append(min(chunk))
+                result['max'].append(max(chunk))
+                result['mean'].append(total/len(chunk))
+                result['count'].append(len(chunk))
+            lo = hi
+        else:
+            b = times[lo] - (times[lo] - t_from) % width # skip empty buckets
+            continue
+        b = b_end
+    return result
+
+# Largest-Triangle-Three-Buckets downsampling to <points> samples. Long
+# series are first reduced to min and max of 4*<points> buckets (MinMaxLTTB),
+# so that LTTB itself only runs over a few thousand samples.
+def lttb(times, values, points):
+    points = max(3, points)
+    if len(values) > 8*points:
+        times, values = minmax_select(times, values, 2*points)
+    total = sum(values)
+    if total != total or total == INF or total == -INF:
+        pairs = [(t, v) for t, v in zip(times, values) if v == v and v != INF and v != -INF]
+        times = [p[0] for p in pairs]; values = [p[1] for p in pairs]
+    n = len(values)
+    if n <= points:
+        return list(times), list(values)
+    out_t = [times[0]]; out_v = [values[0]]
+    size = (n - 2)/(points - 2)
+    a = 0
+    for i in range(points - 2):
+        start = int(i*size) + 1
+        end = int((i + 1)*size) + 1
+        # average of next bucket
+        n_start = end
+        n_end = min(int((i + 2)*size) + 1, n)
+        cx = sum(times[n_start:n_end])/(n_end - n_start)
+        cy = sum(values[n_start:n_end])/(n_end - n_start)
+        ax = times[a]; ay = values[a]
+        # triangle area ~ |A*y + B*x + C|
+        A = ax - cx; B = cy - ay; C = -A*ay - B*ax
+        best = start; best_area = -1.0
+        for j in range(start, end):
+            area = abs(A*values[j] + B*times[j] + C)
+            if area > best_area:
+                best_area = area; best = j
+        out_t.append(times[best]); out_v.append(values[best])
+        a = best
+    out_t.append(times[n - 1]); out_v.append(values[n - 1])
+    return out_t, out_v
+
+# indexes of min and max of each of <buckets> equal-count buckets
+def minmax_select(times, values, buckets):
+    n = len(values)
+    size = n/buckets
+    sel = [0]
+    for i in range(buckets):
+        lo = int(i*size); hi = int((i + 1)*size)
+        if hi <= lo: continue
+        chunk = values[lo:hi]
+        total = sum(chunk)
+        if total != total or total == INF or total == -INF:
+            finite = [k for k, v in enumerate(chunk) if v == v and v != INF and v != -INF]
+            if not finite: continue
+            i_min = lo + min(finite, key=chunk.__getitem__)
+            i_max = lo + max(finite, key=chunk.__getitem__)
+        else:
+            i_min = lo + chunk.index(min(chunk))
+            i_max = lo + chunk.index(max(chunk))
+        if i_min > i_max: i_min, i_max = i_max, i_min
+        if i_min > sel[-1]: sel.append(i_min)
+        if i_max > sel[-1]: sel.append(i_max)
+    if sel[-1] != n - 1: sel.append(n - 1)
+    return [times[i] for i in sel], [values[i] for i in sel]
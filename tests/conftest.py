@@ -0,0 +1,101 @@
+# coding: utf-8
+
+# Tests import modules of the repository root and run its scripts,
+# run them from there with "python -m pytest tests"
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import psycopg2
+
+import database as db
+from spool import Spool
+
+SERVER = os.path.join(ROOT, 'bluesensor-server.py')
+# Database of servers run by tests (never the one of database.py): rows are
+# checked there when BLUESENSOR_TEST_DB is set, otherwise servers get a
+# database which doesn't exist and rows stay in their spool
+TEST_DB = os.environ.get('BLUESENSOR_TEST_DB')
+NO_DB = 'bluesensor_no_test_db'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for(url, timeout=15, until=None):
+    end = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                body = response.read()
+            if until is None or until in body:
+                return body
+        except OSError:
+            if time.monotonic() > end: raise
+        if time.monotonic() > end:
+            raise TimeoutError('{} not in response of {}'.format(until, url))
+        time.sleep(0.1)
+
+# bluesensor-server.py with args, on a free port, saving every measurement
+# into spool_path; returns (process, port)
+def start_server(args, spool_path):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, SERVER, '--port', str(port), '--log-level', 'warning',
+                               '--data-log', '1', '--db-rollup', 'none', '--spool', spool_path] + args,
+                              env=dict(os.environ, BLUESENSOR_DB=TEST_DB or NO_DB),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for('http://127.0.0.1:{}/api/status'.format(port))
+    except:
+        server.kill()
+        raise
+    return server, port
+
+def stop_server(server):
+    server.send_signal(signal.SIGINT)
+    server.wait(30)
+
+def db_rows(source):
+    # (date, data) of rows of source already written to test database, none
+    # if it is not set or not reachable
+    if TEST_DB is None:
+        return []
+    try:
+        conn = psycopg2.connect(host=db.DBHOST, dbname=TEST_DB, user=db.DBUSER,
+                                password=db.DBPWD, connect_timeout=2)
+    except psycopg2.Error:
+        return []
+    try:
+        with conn.cursor() as cs:
+            cs.execute('SELECT date, data FROM {} WHERE source = %s'.format(db.TABLE), (source,))
+            return [(db.sqlDate(row[0]), row[1]) for row in cs.fetchall()]
+    except psycopg2.Error:
+        return []
+    finally:
+        conn.close()
+
+# (date, data) of rows of source saved by a stopped server: in its spool, or
+# already written to test database
+def saved_rows(spool_path, source):
+    rows = db_rows(source)
+    spool = Spool(spool_path)
+    while True:
+        records, position = spool.read(10000)
+        if not records and position == spool.checkpoint: break
+        for date, record_source, data in records:
+            assert record_source == source
+            rows.append((date, json.loads(data)))
+        spool.commit(position)
+    spool.close()
+    return rows
@@ -0,0 +1,61 @@
+# coding: utf-8
+
+# Alert rules (alerts.py)
+
+import math
+import random
+import statistics
+
+import alerts
+
+def engine(specs, now):
+    events = []
+    e = alerts.Engine([alerts.Rule(spec) for spec in specs], ['0'], events.append, now)
+    return e, events
+
+def test_stale_counts_from_arrival_not_from_measurement_time():
+    now = 1700000000000
+    e, events = engine([{'name': 'silent', 'type': 'stale', 'seconds': 30}], now)
+    # backlog of an agent: measurements of the last hour arrive at once
+    for i in range(3600):
+        e.sample('0', now - 3600000 + i*1000, {'temp1': 20.0}, now)
+    e.check(now + 1000)
+    assert events == []
+    e.check(now + 31000)
+    assert [event['state'] for event in events] == ['firing']
+    e.sample('0', now + 32000, {'temp1': 20.0}, now + 32000)
+    assert [event['state'] for event in events] == ['firing', 'resolved']
+
+def test_rate_uses_measurement_time():
+    now = 1700000000000
+    e, events = engine([{'name': 'jump', 'key': 'temp1', 'type': 'rate', 'per_second': 1}], now)
+    # values 1 s apart by their time, all received at once
+    e.sample('0', now, {'temp1': 20.0}, now)
+    e.sample('0', now + 1000, {'temp1': 20.5}, now)
+    assert events == []
+    e.sample('0', now + 2000, {'temp1': 25.0}, now)
+    assert events[-1]['state'] == 'firing' and events[-1]['time'] == now + 2000
+
+def test_window_matches_statistics_of_last_values():
+    rnd = random.Random(3)
+    w = alerts.Window(60)
+    values = []
+    for i in range(10000):
+        # large offset, so that rounding errors of running sums would show
+        value = 1e6 + rnd.gauss(0, 1)
+        w.add(value); values.append(value)
+        if i % 97 == 0 or i == 9999:
+            last = values[-60:]
+            assert len(w) == len(last)
+            assert math.isclose(w.mean(), statistics.fmean(last), rel_tol=1e-12)
+            if len(last) > 1:
+                assert math.isclose(w.stddev(), statistics.pstdev(last), rel_tol=1e-3)
+
+def test_zscore_fires_on_outlier():
+    now = 1700000000000
+    e, events = engine([{'name': 'spike', 'key': 'gas1', 'type': 'zscore', 'window': 20, 'z': 4}], now)
+    for i in range(40):
+        e.sample('0', now + i*1000, {'gas1': 10.0 + (i % 2)*0.5}, now + i*1000)
+    assert events == []
+    e.sample('0', now + 40000, {'gas1': 30.0}, now + 40000)
+    assert events[-1]['state'] == 'firing' and events[-1]['value'] == 30.0
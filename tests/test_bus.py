@@ -0,0 +1,36 @@
+# coding: utf-8
+
+# Local message bus of web workers (bus.py)
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import bus
+
+def test_snapshot_is_written_in_parts_before_live_messages(tmp_path):
+    path = str(tmp_path / 'bus.sock')
+    parts = 200
+    received = []
+
+    def snapshot():
+        for i in range(parts):
+            yield bus.encode('h', '0', '{"chunk": %d, "pad": "%s"}' % (i, 'x'*10000))
+
+    def on_message(kind, sensor, payload):
+        received.append((kind, payload))
+
+    @gen.coroutine
+    def run():
+        server = bus.BusServer(path, snapshot)
+        IOLoop.current().add_callback(bus.subscribe, path, on_message)
+        while not server.subscribers:
+            yield gen.sleep(0.01)
+        # published while snapshot is being written
+        server.publish('m', '0', '{"live": 1}')
+        while len(received) < parts + 1:
+            yield gen.sleep(0.01)
+        server.close()
+
+    IOLoop.current().run_sync(run, timeout=10)
+    assert [kind for kind, payload in received] == ['h']*parts + ['m']
+    assert received[-1][1] == b'{"live": 1}'
@@ -0,0 +1,53 @@
+# coding: utf-8
+
+# Capture of serial data and its replay through a reader (capture.py)
+
+import capture
+import database as db
+import readers
+from timing import clock
+from conftest import start_server, stop_server, wait_for, saved_rows
+
+def frame(pm25, pm10, device=0x1234):
+    data = bytes([pm25 & 0xFF, pm25 >> 8, pm10 & 0xFF, pm10 >> 8, device & 0xFF, device >> 8])
+    return bytes([readers.SDS_HEAD, readers.SDS_DATA]) + data + bytes([sum(data) & 0xFF, readers.SDS_TAIL])
+
+def test_replay_at_max_speed_keeps_original_times(tmp_path):
+    path = str(tmp_path / 'dust.cap')
+    t0 = 1700000000000
+    cap = capture.Capture(path, 'read-dust', '0')
+    for i in range(1000):
+        cap.append(frame(100 + i, 200 + i), clock.mono(t0 + i*1000))
+    cap.close()
+
+    rp = capture.Replay(path, None)
+    reader = readers.SDS021_Reader('0', simulate=True)
+    measurements = []
+    while not rp.done:
+        for data, received in rp.due():
+            measurements += reader.feed(data, received)
+    rp.close()
+    assert [m['time'] for m in measurements] == [t0 + i*1000 for i in range(1000)]
+    assert measurements[-1]['data'] == {'pm25': 109.9, 'pm10': 119.9}
+
+def test_rows_of_replay_at_max_speed_are_dated_with_captured_times(tmp_path):
+    # second record holds three frames of one read
+    t0 = 1700000000000
+    cap = capture.Capture(str(tmp_path / 'ttyUSB0.cap'), 'read-dust', '/dev/ttyUSB0')
+    cap.append(frame(100, 200), clock.mono(t0))
+    cap.append(frame(101, 201) + frame(102, 202) + frame(103, 203), clock.mono(t0 + 1000))
+    for i in range(2, 100):
+        cap.append(frame(102 + i, 202 + i), clock.mono(t0 + i*1000))
+    cap.close()
+
+    spool_path = str(tmp_path / 'spool')
+    server, port = start_server(['--replay', str(tmp_path), '--replay-speed', 'max', 'read-dust', '0'], spool_path)
+    try:
+        wait_for('http://127.0.0.1:{}/api/status'.format(port), until=b'"done"')
+    finally:
+        stop_server(server)
+    rows = saved_rows(spool_path, '/dev/ttyUSB0')
+    times = [t0, t0 + 1000, t0 + 1001, t0 + 1002] + [t0 + i*1000 for i in range(2, 100)]
+    assert sorted(date for date, data in rows) == [db.sqlDate(db.msDate(t)) for t in times]
+    for date, data in rows:
+        assert date == db.sqlDate(db.msDate(data['time']))
@@ -0,0 +1,51 @@
+# coding: utf-8
+
+# Batch of an agent through bluesensor-server.py into the database path:
+# every measurement must become its own row, dated with its own time.
+# Rows are read from spool of the server and, with BLUESENSOR_TEST_DB, from
+# that database (see conftest.py).
+
+import json
+import uuid
+import urllib.request
+
+import agent
+import database as db
+from conftest import start_server, stop_server, saved_rows
+
+RECORDS = 5000
+
+# posts measurements (dicts) of one port as a batch of an agent, returns
+# (date, data) of rows saved from it
+def ingest(tmp_path, measurements):
+    agent_id = 'test-' + uuid.uuid4().hex[:8]
+    spool_path = str(tmp_path / 'spool')
+    server, port = start_server(['--ingest', str(tmp_path / 'ingest.json')], spool_path)
+    try:
+        body = ''.join('{}\t0\t{}\n'.format(i + 1, json.dumps(m)) for i, m in enumerate(measurements))
+        data, encoding = agent.compress(body.encode('utf-8'))
+        request = urllib.request.Request(
+            'http://127.0.0.1:{}/api/ingest?agent={}&reader=read-serial&run=1'.format(port, agent_id),
+            data, {'Content-Type': 'text/tab-separated-values', 'Content-Encoding': encoding})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            result = json.loads(response.read().decode('utf-8'))
+        assert result['accepted'] == len(measurements)
+    finally:
+        stop_server(server)
+    return saved_rows(spool_path, agent_id + ':0')
+
+def test_ingest_batch_is_saved_row_per_measurement(tmp_path):
+    # measurements 1 msec apart, sent at once as after an outage of the link
+    t0 = 1700000000000
+    rows = ingest(tmp_path, [{'time': t0 + i, 'data': {'temp1': i}} for i in range(RECORDS)])
+    assert len(set(date for date, data in rows)) == RECORDS
+    for date, data in rows:
+        assert date == db.sqlDate(db.msDate(data['time']))
+    assert min(date for date, data in rows) == db.sqlDate(db.msDate(t0))
+
+def test_measurements_with_same_time_are_saved_row_each(tmp_path):
+    # several measurements decoded from one read of an agent's reader
+    t0 = 1700000000000
+    rows = ingest(tmp_path, [{'time': t0, 'data': {'pm25': i}} for i in range(3)])
+    assert sorted(date for date, data in rows) == [db.sqlDate(db.msDate(t0 + i)) for i in range(3)]
+    assert sorted(data['data']['pm25'] for date, data in rows) == [0, 1, 2]
@@ -0,0 +1,72 @@
+# coding: utf-8
+
+# Decoding of dust sensor frames (readers.sds_decode, SDS021_Reader.feed)
+# on a recorded stream with corrupt frames, garbage and frames split
+# between reads
+
+import random
+
+import readers
+
+def frame(pm25, pm10, device=0x1234, cmd=readers.SDS_DATA, checksum=None):
+    data = bytes([pm25 & 0xFF, pm25 >> 8, pm10 & 0xFF, pm10 >> 8, device & 0xFF, device >> 8])
+    if checksum is None:
+        checksum = sum(data) & 0xFF
+    return bytes([readers.SDS_HEAD, cmd]) + data + bytes([checksum, readers.SDS_TAIL])
+
+# (stream, expected values, corrupt frames): values avoid byte 0xAA, so
+# decoder resynchronizes on the next frame
+def recording():
+    stream = b''; values = []
+    for i in range(100):
+        pm25 = 100 + i; pm10 = 300 + i
+        stream += frame(pm25, pm10)
+        values.append((pm25/10, pm10/10))
+    stream += frame(1, 2, checksum=0)              # bad checksum
+    stream += b'\x01\x02\x03'                      # garbage
+    stream += frame(5, 6)[:9] + b'\x00'            # bad tail
+    stream += frame(0, 0, cmd=readers.SDS_REPLY)   # reply to a command, no values
+    for i in range(100):
+        stream += frame(500 + i, 700 + i)
+        values.append(((500 + i)/10, (700 + i)/10))
+    return stream, values, 2
+
+def test_decode_skips_corrupt_frames_and_resynchronizes():
+    stream, values, corrupt = recording()
+    decoded, pos, n_corrupt, skipped = readers.sds_decode(stream)
+    assert decoded == values
+    assert pos == len(stream)
+    assert n_corrupt == corrupt
+    assert skipped == 10 + 3 + 10
+
+def test_decode_keeps_incomplete_frame():
+    data = frame(10, 20) + frame(30, 40)[:7]
+    decoded, pos, corrupt, skipped = readers.sds_decode(data)
+    assert decoded == [(1.0, 2.0)]
+    assert pos == readers.SDS_FRAME
+    assert (corrupt, skipped) == (0, 0)
+
+def test_feed_with_frames_split_between_reads():
+    stream, values, corrupt = recording()
+    reader = readers.SDS021_Reader('0', simulate=True)
+    rnd = random.Random(1)
+    measurements = []
+    pos = 0
+    while pos < len(stream):
+        n = rnd.randint(1, 25)
+        measurements += reader.feed(stream[pos:pos + n])
+        pos += n
+    assert [(m['data']['pm25'], m['data']['pm10']) for m in measurements] == values
+    assert reader.stats() == {'frames': len(values), 'corrupt_frames': corrupt, 'dropped_bytes': 23}
+
+def test_measurements_of_one_read_get_increasing_times():
+    reader = readers.SDS021_Reader('0', simulate=True)
+    measurements = reader.feed(frame(10, 20) + frame(30, 40) + frame(50, 60), 1000000000)
+    times = [m['time'] for m in measurements]
+    assert len(times) == 3 and times[0] < times[1] < times[2]
+    # next read at the same millisecond continues after them
+    assert reader.feed(frame(70, 80), 1000000000)[0]['time'] == times[2] + 1
+
+    reader = readers.SerialReader('0', simulate=True)
+    measurements = reader.feed(b'{"data": {"temp1": 1}}\n{"data": {"temp1": 2}}\n', 1000000000)
+    assert measurements[0]['time'] + 1 == measurements[1]['time']
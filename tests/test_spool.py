@@ -0,0 +1,45 @@
+# coding: utf-8
+
+# Local spool of database rows (spool.py)
+
+from spool import Spool
+
+def fill(spool, prefix, n):
+    for i in range(n):
+        spool.append('{}{}'.format(prefix, i), 'src', 'x'*20)
+
+# records of spool from checkpoint on, committed as drainer does
+def drain(spool):
+    records = []
+    while True:
+        batch, position = spool.read(1000)
+        if position == spool.checkpoint: return records
+        spool.commit(position, len(batch))
+        records += batch
+
+def test_size_cap_counts_lost_records(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=1000, max_size=3000)
+    fill(spool, 'a', 50)
+    batch, position = spool.read(5)
+    spool.commit(position, len(batch))
+    fill(spool, 'b', 200)
+    assert spool.lost > 0
+    records = drain(spool)
+    assert len(records) == spool.appended - spool.lost - 5
+    assert records[-1][0] == 'b199'
+    spool.close()
+
+def test_size_cap_after_restart(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=1000, max_size=3000)
+    fill(spool, 'a', 60)
+    batch, position = spool.read(10)
+    spool.commit(position, len(batch))
+    spool.sync()
+    spool.close()
+    # counts of segments on disk and of drained records are restored
+    spool = Spool(str(tmp_path), segment_size=1000, max_size=3000)
+    fill(spool, 'b', 100)
+    records = drain(spool)
+    assert len(records) == 60 + 100 - 10 - spool.lost
+    assert records[-1][0] == 'b99'
+    spool.close()
@@ -0,0 +1,89 @@
+# coding: utf-8
+
+# In-memory store of measurements (store.py)
+
+import math
+import random
+from array import array
+
+from store import RingBuffer, aggregate, lttb
+
+NAN = float('nan')
+
+def filled(capacity, n):
+    rb = RingBuffer(capacity)
+    for i in range(n):
+        rb.append(1000 + i*10, {'a': i, 'b': i*2})
+    return rb
+
+def test_ring_buffer_keeps_last_samples_after_wrap():
+    rb = filled(5, 12)
+    assert len(rb) == 5
+    assert (rb.first_time(), rb.last_time()) == (1070, 1110)
+    times, columns = rb.slice()
+    assert list(times) == [1070, 1080, 1090, 1100, 1110]
+    assert list(columns['a']) == [7, 8, 9, 10, 11]
+    assert list(columns['b']) == [14, 16, 18, 20, 22]
+    assert rb.last() == (1110, {'a': 11, 'b': 22})
+
+def test_ring_buffer_time_range_across_wrap():
+    rb = filled(5, 8) # physical order 1050, 1060, 1070 | 1030, 1040
+    times, columns = rb.slice(1035, 1065)
+    assert list(times) == [1040, 1050, 1060]
+    assert list(columns['a']) == [4, 5, 6]
+    times, columns = rb.slice(last=2)
+    assert list(times) == [1060, 1070]
+    times, values = rb.column('b', t_from=1060)
+    assert (list(times), list(values)) == ([1060, 1070], [12, 14])
+    assert rb.column('missing') == (None, None)
+    assert list(rb.slice(2000)[0]) == []
+
+def test_ring_buffer_missing_and_invalid_values_are_nan():
+    rb = RingBuffer(4)
+    rb.append(1, {'a': 1.5})
+    rb.append(2, {'a': 'none', 'b': '2.5'})
+    rb.append(3, {'b': None})
+    times, columns = rb.slice()
+    assert list(times) == [1, 2, 3]
+    assert columns['a'][0] == 1.5 and math.isnan(columns['a'][1]) and math.isnan(columns['a'][2])
+    assert math.isnan(columns['b'][0]) and columns['b'][1] == 2.5 and math.isnan(columns['b'][2])
+
+def brute_aggregate(times, values, t_from, t_to, width):
+    buckets = {}
+    for t, v in zip(times, values):
+        if t_from <= t <= t_to and v == v:
+            buckets.setdefault(t_from + (t - t_from)//width*width, []).append(v)
+    return [(b, min(vs), max(vs), sum(vs)/len(vs), len(vs)) for b, vs in sorted(buckets.items())]
+
+def test_aggregate_matches_brute_force():
+    rnd = random.Random(2)
+    times = array('q'); values = array('d')
+    t = 0
+    for i in range(5000):
+        t += rnd.choice((1, 1, 2, 50, 3000)) # with gaps longer than buckets
+        times.append(t)
+        values.append(NAN if rnd.random() < 0.05 else rnd.uniform(-10, 10))
+    t_from, t_to = times[100], times[4000]
+    result = aggregate(times, values, t_from, t_to, 200)
+    expected = brute_aggregate(times, values, t_from, t_to, result['width'])
+    assert result['width'] == -(-(t_to - t_from + 1)//200)
+    got = list(zip(result['time'], result['min'], result['max'], result['mean'], result['count']))
+    assert [g[0] for g in got] == [e[0] for e in expected]
+    for g, e in zip(got, expected):
+        assert g[1:3] == e[1:3] and g[4] == e[4] and math.isclose(g[3], e[3])
+
+def test_lttb_keeps_ends_and_peaks():
+    times = array('q', range(0, 100000, 10))
+    values = array('d', (math.sin(i/500) for i in range(len(times))))
+    values[3333] = 50.0; values[7777] = -50.0
+    values[100] = NAN
+    t, v = lttb(times, values, 100)
+    assert len(t) == len(v) == 100
+    assert (t[0], t[-1]) == (times[0], times[-1])
+    assert list(t) == sorted(t)
+    assert 50.0 in v and -50.0 in v
+    assert all(x == x for x in v)
+
+def test_lttb_short_series_unchanged():
+    times = array('q', [1, 2, 3, 4]); values = array('d', [1.0, NAN, 3.0, 4.0])
+    assert lttb(times, values, 10) == ([1, 3, 4], [1.0, 3.0, 4.0])
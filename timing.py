@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# BlueSensor timing
+# Timestamps of measurements are milliseconds since epoch (UTC), taken from
+# time.time_ns(). Display time zone (DISPLAY_TZ) is applied only when times
+# are shown (in graf.html), never to stored or transmitted timestamps.
+# Intervals between samples are measured on the monotonic clock.
+# Run bench-timing.py for cost of one call of these functions.
+
+import time
+import datetime
+
+DISPLAY_TZ = 'Europe/Ljubljana' # time zone of dates shown in web application
+CLOCK_SYNC = 60                 # seconds between synchronizations of monotonic and wall clock
+MAX_BURST  = 1.0                # max seconds of missed ticks which are caught up by Schedule
+
+# current time in msec since epoch (UTC)
+def now_ms():
+    return time.time_ns() // 1000000
+
+# msec since epoch to naive UTC datetime (date column in database)
+def utc_datetime(ms):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=ms)
+
+# Wall clock time of monotonic clock readings (time.monotonic_ns()).
+# Measurements are timestamped with monotonic time when they are received,
+# so that timestamps don't jump when system time is changed; offset to wall
+# clock is updated every CLOCK_SYNC seconds.
+class Clock:
+    def __init__(self):
+        self.sync()
+
+    def sync(self):
+        mono = time.monotonic_ns()
+        self.offset = time.time_ns() - mono
+        self.synced = mono
+
+    # msec since epoch (UTC) of monotonic time mono (ns), or of now
+    def ms(self, mono=None):
+        if mono is None:
+            mono = time.monotonic_ns()
+        if mono - self.synced > CLOCK_SYNC*1000000000:
+            self.sync()
+        return (mono + self.offset) // 1000000
+
+    # monotonic time (ns) of msec since epoch ms, inverse of ms()
+    def mono(self, ms):
+        return ms*1000000 - self.offset
+
+clock = Clock()
+
+# Ticks at <rate> per second on monotonic clock. Tick times are computed
+# from the start, so the rate doesn't drift with the time spent between
+# ticks; ticks missed by less than MAX_BURST seconds are caught up at once.
+class Schedule:
+    def __init__(self, rate):
+        self.period = max(1, int(1e9/rate)) # ns
+        self.start = time.monotonic_ns()
+        self.count = 0 # ticks done
+
+    # monotonic times (ns) of ticks which are due
+    def due(self):
+        n = (time.monotonic_ns() - self.start) // self.period + 1
+        burst = max(1, int(MAX_BURST*1e9) // self.period)
+        if n - self.count > burst:
+            self.count = n - burst # skip the rest
+        ticks = [self.start + i*self.period for i in range(self.count, n)]
+        self.count = max(self.count, n)
+        return ticks
+
+    # seconds until next tick
+    def delay(self):
+        return max(0.0, (self.start + self.count*self.period - time.monotonic_ns())/1e9)